@@ -3,12 +3,231 @@ A custom wrapper for the official ChatGPT API
 Removed unnecessary code
 """
 import os
-import openai
-import tiktoken
+import json
+import time
+import random
+import asyncio
+import requests
+from typing import TYPE_CHECKING
+from requests.adapters import HTTPAdapter
 from decouple import config
 
-ENGINE = config("OPENAI_ENGINE", default="gpt-3.5-turbo")
-ENCODER = tiktoken.encoding_for_model(ENGINE)
+from utils import metrics
+from utils import completion_cache
+from utils.log import get_logger
+from utils.ratelimit import TokenBucket
+from utils.models import ENGINE, COMPLETION_MODEL, OPENAI_ANSWER_TOKENS, get_model
+
+OPENAI_API_BASE = config("OPENAI_API_BASE", default="https://api.openai.com/v1")
+# Keep-alive connections shared by all chats
+OPENAI_POOL_SIZE = config("OPENAI_POOL_SIZE", default=20, cast=int)
+# Seconds to connect and to wait for next piece of response
+OPENAI_CONNECT_TIMEOUT = config("OPENAI_CONNECT_TIMEOUT", default=10.0, cast=float)
+OPENAI_TIMEOUT = config("OPENAI_TIMEOUT", default=120.0, cast=float)
+# Retries on 429/5xx and connection errors, with jittered exponential backoff
+OPENAI_MAX_RETRIES = config("OPENAI_MAX_RETRIES", default=4, cast=int)
+OPENAI_BACKOFF_BASE = config("OPENAI_BACKOFF_BASE", default=1.0, cast=float)
+OPENAI_BACKOFF_MAX = config("OPENAI_BACKOFF_MAX", default=30.0, cast=float)
+# Client-side limits (0 = no limit), answer is expected to take OPENAI_ANSWER_TOKENS
+OPENAI_RPM = config("OPENAI_RPM", default=0, cast=int)
+OPENAI_TPM = config("OPENAI_TPM", default=0, cast=int)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+SUMMARY_PROMPT = ("Condense the conversation below into a short summary for yourself to continue it later. "
+                  "Keep names, facts, decisions, user preferences and open questions. Answer with the summary only.")
+
+log = get_logger("openai")
+
+if TYPE_CHECKING:
+    import aiohttp
+
+
+def count_usage(prompt_tokens, completion_tokens):
+    """Add tokens of one request to metrics and current trace"""
+    metrics.count(metrics.OPENAI_TOKENS, prompt_tokens, "tokens_in", direction="prompt")
+    metrics.count(metrics.OPENAI_TOKENS, completion_tokens, "tokens_out", direction="completion")
+
+
+class OpenAIError(Exception):
+    """Error response from OpenAI API"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class OpenAIClient:
+    """
+    HTTP client for OpenAI API shared by all chats: pooled keep-alive session,
+    timeouts, retries with backoff and requests/tokens per minute limits
+    """
+
+    def __init__(self, api_key: str) -> None:
+        self.api_key = api_key
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=OPENAI_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(self.headers())
+        self.async_session = None
+        self.requests_limit = TokenBucket(OPENAI_RPM)
+        self.tokens_limit = TokenBucket(OPENAI_TPM)
+        self.retries = 0
+
+    def headers(self) -> dict:
+        """Auth headers"""
+        return {"Authorization": f"Bearer {self.api_key}"}
+
+    def backoff(self, attempt, retry_after=None) -> float:
+        """Seconds to wait before next attempt: server hint or full-jitter exponential"""
+        if retry_after:
+            try:
+                return min(float(retry_after), OPENAI_BACKOFF_MAX)
+            except ValueError:
+                pass
+        return random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+
+    def post(self, path, payload, tokens, stream=False) -> requests.Response:
+        """POST to API and return response, retrying temporary failures"""
+        self.requests_limit.acquire()
+        self.tokens_limit.acquire(tokens)
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            retry_after = None
+            try:
+                response = self.session.post(
+                    OPENAI_API_BASE + path,
+                    json=payload,
+                    stream=stream,
+                    timeout=(OPENAI_CONNECT_TIMEOUT, OPENAI_TIMEOUT),
+                )
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                error = OpenAIError(f"OpenAI API request failed: {ex}")
+                metrics.OPENAI_REQUESTS.inc(status="error")
+            else:
+                metrics.OPENAI_REQUESTS.inc(status=response.status_code)
+                if response.status_code < 400:
+                    return response
+                error = OpenAIError(self.error_message(response.status_code, response.text), response.status_code)
+                if response.status_code not in RETRY_STATUSES:
+                    raise error
+                retry_after = response.headers.get("Retry-After")
+                response.close()
+            if attempt == OPENAI_MAX_RETRIES:
+                raise error
+            self.retries += 1
+            metrics.count(metrics.OPENAI_RETRIES, 1, "openai_retries", reason=error.status or "connection")
+            wait = self.backoff(attempt, retry_after)
+            log.warning("%s, retry %s/%s in %.1fs", error, attempt + 1, OPENAI_MAX_RETRIES, wait)
+            time.sleep(wait)
+
+    async def apost(self, path, payload, tokens) -> "aiohttp.ClientResponse":
+        """Async version of post, caller must release the response"""
+        # aiohttp is imported by async mode only, sync bot starts without it
+        import aiohttp
+        await self.requests_limit.aacquire()
+        await self.tokens_limit.aacquire(tokens)
+        session = self.get_async_session()
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            retry_after = None
+            try:
+                response = await session.post(OPENAI_API_BASE + path, json=payload)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                error = OpenAIError(f"OpenAI API request failed: {ex}")
+                metrics.OPENAI_REQUESTS.inc(status="error")
+            else:
+                metrics.OPENAI_REQUESTS.inc(status=response.status)
+                if response.status < 400:
+                    return response
+                error = OpenAIError(self.error_message(response.status, await response.text()), response.status)
+                response.release()
+                if response.status not in RETRY_STATUSES:
+                    raise error
+                retry_after = response.headers.get("Retry-After")
+            if attempt == OPENAI_MAX_RETRIES:
+                raise error
+            self.retries += 1
+            metrics.count(metrics.OPENAI_RETRIES, 1, "openai_retries", reason=error.status or "connection")
+            wait = self.backoff(attempt, retry_after)
+            log.warning("%s, retry %s/%s in %.1fs", error, attempt + 1, OPENAI_MAX_RETRIES, wait)
+            await asyncio.sleep(wait)
+
+    def get_async_session(self) -> "aiohttp.ClientSession":
+        """aiohttp session bound to running event loop"""
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        if self.async_session is None or self.async_session.closed or self.async_session._loop is not loop:
+            self.async_session = aiohttp.ClientSession(
+                headers=self.headers(),
+                connector=aiohttp.TCPConnector(limit=OPENAI_POOL_SIZE),
+                timeout=aiohttp.ClientTimeout(sock_connect=OPENAI_CONNECT_TIMEOUT, sock_read=OPENAI_TIMEOUT),
+            )
+        return self.async_session
+
+    def error_message(self, status, body) -> str:
+        """Readable message from error response"""
+        try:
+            return f"OpenAI API error {status}: {json.loads(body)['error']['message']}"
+        except (ValueError, KeyError, TypeError):
+            return f"OpenAI API error {status}: {body[:200]}"
+
+    def request(self, path, payload, tokens) -> dict:
+        """POST and return parsed JSON"""
+        response = self.post(path, payload, tokens)
+        return self.counted(response.json())
+
+    async def arequest(self, path, payload, tokens) -> dict:
+        """Async POST and return parsed JSON"""
+        response = await self.apost(path, payload, tokens)
+        async with response:
+            return self.counted(await response.json())
+
+    def counted(self, body) -> dict:
+        """Add token usage reported in response to metrics"""
+        usage = body.get("usage")
+        if usage:
+            count_usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+        return body
+
+    def stream(self, path, payload, tokens):
+        """POST with stream=True and yield parsed server-sent events"""
+        response = self.post(path, {**payload, "stream": True}, tokens, stream=True)
+        with response:
+            for line in response.iter_lines():
+                chunk = self.parse_event(line)
+                if chunk is None:
+                    continue
+                if chunk == "[DONE]":
+                    return
+                yield chunk
+
+    async def astream(self, path, payload, tokens):
+        """Async version of stream"""
+        response = await self.apost(path, {**payload, "stream": True}, tokens)
+        async with response:
+            async for line in response.content:
+                chunk = self.parse_event(line.strip())
+                if chunk is None:
+                    continue
+                if chunk == "[DONE]":
+                    return
+                yield chunk
+
+    def parse_event(self, line):
+        """Parse `data: {...}` line of event stream"""
+        if not line.startswith(b"data: "):
+            return None
+        data = line[len(b"data: "):].strip()
+        if data == b"[DONE]":
+            return "[DONE]"
+        return json.loads(data)
+
+
+clients = {}
+
+def get_client(api_key: str) -> OpenAIClient:
+    """Get client shared by all chats for API key"""
+    if api_key not in clients:
+        clients[api_key] = OpenAIClient(api_key)
+    return clients[api_key]
 
 
 class Chatbot:
@@ -17,54 +236,198 @@ class Chatbot:
     """
 
     def get_max_tokens(self, prompt: str) -> int:
-        """ Get the max tokens for a prompt """
-        return 4000 - len(ENCODER.encode(prompt))
+        """ Get the max tokens left for the answer to a completion prompt """
+        model = get_model(COMPLETION_MODEL)
+        max_tokens = model.context - model.count(prompt)
+        if max_tokens <= 0:
+            raise OpenAIError(f"Prompt is too long for {COMPLETION_MODEL}")
+        return max_tokens
 
     def __init__(self, api_key: str) -> None:
         """
         Initialize Chatbot with API key (from https://platform.openai.com/account/api-keys)
         """
-        openai.api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        self.client = get_client(api_key or os.environ.get("OPENAI_API_KEY"))
         self.engine = ENGINE
-        print(f"[BOT] Initialized Chatbot with engine {self.engine}");
+        self.model = get_model(ENGINE)
+        log.info("Initialized Chatbot with engine %s", self.engine)
 
-    def ask_gpt(self, prompt, temperature: "0.5") -> dict:
+    def ask_gpt(self, prompt, temperature: "0.5", cache=False) -> dict:
         """
-        Send a request to ChatGPT and return the response
+        Send a request to ChatGPT and return the response, with cache=True a cached answer to the same request may be returned
         """
-        completion = openai.Completion.create(
-            engine='text-davinci-003',
-            prompt=prompt,
-            temperature=float(temperature or 0.5),
-            max_tokens=self.get_max_tokens(prompt),
-        )
-        if completion.get("choices") is None:
-            raise Exception("ChatGPT API returned no choices")
-        if len(completion["choices"]) == 0:
-            raise Exception("ChatGPT API returned no choices")
-        
-        text = completion.choices[0].text
+        params = self.gpt_params(prompt, temperature)
+        key, text = self.cached(params, cache)
+        if text is not None:
+            return text
+        completion = self.client.request("/completions", params, self.gpt_tokens(params))
+        return self.store(key, self.gpt_text(completion))
+
+    async def aask_gpt(self, prompt, temperature: "0.5", cache=False) -> dict:
+        """
+        Async version of ask_gpt
+        """
+        params = self.gpt_params(prompt, temperature)
+        key, text = self.cached(params, cache)
+        if text is not None:
+            return text
+        completion = await self.client.arequest("/completions", params, self.gpt_tokens(params))
+        return self.store(key, self.gpt_text(completion))
+
+    def cached(self, params, cache) -> tuple:
+        """Cache key of request (None if answer can not be reused) and cached answer"""
+        key = completion_cache.request_key(params) if cache else None
+        if key is None:
+            return None, None
+        return key, completion_cache.get(key)
+
+    def store(self, key, text) -> str:
+        """Put answer to cache if request has a key, returns answer"""
+        if key is not None:
+            completion_cache.put(key, text)
         return text
 
+    def gpt_params(self, prompt, temperature) -> dict:
+        """Request params for Completion API"""
+        return {
+            "model": COMPLETION_MODEL,
+            "prompt": prompt,
+            "temperature": float(temperature or 0.5),
+            "max_tokens": self.get_max_tokens(prompt),
+        }
+
+    def gpt_tokens(self, params) -> int:
+        """Tokens Completion request counts against the limit: prompt plus max answer"""
+        # max_tokens is whatever the prompt left of the context
+        return get_model(COMPLETION_MODEL).context
+
+    def gpt_text(self, completion) -> str:
+        """Get text from Completion API response"""
+        self.check_choices(completion)
+        text = completion["choices"][0]["text"]
+        return text
 
-    def ask(self, messages, temperature: "0.5") -> dict:
+
+    def ask(self, messages, temperature: "0.5", cache=False) -> dict:
         """
         Send a request to ChatGPT and return the response
         """
-        completion = openai.ChatCompletion.create(
-            model=self.engine,
-            temperature=float(temperature),
-            messages=messages,
-            #max_tokens=4000,
-        )
+        params = self.chat_params(messages, temperature)
+        key, text = self.cached(params, cache)
+        if text is not None:
+            return text
+        completion = self.client.request("/chat/completions", params, self.chat_tokens(messages))
+        return self.store(key, self.chat_text(completion))
+
+    async def aask(self, messages, temperature: "0.5", cache=False) -> dict:
+        """
+        Async version of ask
+        """
+        params = self.chat_params(messages, temperature)
+        key, text = self.cached(params, cache)
+        if text is not None:
+            return text
+        completion = await self.client.arequest("/chat/completions", params, self.chat_tokens(messages))
+        return self.store(key, self.chat_text(completion))
+
+    def summarize(self, previous_summary, messages) -> str:
+        """
+        Fold messages into summary of the conversation, used by conv for long chats
+        """
+        lines = [f"Earlier summary: {previous_summary}"] if previous_summary else []
+        lines += [f"{message['role']}: {message['content']}" for message in messages]
+        prompt = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": "\n".join(lines)},
+        ]
+        return self.ask(prompt, "0.2")
+
+    def ask_stream(self, messages, temperature: "0.5", cache=False):
+        """
+        Send a request to ChatGPT and yield response text pieces as they are generated.
+        Cached answer comes as one piece
+        """
+        params = self.chat_params(messages, temperature)
+        key, text = self.cached(params, cache)
+        if text is not None:
+            yield text
+            return
+        tokens = self.chat_tokens(messages)
+        chunks = self.client.stream("/chat/completions", params, tokens)
+        # Streamed responses have no usage, every chunk carries one token
+        pieces = []
+        try:
+            for chunk in chunks:
+                delta = self.chunk_text(chunk)
+                if delta:
+                    pieces.append(delta)
+                    yield delta
+        finally:
+            count_usage(tokens - OPENAI_ANSWER_TOKENS, len(pieces))
+        # Only complete answers are cached, not ones cut by an error
+        self.store(key, "".join(pieces))
+
+    async def aask_stream(self, messages, temperature: "0.5", cache=False):
+        """
+        Async version of ask_stream
+        """
+        params = self.chat_params(messages, temperature)
+        key, text = self.cached(params, cache)
+        if text is not None:
+            yield text
+            return
+        tokens = self.chat_tokens(messages)
+        chunks = self.client.astream("/chat/completions", params, tokens)
+        pieces = []
+        try:
+            async for chunk in chunks:
+                delta = self.chunk_text(chunk)
+                if delta:
+                    pieces.append(delta)
+                    yield delta
+        finally:
+            count_usage(tokens - OPENAI_ANSWER_TOKENS, len(pieces))
+        self.store(key, "".join(pieces))
+
+    def chunk_text(self, chunk) -> str:
+        """Get text piece from streamed ChatCompletion chunk"""
+        self.check_choices(chunk)
+        return chunk["choices"][0].get("delta", {}).get("content")
+
+    def chat_params(self, messages, temperature) -> dict:
+        """Request params for ChatCompletion API"""
+        return {
+            "model": self.engine,
+            "temperature": float(temperature),
+            "messages": self.to_api_messages(messages),
+            #"max_tokens": 4000,
+        }
+
+    def chat_tokens(self, messages) -> int:
+        """Tokens ChatCompletion request counts against the limit, from cached history counts.
+        Raises OpenAIError without calling API if the prompt does not fit into the model context"""
+        prompt = self.model.chat_tokens(messages)
+        if prompt >= self.model.context:
+            raise OpenAIError(f"Prompt of {prompt} tokens is too long for {self.engine} ({self.model.context})")
+        return prompt + OPENAI_ANSWER_TOKENS
+
+    def chat_text(self, completion) -> str:
+        """Get text from ChatCompletion API response"""
+        self.check_choices(completion)
+        text = self.hotfix_text(completion["choices"][0]["message"]["content"])
+        return text
+
+    def check_choices(self, completion):
+        """Raise if API response has no choices"""
         if completion.get("choices") is None:
             raise Exception("ChatGPT API returned no choices")
         if len(completion["choices"]) == 0:
             raise Exception("ChatGPT API returned no choices")
-        
-        text = self.hotfix_text(completion.choices[0].message.content)
-        return text
-    
+
+    def to_api_messages(self, messages) -> list:
+        """Drop local bookkeeping keys (like cached token counts) from messages"""
+        return [{"role": message["role"], "content": message["content"]} for message in messages]
+
     def hotfix_text(self, text) -> str:
         """Hotfix for text"""
         text_to_delete = [
@@ -72,4 +435,4 @@ class Chatbot:
         ]
         for item in text_to_delete:
             text = text.replace(item, '')
-        return text
\ No newline at end of file
+        return text
@@ -1,229 +1,256 @@
 # pylint: disable = no-name-in-module
 """Telegram bot for OpenAI GPT-3 chatbot"""
-from datetime import datetime
-import traceback
+import os
 from decouple import config
 import telebot
 
 # Local imports
 from ai import Chatbot
-from conv import load, get, init, reset, rollback, get_file_path, trans
-from conv import save_question, save_response, save_chat_settings, get_all_chat_settings
+from conv import get, init, reset, rollback, history_len, last_message, forget_delivery, get_storage
+from conv import save_question, save_response, save_chat_settings, get_all_chat_settings, set_summarizer
 from utils.serp import get_serp
+from sender import Sender, split_message
+import export
+from utils import metrics
+from utils.log import get_logger
+from common import AVAILBLE_SETTINGS, HELP_MESSAGE, get_rollback_count
+from common import settings_text, parse_setting, get_question
+from common import STREAM_RESPONSES, STREAM_PLACEHOLDER, StreamBuffer, InFlight
+
+log = get_logger("bot")
 
 # Get API key from .env file
 API_KEY = config("OPENAI_TOKEN")
 BOT_TOKEN = config("BOT_TOKEN")
+# Bot API server, for local Bot API server or tests
+TELEGRAM_API_URL = config("TELEGRAM_API_URL", default="")
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
 bot = telebot.TeleBot(BOT_TOKEN)
-chatbots = {}
-try:
-    BOT_NAME = bot.get_me().username
-    print(f"[TELEGRAM] Token is ok, bot username: @{BOT_NAME}")
-except AttributeError as error:
-    print(f"Looks like telegram token is invalid, error: {error}")
-    exit(1)
-
-BOT_USERNAME = bot.get_me().username
-
-print("[BOT] Initialized Chatbot @"+BOT_USERNAME)
-
-AVAILBLE_SETTINGS = [
-    {
-        "k": "region",
-        "default": "us-en",
-        "description": "Region of DuckDuckGo search engine: wt-wt, us-en, uk-en, ru-ru, etc.",
-    },
-    {
-        "k": "num",
-        "default": "3",
-        "description": "Max results to show from DuckDuckGo search engine",
-        "options": ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10"],
-    },
-    {
-        "k": "time",
-        "default": "all",
-        "description": "Time range of DuckDuckGo search engine: all, d, w, m, y",
-        "options": ["all", "d", "w", "m", "y"],
-    },
-    {
-        "k": "temperature",
-        "default": "0.5",
-        "description": "Temperature of OpenAI GPT-3 chatbot",
-        "options": ["0.1", "0.2", "0.3", "0.4", "0.5", "0.6", "0.7", "0.8", "0.9", "1.0"],
-    }
-]
-
-def get_time():
-    """Get current time"""
-    return datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+# Replies wait for Telegram rate limits instead of failing
+sender = Sender(bot)
+# One client for all chats: shared connection pool and rate limits
+chatbot = Chatbot(api_key=API_KEY)
+set_summarizer(chatbot.summarize)
+# Worker processes get username from the process that started them, see workers.py
+BOT_NAME = config("BOT_USERNAME", default="")
+# Telegram redelivers updates after timeouts and restarts, each message is answered once
+inflight = InFlight()
 
 def initialize_chatbot(message):
-    """Initialize chatbot"""
-    if message.chat.id not in chatbots:
-        chatbots[message.chat.id] = Chatbot(api_key=API_KEY)
-        load(message.chat.id)
-        init(message.chat.id, message.chat.title, message.chat.type, message.from_user)
-        print(f"[BOT] Created chatbot for chat {message.chat.id}")
-        return True
-    return False
+    """Initialize chat history, loads it from storage if chat is not in memory"""
+    init(message.chat.id, message.chat.title, message.chat.type, message.from_user)
 
 @bot.message_handler(commands=['reset'])
 def reset_event(message):
     """Reset chat history"""
     initialize_chatbot(message)
     reset(message.chat.id)
-    bot.reply_to(message, "Chat history has been reset to empty!")
+    sender.reply(message, "Chat history has been reset to empty!")
 
 @bot.message_handler(commands=['rollback'])
 def rollback_event(message):
     """Rollback one message"""
-    initialize_chatbot(message)
-    # Get count from command of fallback to 1
-    count = int(message.text.split()[1]) if len(message.text.split()) > 1 else 1
-    history = get(message.chat.id)
-     # Check if can rollback (not more than history size)
-    if len(history) < count:
-        bot.reply_to(message, "Can't rollback more than chat history size!")
-        return
-    rollback(message.chat.id, count)
-    history = get(message.chat.id)
-    last_message = history[-count]
-    bot.reply_to(message, "Chat history rollback successful. Last message now: " + last_message["text"])
+    with metrics.request("rollback", message):
+        initialize_chatbot(message)
+        with inflight.once(message) as first:
+            if not first:
+                return
+            count = get_rollback_count(message.text)
+             # Check if can rollback (not more than history size)
+            if history_len(message.chat.id) < count:
+                sender.reply(message, "Can't rollback more than chat history size!")
+                return
+            rollback(message.chat.id, count)
+            last = last_message(message.chat.id)
+            sender.reply(message, "Chat history rollback successful. Last message now: " + (last["content"] if last else "(history is empty)"))
 
 
 @bot.message_handler(commands=['help', 'start'])
 def help_message(message):
     """Display help message"""
-    bot.reply_to(message, """Hi, I'm a chatbot powered by OpenAI GPT-3. 
-Open source code on GitHub: https://github.com/Hormold/py-tg-chat by @define
-Current chat history size: """ + str(len(get(message.chat.id))) + """. Bot uses ChatGPT API.
-
-Available commands:
-/help - Display this message
-/rollback <num> - Rollback current chat history by <num> messages
-/reset - Remove all current chat history
-/backup - Download chat history (json file)
-/s <query> - Search on DuckDuckGo and compile a one-line response
-/settings key:value - Change chat settings (see /settings) + set temperature
-""")
+    sender.reply(message, HELP_MESSAGE.format(history_size=history_len(message.chat.id)))
 
 @bot.message_handler(commands=['settings'])
 def settings_message(message):
     """Display chat settings"""
-    initialize_chatbot(message)
-    settings = get_all_chat_settings(message.chat.id, AVAILBLE_SETTINGS)
-    if len(message.text.split()) == 1:
-        # Display current settings
-        text = "Available settings:\n\n"
-        for sett in AVAILBLE_SETTINGS:
-            current_value = settings[sett["k"]]
-            text += f"{sett['k']}: {current_value} ({sett['description']})\n"
-        text+="\n\nSend message in format /settings key:value to change setting. Example: /settings temperature:0.5"
-        bot.reply_to(message, text)
-    else:
-        # Change settings
-        key, value = message.text.split()[1].split(":")
-        if key not in settings:
-            bot.reply_to(message, f"Invalid setting key: {key}")
-            return
-      
-        # if has settings[key]["options"] and value not in settings[key]["options"]
-        if "options" in settings[key] and value not in settings[key]["options"]:
-            #map_to_str = lambda x: str(x)
-            options = settings[key]["options"]#map(map_to_str, settings[key]["options"])
-            bot.reply_to(message, f"Invalid setting value: {value}, available options: {options.join(', ')}")
-            return
-        if (value == "default" or len(value) == 0 or value == " " or len(value) > 100):
-            value = settings[key]["default"]
-        if key == "num":
-            value = int(value)
-        if key == "temperature":
-            if(float(value) > 1.0):
-                value = "1.0"
-            if(float(value) < 0.1):
-                value = "0.1"
-        save_chat_settings(message.chat.id, key, value)
-        bot.reply_to(message, f"Setting {key} has been changed to {value}")
+    with metrics.request("settings", message):
+        initialize_chatbot(message)
+        settings = get_all_chat_settings(message.chat.id, AVAILBLE_SETTINGS)
+        if len(message.text.split()) == 1:
+            # Display current settings
+            sender.reply(message, settings_text(settings))
+        else:
+            # Change settings
+            key, value, error = parse_setting(message.text)
+            if error is not None:
+                sender.reply(message, error)
+                return
+            save_chat_settings(message.chat.id, key, value)
+            sender.reply(message, f"Setting {key} has been changed to {value}")
+
+def send_export(message, caption, build, *args):
+    """Build export file in export pool and send it, runs off handler thread"""
+    path = None
+    try:
+        path, name = build(*args)
+        with open(path, 'rb') as document:
+            bot.send_document(message.chat.id, document=document, caption=caption, visible_file_name=name)
+    except export.ExportError as err:
+        sender.reply(message, str(err))
+    except Exception as err:
+        log.exception("Export failed in chat %s > %s", message.chat.id, err)
+        sender.reply(message, f"Export failed: {err}")
+    finally:
+        if path is not None:
+            os.remove(path)
 
 @bot.message_handler(commands=['backup'])
 def backup_message(message):
     """Download chat history"""
     initialize_chatbot(message)
-    # Get chat history as json string
-    file_path = get_file_path(message.chat.id)
-    # Send chat history as file - backup.json
-    bot.send_document(
-        message.chat.id,
-        document=open(file_path, 'rb'),
-        caption="Chat history backup"
-    )
+    try:
+        options, _ = export.parse_options(message.text)
+    except export.ExportError as err:
+        sender.reply(message, str(err))
+        return
+    export.executor.submit(send_export, message, "Chat history backup", export.export_chat, message.chat.id, options)
+
+@bot.message_handler(commands=['export'])
+def export_message(message):
+    """Download history of many chats, for bot admins"""
+    if message.from_user.id not in export.ADMIN_IDS:
+        sender.reply(message, "Only bot admins can export other chats, use /backup")
+        return
+    try:
+        options, words = export.parse_options(message.text)
+        chat_ids = export.bundle_ids(words)
+    except export.ExportError as err:
+        sender.reply(message, str(err))
+        return
+    export.executor.submit(send_export, message, export.bundle_caption(words), export.export_bundle, chat_ids, options)
 
 @bot.message_handler(commands=['s'])
 def search_message(message):
     """Search on DuckDuckGo"""
-    initialize_chatbot(message)
-    # Get search query from command /s <query>
-    query = message.text.split(maxsplit=1)[1]
-    # Get search results
-    settings = get_all_chat_settings(message.chat.id, AVAILBLE_SETTINGS)
-    bot.send_chat_action(message.chat.id, 'typing')
-
-    try: 
-        final_prompt = get_serp(query, num_results=int(settings["num"]), time_period=settings["time"], region=settings["region"])
-        save_question(message.chat.id, 'Search in DuckDuckGo for: '+query, message.from_user)
-        resp = chatbots[message.chat.id].ask_gpt(final_prompt, temperature=float(settings["temperature"]))
-        save_response(message.chat.id, resp)
+    with metrics.request("search", message):
+        initialize_chatbot(message)
+        with inflight.once(message) as first:
+            if not first:
+                return
+            # Get search query from command /s <query>
+            query = message.text.split(maxsplit=1)[1]
+            # Get search results
+            settings = get_all_chat_settings(message.chat.id, AVAILBLE_SETTINGS)
+            sender.action(message.chat.id, 'typing')
+
+            try: 
+                with metrics.stage("search"):
+                    final_prompt = get_serp(query, num_results=int(settings["num"]), time_period=settings["time"], region=settings["region"],
+                                            deep=settings["deep"] == "on")
+                if not save_question(message.chat.id, 'Search in DuckDuckGo for: '+query, message.from_user, message.message_id):
+                    # Update was delivered twice, the first one is answered
+                    return
+                with metrics.stage("openai"):
+                    resp = chatbot.ask_gpt(final_prompt, temperature=float(settings["temperature"]), cache=settings["cache"] == "on")
+                save_response(message.chat.id, resp)
         
-    except Exception as err:
-        print('[ERROR] Search error: ', err)
-        return bot.reply_to(message, "Search error: " + str(err))
-    try: 
-        # Try to response in markdown
-        bot.reply_to(message, resp, parse_mode="Markdown")
-    except Exception as err:
-        print('[ERROR] Markdown error: ', err)
-        bot.reply_to(message, resp)
+            except Exception as err:
+                log.error("Search error: %s", err)
+                # Not answered, redelivered update tries again
+                forget_delivery(message.chat.id, message.message_id)
+                return sender.reply(message, "Search error: " + str(err))
+            # Plain text if Telegram can't parse Markdown of the answer
+            sender.reply(message, resp, parse_mode="Markdown")
+
+def stream_reply(message, chat_history, temperature, cache=False):
+    """Reply with placeholder and edit it while completion is streamed, returns final text"""
+    placeholder = sender.reply(message, STREAM_PLACEHOLDER)
+    buffer = StreamBuffer()
+    for delta in chatbot.ask_stream(chat_history, temperature=temperature, cache=cache):
+        if not buffer.add(delta):
+            continue
+        text = buffer.preview(chatbot.hotfix_text)
+        if text is None:
+            continue
+        if sender.edit(text, message.chat.id, placeholder.message_id, final=False):
+            buffer.mark_shown(text)
+        else:
+            # Skip this edit, next one will catch up
+            buffer.mark_failed()
+    resp = chatbot.hotfix_text(buffer.text)
+    # Answer longer than one message continues in new ones
+    parts = split_message(resp)
+    if parts and parts[0].strip() and parts[0] != buffer.shown:
+        sender.edit(parts[0], message.chat.id, placeholder.message_id)
+    for part in parts[1:]:
+        sender.send(message.chat.id, part)
+    return resp
 
 @bot.message_handler(func=lambda message: True)
 def reply(message):
     """Handle all incoming messages"""
-    initialize_chatbot(message)
+    with metrics.request("reply", message):
+        with metrics.stage("init"):
+            initialize_chatbot(message)
 
-    # Ignore zero length messages or it 1 symbol
-    if len(message.text) < 2:
-        return
-    is_reply = False
-    if message.reply_to_message is not None:
-        is_reply = message.reply_to_message.from_user.username == BOT_NAME
-    # If message not from private chat, it must start with bot name
-    if message.chat.type != "private" and not message.text.startswith(f"@{BOT_NAME}") and not is_reply:
-        return
-    else:
-        message.text = message.text.replace(f"@{BOT_NAME}", "").strip()
+        question = get_question(message, BOT_NAME)
+        if question is None:
+            return
+        message.text = question
+        with inflight.once(message) as first:
+            if not first:
+                return
+            # Save message to chat history
+            with metrics.stage("save_question"):
+                saved = save_question(message.chat.id, message.text, message.from_user, message.message_id)
+            if not saved:
+                return
 
-    # Allow only latin characters
-    if not message.text.isascii():
-        message.text = trans(message.text)
-        # Non latin characters are very slow to process and badly tokenized
-    # Save message to chat history
-    save_question(message.chat.id, message.text, message.from_user)
+            with metrics.stage("get"):
+                chat_history = get(message.chat.id)
 
-    chat_history = get(message.chat.id)
+            settings = get_all_chat_settings(message.chat.id, AVAILBLE_SETTINGS)
 
-    settings = get_all_chat_settings(message.chat.id, AVAILBLE_SETTINGS)
+            # Send typing status
+            with metrics.stage("send"):
+                sender.action(message.chat.id, 'typing')
 
-    # Send typing status
-    bot.send_chat_action(message.chat.id, 'typing')
+            try:
+                log.debug("[%s in %s] > %s (%s)", message.from_user.id, message.chat.id, message.text, settings['temperature'])
+                if STREAM_RESPONSES:
+                    # Stream stage covers generation and edits of the placeholder
+                    with metrics.stage("stream"):
+                        resp = stream_reply(message, chat_history, settings["temperature"], settings["cache"] == "on")
+                else:
+                    with metrics.stage("openai"):
+                        resp = chatbot.ask(chat_history, temperature=settings["temperature"], cache=settings["cache"] == "on")
+                    with metrics.stage("send"):
+                        sender.reply(message, resp)
+                log.debug("[BOT] < %s", resp)
+                with metrics.stage("save_response"):
+                    save_response(message.chat.id, resp)
+            except Exception as ex:
+                log.exception("On reply > %s", ex)
+                # Not answered, redelivered update tries again
+                forget_delivery(message.chat.id, message.message_id)
+                sender.reply(message, 'Oops, something went wrong. '+str(ex))
 
+def check_token():
+    """Learn bot username with getMe unless BOT_USERNAME has it, exit on invalid token"""
+    global BOT_NAME
+    if BOT_NAME:
+        return
     try:
-        print(f"[{get_time()}] [{message.from_user.id} in {message.chat.id}] > {message.text} ({settings['temperature']})")
-        resp = chatbots[message.chat.id].ask(chat_history, temperature=settings["temperature"])
-        print(f"[{get_time()}] [BOT] < {resp}")
-        bot.reply_to(message, resp)
-        save_response(message.chat.id, resp)
-    except Exception as ex:
-        bot.reply_to(message, 'Oops, something went wrong. '+str(ex))
-        print(f"[ERROR] On reply > {ex}")
-        traceback.print_exc()
-
-bot.infinity_polling()
+        BOT_NAME = bot.get_me().username
+        log.info("Token is ok, bot username: @%s", BOT_NAME)
+    except AttributeError as error:
+        log.critical("Looks like telegram token is invalid, error: %s", error)
+        exit(1)
+
+if __name__ == "__main__":
+    # Setup with side effects stays here: spawned helper processes import this module again
+    get_storage()
+    check_token()
+    metrics.start_server()
+    bot.infinity_polling()
@@ -0,0 +1,335 @@
+# pylint: disable = no-name-in-module
+"""Telegram bot for OpenAI GPT-3 chatbot, asyncio mode
+
+Every chat gets its own ordered queue: messages of one chat are handled one by one,
+different chats are handled concurrently (up to MAX_CONCURRENCY at once).
+Run: python async_app.py
+"""
+import os
+import asyncio
+from decouple import config
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+# Local imports
+from ai import Chatbot
+from conv import get, init, reset, rollback, history_len, last_message, first_delivery, forget_delivery, get_storage
+from conv import save_question, save_response, save_chat_settings, get_all_chat_settings, set_summarizer
+from utils.serp import get_serp
+from sender import AsyncSender, split_message
+import export
+from utils import metrics
+from utils.log import get_logger
+from common import AVAILBLE_SETTINGS, HELP_MESSAGE, get_rollback_count
+from common import settings_text, parse_setting, get_question
+from common import STREAM_RESPONSES, STREAM_PLACEHOLDER, StreamBuffer
+
+log = get_logger("bot")
+
+# Get API key from .env file
+API_KEY = config("OPENAI_TOKEN")
+BOT_TOKEN = config("BOT_TOKEN")
+# Bot API server, for local Bot API server or tests
+TELEGRAM_API_URL = config("TELEGRAM_API_URL", default="")
+# Max chats processed at the same time
+MAX_CONCURRENCY = config("MAX_CONCURRENCY", default=16, cast=int)
+# Seconds before idle chat queue worker is stopped
+CHAT_IDLE_TIMEOUT = config("CHAT_IDLE_TIMEOUT", default=60, cast=int)
+
+if TELEGRAM_API_URL:
+    asyncio_helper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+bot = AsyncTeleBot(BOT_TOKEN)
+# Replies wait for Telegram rate limits instead of failing
+sender = AsyncSender(bot)
+# One client for all chats: shared connection pool and rate limits
+chatbot = Chatbot(api_key=API_KEY)
+set_summarizer(chatbot.summarize)
+BOT_NAME = None
+# Exports run outside chat queues, references keep tasks from being collected
+background_tasks = set()
+
+
+class ChatQueues:
+    """Ordered job queue per chat with global concurrency cap"""
+
+    def __init__(self, limit, idle_timeout):
+        self.limit = limit
+        self.idle_timeout = idle_timeout
+        self.queues = {}
+        self.workers = set()
+        self.semaphore = None
+
+    def submit(self, chat_id, job):
+        """Queue coroutine function `job` to run after previous jobs of this chat"""
+        if self.semaphore is None:
+            # Created lazily, so it is bound to running loop
+            self.semaphore = asyncio.Semaphore(self.limit)
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = asyncio.Queue()
+            worker = asyncio.create_task(self.worker(chat_id, queue))
+            self.workers.add(worker)
+            worker.add_done_callback(self.workers.discard)
+        queue.put_nowait(job)
+
+    async def worker(self, chat_id, queue):
+        """Run jobs of one chat in order, stop after idle timeout"""
+        while True:
+            try:
+                job = await asyncio.wait_for(queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                # No await between check and removal, so submit() can't race with it
+                if queue.empty():
+                    del self.queues[chat_id]
+                    return
+                continue
+            async with self.semaphore:
+                try:
+                    await job()
+                except Exception as ex:
+                    log.exception("Job failed in chat %s > %s", chat_id, ex)
+
+chat_queues = ChatQueues(MAX_CONCURRENCY, CHAT_IDLE_TIMEOUT)
+
+def per_chat(handler):
+    """Run handler through chat queue instead of inline"""
+    async def wrapper(message):
+        chat_queues.submit(message.chat.id, lambda: handler(message))
+    wrapper.__name__ = handler.__name__
+    wrapper.__doc__ = handler.__doc__
+    return wrapper
+
+async def offload(function, *args):
+    """Run blocking conv/storage call in default executor, so disk IO of one chat
+    does not stall other chats. Jobs of a chat await it, so their order is kept,
+    and metrics trace of the request is carried into the thread"""
+    return await asyncio.to_thread(function, *args)
+
+async def initialize_chatbot(message):
+    """Initialize chat history, loads it from storage if chat is not in memory"""
+    await offload(init, message.chat.id, message.chat.title, message.chat.type, message.from_user)
+
+@bot.message_handler(commands=['reset'])
+@per_chat
+async def reset_event(message):
+    """Reset chat history"""
+    await initialize_chatbot(message)
+    await offload(reset, message.chat.id)
+    await sender.reply(message, "Chat history has been reset to empty!")
+
+@bot.message_handler(commands=['rollback'])
+@per_chat
+async def rollback_event(message):
+    """Rollback one message"""
+    with metrics.request("rollback", message):
+        await initialize_chatbot(message)
+        if not await offload(first_delivery, message.chat.id, message.message_id):
+            return
+        count = get_rollback_count(message.text)
+         # Check if can rollback (not more than history size)
+        if await offload(history_len, message.chat.id) < count:
+            await sender.reply(message, "Can't rollback more than chat history size!")
+            return
+        await offload(rollback, message.chat.id, count)
+        last = await offload(last_message, message.chat.id)
+        await sender.reply(message, "Chat history rollback successful. Last message now: " + (last["content"] if last else "(history is empty)"))
+
+@bot.message_handler(commands=['help', 'start'])
+@per_chat
+async def help_message(message):
+    """Display help message"""
+    await sender.reply(message, HELP_MESSAGE.format(history_size=await offload(history_len, message.chat.id)))
+
+@bot.message_handler(commands=['settings'])
+@per_chat
+async def settings_message(message):
+    """Display chat settings"""
+    with metrics.request("settings", message):
+        await initialize_chatbot(message)
+        settings = await offload(get_all_chat_settings, message.chat.id, AVAILBLE_SETTINGS)
+        if len(message.text.split()) == 1:
+            # Display current settings
+            await sender.reply(message, settings_text(settings))
+        else:
+            # Change settings
+            key, value, error = parse_setting(message.text)
+            if error is not None:
+                await sender.reply(message, error)
+                return
+            await offload(save_chat_settings, message.chat.id, key, value)
+            await sender.reply(message, f"Setting {key} has been changed to {value}")
+
+def run_in_background(coroutine):
+    """Start task that does not hold chat queue or concurrency slot"""
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def send_export(message, caption, build, *args):
+    """Build export file in export pool and send it"""
+    path = None
+    try:
+        path, name = await asyncio.get_running_loop().run_in_executor(export.executor, build, *args)
+        with open(path, 'rb') as document:
+            await bot.send_document(message.chat.id, document=document, caption=caption, visible_file_name=name)
+    except export.ExportError as err:
+        await sender.reply(message, str(err))
+    except Exception as err:
+        log.exception("Export failed in chat %s > %s", message.chat.id, err)
+        await sender.reply(message, f"Export failed: {err}")
+    finally:
+        if path is not None:
+            os.remove(path)
+
+@bot.message_handler(commands=['backup'])
+@per_chat
+async def backup_message(message):
+    """Download chat history"""
+    await initialize_chatbot(message)
+    try:
+        options, _ = export.parse_options(message.text)
+    except export.ExportError as err:
+        await sender.reply(message, str(err))
+        return
+    run_in_background(send_export(message, "Chat history backup", export.export_chat, message.chat.id, options))
+
+@bot.message_handler(commands=['export'])
+@per_chat
+async def export_message(message):
+    """Download history of many chats, for bot admins"""
+    if message.from_user.id not in export.ADMIN_IDS:
+        await sender.reply(message, "Only bot admins can export other chats, use /backup")
+        return
+    try:
+        options, words = export.parse_options(message.text)
+        chat_ids = export.bundle_ids(words)
+    except export.ExportError as err:
+        await sender.reply(message, str(err))
+        return
+    run_in_background(send_export(message, export.bundle_caption(words), export.export_bundle, chat_ids, options))
+
+@bot.message_handler(commands=['s'])
+@per_chat
+async def search_message(message):
+    """Search on DuckDuckGo"""
+    with metrics.request("search", message):
+        await initialize_chatbot(message)
+        if not await offload(first_delivery, message.chat.id, message.message_id):
+            return
+        # Get search query from command /s <query>
+        query = message.text.split(maxsplit=1)[1]
+        # Get search results
+        settings = await offload(get_all_chat_settings, message.chat.id, AVAILBLE_SETTINGS)
+        await sender.action(message.chat.id, 'typing')
+
+        try:
+            # DuckDuckGo client is blocking, keep it off the event loop
+            with metrics.stage("search"):
+                final_prompt = await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: get_serp(query, num_results=int(settings["num"]), time_period=settings["time"], region=settings["region"],
+                                           deep=settings["deep"] == "on"))
+            if not await offload(save_question, message.chat.id, 'Search in DuckDuckGo for: '+query, message.from_user, message.message_id):
+                # Update was delivered twice, the first one is answered
+                return
+            with metrics.stage("openai"):
+                resp = await chatbot.aask_gpt(final_prompt, temperature=float(settings["temperature"]), cache=settings["cache"] == "on")
+            await offload(save_response, message.chat.id, resp)
+
+        except Exception as err:
+            log.error("Search error: %s", err)
+            # Not answered, redelivered update tries again
+            await offload(forget_delivery, message.chat.id, message.message_id)
+            return await sender.reply(message, "Search error: " + str(err))
+        # Plain text if Telegram can't parse Markdown of the answer
+        await sender.reply(message, resp, parse_mode="Markdown")
+
+async def stream_reply(message, chat_history, temperature, cache=False):
+    """Reply with placeholder and edit it while completion is streamed, returns final text"""
+    placeholder = await sender.reply(message, STREAM_PLACEHOLDER)
+    buffer = StreamBuffer()
+    async for delta in chatbot.aask_stream(chat_history, temperature=temperature, cache=cache):
+        if not buffer.add(delta):
+            continue
+        text = buffer.preview(chatbot.hotfix_text)
+        if text is None:
+            continue
+        if await sender.edit(text, message.chat.id, placeholder.message_id, final=False):
+            buffer.mark_shown(text)
+        else:
+            # Skip this edit, next one will catch up
+            buffer.mark_failed()
+    resp = chatbot.hotfix_text(buffer.text)
+    # Answer longer than one message continues in new ones
+    parts = split_message(resp)
+    if parts and parts[0].strip() and parts[0] != buffer.shown:
+        await sender.edit(parts[0], message.chat.id, placeholder.message_id)
+    for part in parts[1:]:
+        await sender.send(message.chat.id, part)
+    return resp
+
+@bot.message_handler(func=lambda message: True)
+@per_chat
+async def reply(message):
+    """Handle all incoming messages"""
+    with metrics.request("reply", message):
+        with metrics.stage("init"):
+            await initialize_chatbot(message)
+
+        question = get_question(message, BOT_NAME)
+        if question is None:
+            return
+        message.text = question
+        # Jobs of chat run one by one, so redelivered message comes after the first one is answered
+        if not await offload(first_delivery, message.chat.id, message.message_id):
+            return
+        # Save message to chat history
+        with metrics.stage("save_question"):
+            saved = await offload(save_question, message.chat.id, message.text, message.from_user, message.message_id)
+        if not saved:
+            return
+
+        with metrics.stage("get"):
+            chat_history = await offload(get, message.chat.id)
+
+        settings = await offload(get_all_chat_settings, message.chat.id, AVAILBLE_SETTINGS)
+
+        # Send typing status
+        with metrics.stage("send"):
+            await sender.action(message.chat.id, 'typing')
+
+        try:
+            log.debug("[%s in %s] > %s (%s)", message.from_user.id, message.chat.id, message.text, settings['temperature'])
+            if STREAM_RESPONSES:
+                # Stream stage covers generation and edits of the placeholder
+                with metrics.stage("stream"):
+                    resp = await stream_reply(message, chat_history, settings["temperature"], settings["cache"] == "on")
+            else:
+                with metrics.stage("openai"):
+                    resp = await chatbot.aask(chat_history, temperature=settings["temperature"], cache=settings["cache"] == "on")
+                with metrics.stage("send"):
+                    await sender.reply(message, resp)
+            log.debug("[BOT] < %s", resp)
+            with metrics.stage("save_response"):
+                await offload(save_response, message.chat.id, resp)
+        except Exception as ex:
+            log.exception("On reply > %s", ex)
+            # Not answered, redelivered update tries again
+            await offload(forget_delivery, message.chat.id, message.message_id)
+            await sender.reply(message, 'Oops, something went wrong. '+str(ex))
+
+async def main():
+    """Open storage, check token and start polling"""
+    global BOT_NAME
+    get_storage()
+    try:
+        BOT_NAME = (await bot.get_me()).username
+        log.info("Token is ok, bot username: @%s", BOT_NAME)
+    except AttributeError as error:
+        log.critical("Looks like telegram token is invalid, error: %s", error)
+        exit(1)
+    log.info("Async mode, max %s chats at once", MAX_CONCURRENCY)
+    metrics.start_server()
+    await bot.infinity_polling()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+"""Reply latency with many simultaneous chats, polling vs async mode
+
+Run: python bench/async_latency.py --mode async --chats 100 --openai-latency 0.5
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import FakeTelegram, FakeOpenAI, FakeServer, use_fakes, start_bot, percentile
+
+
+def main():
+    """Send one message from every chat at once and wait for all replies"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mode", choices=["polling", "async"], default="async")
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=1, help="messages per chat")
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--openai-jitter", type=float, default=0.1)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--stream", action="store_true", help="measure first visible text of streamed replies")
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+    if args.stream:
+        os.environ["STREAM_RESPONSES"] = "1"
+
+    telegram = FakeTelegram()
+    openai_fake = FakeOpenAI(latency=args.openai_latency, jitter=args.openai_jitter, error_rate=args.openai_error_rate)
+    base_url = FakeServer(telegram, openai_fake).start()
+    use_fakes(base_url, tempfile.mkdtemp(prefix="bench-"))
+    start_bot(args.mode)
+
+    pushed = {}
+    started = time.perf_counter()
+    for number in range(args.messages):
+        for chat in range(args.chats):
+            update, pushed_at = telegram.push_message(1000 + chat, f"Question {number} from chat {chat}")
+            pushed[update["message"]["message_id"]] = pushed_at
+
+    latencies = {}
+    placeholders = {}
+    deadline = time.perf_counter() + args.timeout
+    while len(latencies) < len(pushed) and time.perf_counter() < deadline:
+        for sent in list(telegram.sent):
+            if not args.stream:
+                if sent["reply_to"] in pushed and sent["reply_to"] not in latencies:
+                    latencies[sent["reply_to"]] = sent["time"] - pushed[sent["reply_to"]]
+            elif sent["method"] == "sendMessage" and sent["reply_to"] in pushed:
+                placeholders[sent["message_id"]] = sent["reply_to"]
+            elif sent["method"] == "editMessageText" and sent["message_id"] in placeholders:
+                # First edit replaces placeholder with first visible text
+                question = placeholders[sent["message_id"]]
+                if question not in latencies:
+                    latencies[question] = sent["time"] - pushed[question]
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    values = list(latencies.values())
+    if args.stream:
+        print("latency is time to first visible text")
+    print(f"mode={args.mode} chats={args.chats} messages={len(pushed)} openai_latency={args.openai_latency}s")
+    print(f"replied: {len(values)}/{len(pushed)} in {elapsed:.2f}s ({len(values) / elapsed:.1f} replies/s)")
+    if openai_fake.errors:
+        print(f"openai 429 responses: {openai_fake.errors}")
+    print(f"latency p50={percentile(values, 50):.3f}s p99={percentile(values, 99):.3f}s max={max(values, default=0):.3f}s")
+    os._exit(0 if len(values) == len(pushed) else 1)
+
+
+if __name__ == "__main__":
+    main()
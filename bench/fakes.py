@@ -0,0 +1,402 @@
+"""Local fake Telegram Bot API, OpenAI API and DuckDuckGo servers for benchmarks
+
+All run on aiohttp in a background thread, so they can serve sync and async bots.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import threading
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from aiohttp import web
+from requests.adapters import HTTPAdapter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def use_fakes(base_url, workdir):
+    """Point Telegram and OpenAI clients to fake server and chat storage to workdir/logs.
+    Must be called before bot modules are imported"""
+    os.environ.setdefault("BOT_TOKEN", "123:bench")
+    os.environ.setdefault("OPENAI_TOKEN", "sk-bench")
+    os.environ["OPENAI_API_BASE"] = base_url + "/v1"
+    # Environment also reaches worker processes of webhook mode
+    os.environ["TELEGRAM_API_URL"] = base_url
+    os.makedirs(os.path.join(workdir, "logs"), exist_ok=True)
+    os.chdir(workdir)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    from telebot import apihelper, asyncio_helper
+    apihelper.API_URL = base_url + "/bot{0}/{1}"
+    asyncio_helper.API_URL = base_url + "/bot{0}/{1}"
+
+
+class RedirectAdapter(HTTPAdapter):
+    """Transport adapter that sends requests to base_url, path and query are kept"""
+
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        """Rewrite host of request and send it"""
+        parts = urlsplit(request.url)
+        request.url = self.base_url + parts.path + (f"?{parts.query}" if parts.query else "")
+        return super().send(request, **kwargs)
+
+
+def use_fake_search(base_url):
+    """Point duckduckgo_search to fake server"""
+    from duckduckgo_search import utils
+    # Tokens are cached on disk by query, fake ones must not reach real searches
+    utils.VQD_CACHE = {}
+    for host in ("https://duckduckgo.com", "https://links.duckduckgo.com"):
+        utils.SESSION.mount(host, RedirectAdapter(base_url))
+
+
+def start_bot(mode):
+    """Import bot module for mode and start polling in background thread"""
+    if mode == "async":
+        import async_app
+        thread = threading.Thread(target=lambda: asyncio.run(async_app.main()), daemon=True)
+    else:
+        import app
+        app.get_storage()
+        app.check_token()
+        thread = threading.Thread(target=lambda: app.bot.infinity_polling(timeout=1), daemon=True)
+    thread.start()
+
+
+async def read_params(request):
+    """Merge query, form and json params of Bot API request"""
+    params = dict(request.query)
+    if request.content_type == "application/json":
+        params.update(await request.json())
+    elif request.can_read_body and request.method not in ("POST", "PUT", "PATCH"):
+        # aiohttp parses forms of POST only, async client sends params of GET calls (getUpdates) as body
+        params.update(parse_qsl(await request.text(), keep_blank_values=True))
+    elif request.can_read_body:
+        form = await request.post()
+        for key, value in form.items():
+            params[key] = value if isinstance(value, str) else "<file>"
+    return params
+
+
+class FakeTelegram:
+    """Minimal Bot API: getMe, getUpdates long polling and send* methods.
+    Records every sent message with receive time, methods other than getUpdates take `latency` seconds"""
+
+    def __init__(self, username="bench_bot", latency=0.0):
+        self.username = username
+        self.latency = latency
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.sent = []
+        self.calls = {}
+        self.loop = None
+        self.new_updates = None
+        self.lock = threading.Lock()
+
+    def make_message(self, chat_id, text, chat_type="private", user_id=None, title=None):
+        """Build incoming message object"""
+        user_id = user_id or chat_id
+        with self.lock:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        chat = {"id": chat_id, "type": chat_type}
+        if title is not None:
+            chat["title"] = title
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return message
+
+    def make_update(self, chat_id, text, **kwargs):
+        """Build update with incoming message, thread-safe"""
+        with self.lock:
+            update_id = self.next_update_id
+            self.next_update_id += 1
+        return {"update_id": update_id, "message": self.make_message(chat_id, text, **kwargs)}
+
+    def push_message(self, chat_id, text, **kwargs):
+        """Queue incoming message for bot, thread-safe. Returns (update, push time)"""
+        update = self.make_update(chat_id, text, **kwargs)
+        pushed_at = time.perf_counter()
+        self.loop.call_soon_threadsafe(self.add_update, update)
+        return update, pushed_at
+
+    def push_update(self, update):
+        """Queue recorded update for bot with new update id and current date, thread-safe.
+        Returns (update, push time)"""
+        with self.lock:
+            update = {**update, "update_id": self.next_update_id}
+            self.next_update_id += 1
+        update["message"] = {**update["message"], "date": int(time.time())}
+        pushed_at = time.perf_counter()
+        self.loop.call_soon_threadsafe(self.add_update, update)
+        return update, pushed_at
+
+    def add_update(self, update):
+        """Add update and wake up waiting getUpdates"""
+        self.updates.append(update)
+        self.new_updates.set()
+
+    def replies_to(self, message_id):
+        """Sent messages that reply to message_id"""
+        return [sent for sent in self.sent if sent["reply_to"] == message_id]
+
+    def reply_target(self, params):
+        """Get id of message this send replies to"""
+        if "reply_to_message_id" in params:
+            return int(params["reply_to_message_id"])
+        if "reply_parameters" in params:
+            reply = params["reply_parameters"]
+            if isinstance(reply, str):
+                reply = json.loads(reply)
+            return int(reply["message_id"])
+        return None
+
+    async def handle(self, request):
+        """Dispatch Bot API method"""
+        method = request.match_info["method"]
+        params = await read_params(request)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getMe":
+            return self.ok({"id": 1, "is_bot": True, "first_name": "Bench", "username": self.username})
+        if method == "getUpdates":
+            return self.ok(await self.get_updates(params))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            message = self.make_message(int(params.get("chat_id", 0)), params.get("text", ""))
+            message["from"] = {"id": 1, "is_bot": True, "first_name": "Bench", "username": self.username}
+            if method == "editMessageText" and "message_id" in params:
+                message["message_id"] = int(params["message_id"])
+            self.sent.append({
+                "method": method,
+                "chat_id": message["chat"]["id"],
+                "message_id": message["message_id"],
+                "reply_to": self.reply_target(params),
+                "text": message["text"],
+                "time": time.perf_counter(),
+            })
+            return self.ok(message)
+        return self.ok(True)
+
+    async def get_updates(self, params):
+        """Long polling: wait for updates newer than offset"""
+        offset = int(params.get("offset", 0) or 0)
+        timeout = min(float(params.get("timeout", 0) or 0), 1.0)
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates and timeout > 0:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit", 100) or 100)
+        return self.updates[:limit]
+
+    def ok(self, result):
+        """Bot API success response"""
+        return web.json_response({"ok": True, "result": result})
+
+    def setup(self, app):
+        """Register routes"""
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+
+
+class FakeOpenAI:
+    """Chat and text completion endpoints with configurable latency"""
+
+    def __init__(self, latency=0.5, jitter=0.0, answer="This is a fake answer from benchmark model.", error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.answer = answer
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+
+    def rate_limited(self):
+        """Randomly answer 429 like an overloaded API"""
+        if random.random() >= self.error_rate:
+            return None
+        self.errors += 1
+        return web.json_response(
+            {"error": {"message": "Rate limit reached", "type": "requests"}},
+            status=429, headers={"Retry-After": "0.2"})
+
+    def usage(self, prompt):
+        """Token usage of response, one token per word is close enough"""
+        prompt_tokens = len(prompt.split())
+        completion_tokens = len(self.answer.split())
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+    async def delay(self):
+        """Simulate generation time"""
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+    async def chat_completions(self, request):
+        """POST /v1/chat/completions"""
+        body = await request.json()
+        self.requests += 1
+        error = self.rate_limited()
+        if error is not None:
+            return error
+        if body.get("stream"):
+            return await self.stream_chat(request)
+        await self.delay()
+        return web.json_response({
+            "id": f"chatcmpl-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": self.answer}, "finish_reason": "stop"}],
+            "usage": self.usage(" ".join(message["content"] for message in body["messages"])),
+        })
+
+    async def stream_chat(self, request):
+        """Server-sent events, answer split by words spread over latency"""
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        words = self.answer.split(" ")
+        for number, word in enumerate(words):
+            await asyncio.sleep((self.latency + random.uniform(0, self.jitter)) / len(words))
+            chunk = {
+                "id": f"chatcmpl-{self.requests}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "choices": [{"index": 0, "delta": {"content": word if number == 0 else " " + word}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def completions(self, request):
+        """POST /v1/completions and /v1/engines/{engine}/completions"""
+        body = await request.json()
+        self.requests += 1
+        error = self.rate_limited()
+        if error is not None:
+            return error
+        await self.delay()
+        return web.json_response({
+            "id": f"cmpl-{self.requests}",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "choices": [{"index": 0, "text": self.answer, "finish_reason": "stop"}],
+            "usage": self.usage(body["prompt"]),
+        })
+
+    def setup(self, app):
+        """Register routes"""
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/completions", self.completions)
+        app.router.add_post("/v1/engines/{engine}/completions", self.completions)
+
+
+class FakeDuckDuckGo:
+    """Endpoints duckduckgo_search calls (vqd token, d.js results) and pages of results
+    for deep search, with configurable latency"""
+
+    def __init__(self, latency=0.3, jitter=0.0, results=10, page_words=600):
+        self.latency = latency
+        self.jitter = jitter
+        self.results = results
+        self.page_words = page_words
+        self.requests = 0
+
+    async def delay(self):
+        """Simulate search time"""
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+    async def vqd(self, request):
+        """POST / with query, page has token of search"""
+        self.requests += 1
+        await self.delay()
+        return web.Response(text='<html><script>vqd="4-123456789"</script></html>', content_type="text/html")
+
+    async def links(self, request):
+        """GET /d.js?q=..., results of query, each points to a page of this server"""
+        self.requests += 1
+        await self.delay()
+        query = request.query.get("q", "")
+        base = f"{request.scheme}://{request.host}"
+        results = [{
+            "t": f"Result {number} for <b>{query}</b>",
+            "a": f"Snippet {number} about <b>{query}</b>: " + " ".join(f"word{n}" for n in range(40)),
+            "u": f"{base}/page/{number}?{urlencode({'q': query})}",
+        } for number in range(self.results)]
+        # Last row of real response links next page
+        results.append({"n": "/d.js?q=next"})
+        return web.json_response({"results": results})
+
+    async def page(self, request):
+        """GET /page/{number}, article for deep search"""
+        await self.delay()
+        number = request.match_info["number"]
+        paragraphs = "".join(f"<p>{' '.join(f'text{n}' for n in range(index, index + 60))}.</p>"
+                             for index in range(0, self.page_words, 60))
+        return web.Response(text=f"<html><head><title>Page {number}</title></head><body><article>"
+                                 f"<h1>Page {number}</h1>{paragraphs}</article></body></html>", content_type="text/html")
+
+    def setup(self, app):
+        """Register routes"""
+        app.router.add_post("/", self.vqd)
+        app.router.add_get("/d.js", self.links)
+        app.router.add_get("/page/{number}", self.page)
+
+
+class FakeServer:
+    """Runs fake services on one local port in background thread"""
+
+    def __init__(self, *services):
+        self.services = services
+        self.loop = asyncio.new_event_loop()
+        self.port = None
+        self.thread = None
+
+    def start(self):
+        """Start server, returns base url"""
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            app = web.Application(client_max_size=64 * 1024 * 1024)
+            for service in self.services:
+                service.loop = self.loop
+                if hasattr(service, "new_updates"):
+                    service.new_updates = asyncio.Event()
+                service.setup(app)
+            runner = web.AppRunner(app, access_log=None)
+            self.loop.run_until_complete(runner.setup())
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            self.loop.run_until_complete(site.start())
+            self.port = site._server.sockets[0].getsockname()[1]
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        return f"http://127.0.0.1:{self.port}"
@@ -0,0 +1,89 @@
+"""Recall index of long chats: build, lookup, file size and load time
+
+History is synthetic: messages of 5-40 words drawn from a Zipf-like vocabulary,
+so a few words are in most messages and most words are rare, like in real chats.
+Lookups use words of random history messages as questions.
+
+Run: python bench/recall_index.py --messages 100000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from itertools import accumulate
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import ROOT, percentile
+
+
+def make_history(count, vocabulary, seed):
+    """Synthetic chat history entries"""
+    generator = random.Random(seed)
+    words = [f"w{number}" for number in range(vocabulary)]
+    cumulative = list(accumulate(1 / (rank + 1) for rank in range(vocabulary)))
+    history = []
+    for number in range(count):
+        text = " ".join(generator.choices(words, cum_weights=cumulative, k=generator.randint(5, 40)))
+        if number % 2:
+            history.append({"role": "assistant", "content": text})
+        else:
+            history.append({"role": "user", "content": f"#{generator.randint(1, 50)}: {text}"})
+    return history
+
+
+def main():
+    """Build index of synthetic chat and time its operations"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    sys.path.insert(0, ROOT)
+    import recall
+
+    history = make_history(args.messages, args.vocabulary, args.seed)
+    path = os.path.join(tempfile.mkdtemp(prefix="bench-"), "recall_1.idx")
+    index = recall.HistoryIndex(path)
+    started = time.perf_counter()
+    index.catch_up(history)
+    build = time.perf_counter() - started
+    print(f"messages={args.messages} words={len(index.postings)} postings={index.entries}")
+    print(f"build: {build:.2f}s ({build / args.messages * 1e6:.1f}us per message)")
+
+    extra = make_history(1000, args.vocabulary, args.seed + 1)
+    started = time.perf_counter()
+    for entry in extra:
+        index.add(entry)
+    print(f"add: {(time.perf_counter() - started) / len(extra) * 1e6:.1f}us per message")
+    history += extra
+
+    started = time.perf_counter()
+    index.save()
+    save = time.perf_counter() - started
+    size = os.path.getsize(path)
+    with open(path, "rb") as index_file:
+        data = index_file.read()
+    started = time.perf_counter()
+    loaded = recall.HistoryIndex.decode(path, data)
+    load = time.perf_counter() - started
+    assert loaded.postings == index.postings and loaded.lengths == index.lengths and loaded.matches(history)
+    raw = sum(len(entry["content"].encode("utf-8")) for entry in history)
+    print(f"file: {size / 1024:.0f}KB ({size / raw * 100:.0f}% of message text), save {save * 1000:.0f}ms, load {load * 1000:.0f}ms")
+
+    generator = random.Random(args.seed + 2)
+    timings = []
+    for _ in range(args.queries):
+        question = history[generator.randrange(len(history))]["content"]
+        end = len(history) - generator.randint(5, 50)
+        started = time.perf_counter()
+        index.search(question, end, recall.RECALL_TOP_K)
+        timings.append(time.perf_counter() - started)
+    print(f"search: p50={percentile(timings, 50) * 1000:.3f}ms p99={percentile(timings, 99) * 1000:.3f}ms "
+          f"max={max(timings) * 1000:.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
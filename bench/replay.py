@@ -0,0 +1,318 @@
+"""End-to-end replay of chat traffic through the bot handlers against fake Telegram, OpenAI and DuckDuckGo
+
+Updates are synthetic (private chats and groups: questions, /s, /rollback,
+/settings and group messages not addressed to the bot) or read from a jsonl file
+of recorded Telegram updates. Every chat sends its next update when the bot has
+replied to the previous one, so --chats is the number of chats talking at once.
+
+Reported: updates per second, reply latency by kind of update, percentiles of
+handler stages from request traces (TRACE_LOG), peak RSS of the process (fake
+servers included) and bytes written to logs/. Results are compared with the
+scenario in bench/replay_baseline.json. Times depend on the machine, so the
+baseline is not kept in the repository: save it with --save-baseline on the
+machine that runs the bench, before the change. Slowdown or growth over
+--tolerance is reported, and fails the run only with --strict. Updates left
+without reply always fail it.
+
+Run: python bench/replay.py --mode polling --chats 20 --updates-per-chat 40
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+from itertools import accumulate
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import FakeTelegram, FakeOpenAI, FakeDuckDuckGo, FakeServer, use_fakes, use_fake_search, start_bot, percentile
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "replay_baseline.json")
+# Share of updates of every kind, chatter is sent in groups only
+KINDS = {"question": 70, "search": 8, "rollback": 5, "settings": 7, "chatter": 10}
+# Last one is invalid, the bot answers with an error
+SETTINGS = ["", "summary:on", "recall:on", "cache:on", "deep:on", "temperature:0.2", "num:5", "time:w", "temperature:2"]
+USERS_PER_GROUP = 5
+# Added to latency limits, few milliseconds of a short stage are noise
+SLACK_SECONDS = 0.005
+# Percentiles of fewer samples are too noisy to compare, p99 of fewer than 100 is just the slowest one
+MIN_SAMPLES = 30
+P99_SAMPLES = 100
+
+
+def make_updates(telegram, args):
+    """Synthetic updates, list per chat in order of sending"""
+    generator = random.Random(args.seed)
+    vocabulary = [f"word{number}" for number in range(2000)]
+    cumulative = list(accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    kinds = list(KINDS)
+    chats = []
+    for number in range(args.chats):
+        group = generator.random() < args.group_share
+        chat_id = -(1000 + number) if group else 1000 + number
+        users = [abs(chat_id) * 10 + user for user in range(USERS_PER_GROUP)] if group else [chat_id]
+        questions = []
+        updates = []
+        for _ in range(args.updates_per_chat):
+            kind = generator.choices(kinds, weights=[KINDS[kind] if group or kind != "chatter" else 0 for kind in kinds])[0]
+            text = " ".join(generator.choices(vocabulary, cum_weights=cumulative, k=generator.randint(5, 30)))
+            if kind == "question":
+                # Some questions are asked again, answer cache can reuse them
+                if questions and generator.random() < 0.1:
+                    text = generator.choice(questions)
+                questions.append(text)
+                if group:
+                    text = f"@{telegram.username} {text}"
+            elif kind == "search":
+                text = "/s " + " ".join(text.split()[:generator.randint(2, 5)])
+            elif kind == "rollback":
+                text = "/rollback" if generator.random() < 0.7 else f"/rollback {generator.randint(2, 4)}"
+            elif kind == "settings":
+                text = f"/settings {generator.choice(SETTINGS)}".strip()
+            updates.append(telegram.make_update(
+                chat_id, text, chat_type="group" if group else "private",
+                user_id=generator.choice(users) if group else None, title=f"Group {number}" if group else None))
+        chats.append(updates)
+    return chats
+
+
+def read_updates(path):
+    """Recorded updates from jsonl file, list per chat in order of recording"""
+    chats = {}
+    with open(path, "r", encoding="utf-8") as updates_file:
+        for line in updates_file:
+            if line.strip():
+                update = json.loads(line)
+                if "message" in update and update["message"].get("text"):
+                    chats.setdefault(update["message"]["chat"]["id"], []).append(update)
+    return list(chats.values())
+
+
+def write_updates(path, chats):
+    """Save updates to jsonl file, chats interleaved like live traffic"""
+    with open(path, "w", encoding="utf-8") as updates_file:
+        for number in range(max(map(len, chats), default=0)):
+            for updates in chats:
+                if number < len(updates):
+                    updates_file.write(json.dumps(updates[number], ensure_ascii=False) + "\n")
+
+
+def kind_of(message, bot_name):
+    """Kind of update for the report, None if the bot does not answer it"""
+    text = message["text"]
+    if text.startswith("/s "):
+        return "search"
+    if text.startswith("/rollback"):
+        return "rollback"
+    if text.startswith("/settings"):
+        return "settings"
+    if text.startswith("/"):
+        return "command"
+    if message["chat"]["type"] == "private" or text.startswith(f"@{bot_name}"):
+        return "question"
+    return None
+
+
+def replay(telegram, chats, reply_timeout):
+    """Send updates chat by chat as replies come. Returns (latencies by kind, updates sent, unanswered kinds, seconds)"""
+    queues = {updates[0]["message"]["chat"]["id"]: deque(updates) for updates in chats if updates}
+    # (chat id, message id) -> (kind, push time)
+    pending = {}
+    latencies = {}
+    unanswered = []
+    sent_updates = 0
+
+    def push_next(chat_id):
+        """Send updates of chat up to the next one that gets a reply"""
+        nonlocal sent_updates
+        queue = queues[chat_id]
+        while queue:
+            update, pushed_at = telegram.push_update(queue.popleft())
+            sent_updates += 1
+            message = update["message"]
+            kind = kind_of(message, telegram.username)
+            if kind is not None:
+                latencies.setdefault(kind, [])
+                pending[(chat_id, message["message_id"])] = (kind, pushed_at)
+                return
+
+    started = time.perf_counter()
+    for chat_id in queues:
+        push_next(chat_id)
+    seen = 0
+    while pending:
+        sent = telegram.sent[seen:]
+        seen += len(sent)
+        for message in sent:
+            key = (message["chat_id"], message["reply_to"])
+            if key in pending:
+                kind, pushed_at = pending.pop(key)
+                latencies[kind].append(message["time"] - pushed_at)
+                push_next(key[0])
+        now = time.perf_counter()
+        for key, (kind, pushed_at) in list(pending.items()):
+            if now - pushed_at > reply_timeout:
+                del pending[key]
+                unanswered.append(kind)
+                push_next(key[0])
+        time.sleep(0.002)
+    return latencies, sent_updates, unanswered, time.perf_counter() - started
+
+
+def read_traces(path):
+    """Seconds of handlers and their stages from trace log, by name"""
+    timings = {}
+    if not os.path.exists(path):
+        return timings
+    with open(path, "r", encoding="utf-8") as trace_log:
+        for line in trace_log:
+            record = json.loads(line)
+            timings.setdefault(record["handler"], []).append(record["seconds"])
+            for stage, seconds in record["stages"].items():
+                timings.setdefault(f"{record['handler']}.{stage}", []).append(seconds)
+    return timings
+
+
+def directory_size(path):
+    """Bytes of files under path"""
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def summarize(values):
+    """Percentiles of latencies in seconds"""
+    return {"count": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99)}
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of results against baseline, as lines of text"""
+    regressions = []
+    if results["updates_per_second"] < baseline["updates_per_second"] * (1 - tolerance):
+        regressions.append(f"updates/s {results['updates_per_second']:.1f} < baseline {baseline['updates_per_second']:.1f}")
+    for key in ("peak_rss_mb", "storage_bytes"):
+        if results[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key} {results[key]:.0f} > baseline {baseline[key]:.0f}")
+    for section in ("latency", "stages"):
+        for name, current in results[section].items():
+            previous = baseline[section].get(name)
+            if previous is None or current["count"] < MIN_SAMPLES:
+                continue
+            for key in ("p50", "p99") if current["count"] >= P99_SAMPLES else ("p50",):
+                limit = previous[key] * (1 + tolerance) + SLACK_SECONDS
+                if current[key] > limit:
+                    regressions.append(f"{section} {name} {key} {current[key] * 1000:.1f}ms > limit {limit * 1000:.1f}ms")
+    return regressions
+
+
+def main():
+    """Replay updates, report and compare with baseline"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["polling", "async"], default="polling")
+    parser.add_argument("--backend", choices=["json", "journal"], default="json")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--updates-per-chat", type=int, default=40)
+    parser.add_argument("--group-share", type=float, default=0.3, help="share of chats that are groups")
+    parser.add_argument("--updates", help="replay recorded updates from jsonl file instead of synthetic ones")
+    parser.add_argument("--save-updates", help="write the updates to jsonl file for later replays")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--openai-latency", type=float, default=0.1)
+    parser.add_argument("--openai-jitter", type=float, default=0.0)
+    parser.add_argument("--search-latency", type=float, default=0.05)
+    parser.add_argument("--answer-words", type=int, default=60, help="length of fake answers, history grows by them")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep Telegram rate limits of sender")
+    parser.add_argument("--reply-timeout", type=float, default=60)
+    parser.add_argument("--scenario", help="name of results in baseline file (default from mode, backend and size)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown or growth over baseline, share")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--strict", action="store_true", help="exit with 1 on regression, baseline must be from this machine")
+    args = parser.parse_args()
+
+    answer = " ".join(f"answer{number}" for number in range(args.answer_words))
+    telegram = FakeTelegram(latency=args.telegram_latency)
+    openai_fake = FakeOpenAI(latency=args.openai_latency, jitter=args.openai_jitter, answer=answer)
+    search_fake = FakeDuckDuckGo(latency=args.search_latency)
+    base_url = FakeServer(telegram, openai_fake, search_fake).start()
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    use_fakes(base_url, workdir)
+    use_fake_search(base_url)
+    os.environ["STORAGE_BACKEND"] = args.backend
+    # Pages of deep search are served by the fake server on localhost
+    os.environ["SERP_ALLOW_LOCAL"] = "True"
+    os.environ["TRACE_LOG"] = os.path.join(workdir, "trace.jsonl")
+    if not args.telegram_limits:
+        # Limits would set the pace instead of the bot
+        for name in ("TELEGRAM_SENDS_PER_MINUTE", "TELEGRAM_CHAT_SENDS_PER_MINUTE", "TELEGRAM_GROUP_SENDS_PER_MINUTE"):
+            os.environ[name] = "0"
+
+    if args.updates:
+        chats = read_updates(args.updates)
+        scenario = args.scenario or f"{args.mode}-{args.backend}-{os.path.basename(args.updates)}"
+    else:
+        chats = make_updates(telegram, args)
+        scenario = args.scenario or f"{args.mode}-{args.backend}-{args.chats}x{args.updates_per_chat}"
+    if args.save_updates:
+        write_updates(args.save_updates, chats)
+        print(f"saved {sum(map(len, chats))} updates to {args.save_updates}")
+
+    start_bot(args.mode)
+    import conv
+    from utils import metrics, serp
+    # Bot is polling once getUpdates comes
+    while not telegram.calls.get("getUpdates"):
+        time.sleep(0.01)
+    latencies, handled, unanswered, elapsed = replay(telegram, chats, args.reply_timeout)
+    conv.get_storage().flush()
+    # Page extraction processes of deep search would outlive os._exit
+    if serp.extract_executor is not None:
+        serp.extract_executor.shutdown()
+
+    results = {
+        "updates_per_second": handled / elapsed,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "storage_bytes": sum(metrics.STORAGE_BYTES.values.values()),
+        "latency": {kind: summarize(values) for kind, values in latencies.items()},
+        "stages": {name: summarize(values) for name, values in read_traces(os.environ["TRACE_LOG"]).items()},
+    }
+    print(f"scenario={scenario} chats={len(chats)} updates={handled} in {elapsed:.2f}s: "
+          f"{results['updates_per_second']:.1f} updates/s")
+    print(f"openai requests={openai_fake.requests} search requests={search_fake.requests} "
+          f"telegram calls={sum(telegram.calls.values())}")
+    print(f"peak RSS {results['peak_rss_mb']:.0f}MB, written to logs/ {results['storage_bytes'] / 1024:.0f}KB, "
+          f"logs/ on disk {directory_size(os.path.join(workdir, 'logs')) / 1024:.0f}KB")
+    print(f"{'':>26} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for section, title in (("latency", "reply latency"), ("stages", "handlers and stages")):
+        print(title)
+        for name, summary in sorted(results[section].items()):
+            print(f"{name:>26} {summary['count']:>6} {summary['p50'] * 1000:>7.1f}ms "
+                  f"{summary['p95'] * 1000:>7.1f}ms {summary['p99'] * 1000:>7.1f}ms")
+    if unanswered:
+        print(f"no reply in {args.reply_timeout}s: {len(unanswered)} ({', '.join(sorted(set(unanswered)))})")
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE, "r", encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+    failed = bool(unanswered)
+    if args.save_baseline:
+        baseline[scenario] = results
+        with open(BASELINE, "w", encoding="utf-8") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print(f"saved {scenario} to {BASELINE}")
+    elif scenario in baseline:
+        regressions = compare(results, baseline[scenario], args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        print(f"baseline {scenario}: {'REGRESSION' if regressions else 'ok'}")
+        failed = failed or (args.strict and bool(regressions))
+    else:
+        print(f"no baseline for {scenario}, save one with --save-baseline")
+    # Bot threads do not stop by themselves
+    os._exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Cost of saving one message at different history lengths
+
+Compares duplicate removal that used to run on every snapshot (scan of whole
+history) with check of newest entries on insert, and shows full save cost of
+both storage backends.
+
+Run: python bench/save.py --sizes 100 1000 10000
+"""
+import os
+import sys
+import time
+import types
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import ROOT
+
+
+def old_dedup(history):
+    """Duplicate removal conv.snapshot did before every write"""
+    keys = [(entry['role'], entry['content']) for entry in history]
+    keep = [key not in keys[n + 1:] for n, key in enumerate(keys)]
+    return [entry for entry, kept in zip(history, keep) if kept]
+
+
+def timed(function, repeat):
+    """Average seconds of function call"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - started) / repeat
+
+
+def main():
+    """Fill chats of every size and time one more save"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--backend", choices=["json", "journal"], default="json")
+    args = parser.parse_args()
+    os.environ["LOG_DIR"] = tempfile.mkdtemp(prefix="bench-")
+    os.environ["STORAGE_BACKEND"] = args.backend
+    os.environ["JOURNAL_COMPACT_EVERY"] = "1000000"
+    sys.path.insert(0, ROOT)
+    import conv
+
+    author = types.SimpleNamespace(id=1, first_name="Bench", last_name=None, username="bench")
+    print(f"backend={args.backend}")
+    print(f"{'messages':>9} {'old dedup':>11} {'insert check':>13} {'save_question':>14}")
+    for size in args.sizes:
+        chat_id = size
+        conv.init(chat_id, "bench", "group", author)
+        chat = conv.get_chat(str(chat_id))
+        for number in range(size):
+            chat['history'].append(conv.make_entry('user', f"#1: message {number} of the bench chat", number))
+        conv.recount_tokens(chat)
+        conv.save(chat_id)
+        history = chat['history']
+        repeat = max(1, 20000 // size)
+        entry = conv.make_entry('user', "#1: new message", size)
+        old = timed(lambda: old_dedup(history), max(1, repeat // 10))
+        check = timed(lambda: conv.is_duplicate(history, entry), repeat)
+        number = iter(range(size + 1, size + 1 + repeat))
+        save = timed(lambda: conv.save_question(chat_id, "thanks", author, next(number)), repeat)
+        print(f"{size:>9} {old * 1000:>9.2f}ms {check * 1000:>11.4f}ms {save * 1000:>12.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
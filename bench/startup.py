@@ -0,0 +1,97 @@
+"""Cold start time of bot modules
+
+Every run imports the bot module in a fresh interpreter against fake Telegram,
+so the time covers module imports, client setup, opening storage and getMe
+(sync mode, async mode checks the token in main). Median of runs is
+compared with bench/startup_baseline.json. Times depend on the machine, so the
+baseline is not kept in the repository: save it with --save-baseline on the
+machine that runs the bench, before the change. Slowdown over --tolerance is
+reported, and fails the run only with --strict.
+
+Run: python bench/startup.py --save-baseline, then python bench/startup.py after the change
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import ROOT, FakeTelegram, FakeOpenAI, FakeServer, use_fakes, percentile
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_baseline.json")
+# Modules that must not be loaded until they are needed
+DEFERRED = ["aiohttp", "readability", "duckduckgo_search", "tiktoken"]
+CHILD = """
+import sys, time, json
+started = time.perf_counter()
+import {module}
+{module}.get_storage()
+if hasattr({module}, "check_token"):
+    {module}.check_token()
+print(json.dumps({{"seconds": time.perf_counter() - started,
+                  "loaded": [name for name in {deferred!r} if name in sys.modules]}}))
+"""
+
+
+def cold_start(module):
+    """Import module in new interpreter. Returns (import seconds, process seconds, deferred modules it loaded)"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    code = CHILD.format(module=module, deferred=DEFERRED)
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True).stdout
+    total = time.perf_counter() - started
+    result = json.loads(output.strip().splitlines()[-1])
+    return result["seconds"], total, result["loaded"]
+
+
+def main():
+    """Measure cold start of every module and compare with baseline"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modules", nargs="+", default=["app", "async_app"])
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown over baseline, share")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--strict", action="store_true", help="exit with 1 on regression, baseline must be from this machine")
+    args = parser.parse_args()
+
+    telegram = FakeTelegram()
+    base_url = FakeServer(telegram, FakeOpenAI()).start()
+    use_fakes(base_url, tempfile.mkdtemp(prefix="bench-"))
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE, "r", encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    failed = False
+    for module in args.modules:
+        get_me = telegram.calls.get("getMe", 0)
+        runs = [cold_start(module) for _ in range(args.runs)]
+        imports = [seconds for seconds, _, _ in runs]
+        totals = [seconds for _, seconds, _ in runs]
+        loaded = sorted(set(name for _, _, names in runs for name in names))
+        results[module] = percentile(totals, 50)
+        print(f"{module}: process p50={percentile(totals, 50) * 1000:.0f}ms import p50={percentile(imports, 50) * 1000:.0f}ms "
+              f"getMe per start={(telegram.calls.get('getMe', 0) - get_me) / args.runs:.0f} "
+              f"deferred modules loaded={loaded or 'none'}")
+        if module in baseline:
+            limit = baseline[module] * (1 + args.tolerance)
+            verdict = "ok" if results[module] <= limit else "REGRESSION"
+            print(f"  baseline {baseline[module] * 1000:.0f}ms, limit {limit * 1000:.0f}ms: {verdict}")
+            failed = failed or verdict != "ok"
+    if args.save_baseline:
+        baseline.update({module: round(seconds, 4) for module, seconds in results.items()})
+        with open(BASELINE, "w", encoding="utf-8") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2)
+            baseline_file.write("\n")
+        print(f"saved {BASELINE}")
+        return
+    sys.exit(1 if failed and args.strict else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Transliteration of names and questions: transliterate.translit per call vs utils/translit.py
+
+Checks that both give the same text on random strings, then times single calls
+and building the system prompt of a group with many members, where every
+member name used to be transliterated on every rebuild.
+
+Run: python bench/translit.py --members 500
+"""
+import os
+import sys
+import time
+import types
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import ROOT
+
+# Russian, letters of other cyrillic languages the pack does not know, latin and punctuation
+ALPHABET = ("абвгдеёжзийклмнопрстуфхцчшщъыьэюяАБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ"
+            "іїєґўІЇЄҐЎ" "abcxyzABCXYZ0123456789 .,!?'-_@#")
+
+
+def timed(function, values, repeat=1):
+    """Average seconds per value"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for value in values:
+            function(value)
+    return (time.perf_counter() - started) / (repeat * len(values))
+
+
+def main():
+    """Compare results and speed of both transliterations"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--members", type=int, default=500)
+    parser.add_argument("--strings", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    os.environ["LOG_DIR"] = tempfile.mkdtemp(prefix="bench-")
+    os.environ["ENABLE_TRANSLIT"] = "true"
+    sys.path.insert(0, ROOT)
+    from transliterate import translit
+    from utils import translit as fast
+    import conv
+
+    def library(text):
+        """Transliteration as conv.trans did it"""
+        return translit(text, 'ru', reversed=True)
+
+    generator = random.Random(args.seed)
+    strings = ["".join(generator.choices(ALPHABET, k=generator.randint(0, 80))) for _ in range(args.strings)]
+    mismatches = [text for text in strings if fast.to_latin(text) != library(text) or fast.convert(text) != library(text)]
+    print(f"checked {len(strings)} strings, mismatches: {len(mismatches)}")
+    if mismatches:
+        print(f"first mismatch: {mismatches[0]!r}")
+        sys.exit(1)
+
+    names = ["".join(generator.choices(ALPHABET[:66], k=generator.randint(4, 14))) for _ in range(args.members)]
+    questions = ["".join(generator.choices(ALPHABET, k=300)) for _ in range(200)]
+    print(f"{'':>10} {'translit':>10} {'table':>10} {'memo':>10}")
+    for label, values in (("name", names), ("question", questions)):
+        fast.memoized.cache_clear()
+        for value in values:
+            fast.to_latin(value)
+        print(f"{label:>10} {timed(library, values) * 1e6:>8.1f}us {timed(fast.convert, values, 10) * 1e6:>8.2f}us "
+              f"{timed(fast.to_latin, values, 10) * 1e6:>8.2f}us")
+
+    def old_user_to_str(user):
+        """Member line as user_to_str rendered it, names transliterated again on every call"""
+        return f'#{user["id"]} is {library(user["first_name"])} {library(user["last_name"])} (@{user["username"]})'
+
+    chat_id = -1
+    author = types.SimpleNamespace(id=0, first_name=names[0], last_name=None, username="user0")
+    conv.init(chat_id, "Группа", "group", author)
+    for number, name in enumerate(names[1:], 1):
+        user = types.SimpleNamespace(id=number, first_name=name, last_name=names[-number], username=f"user{number}")
+        conv.save_question(chat_id, "привет", user)
+    chat = conv.get_chat(str(chat_id))
+    members = list(chat['members'].values())
+    assert [old_user_to_str(member) for member in members] == [member['rendered'] for member in members]
+
+    def old_prompt(_):
+        """Member list of system prompt as it was built before"""
+        return ", ".join(old_user_to_str(member) for member in members)
+
+    def new_prompt(_):
+        """System prompt rebuilt from rendered members"""
+        conv.prompt_cache.pop(str(chat_id))
+        return conv.get_system_prompt(str(chat_id), chat)
+
+    print(f"system prompt of {len(members)} members: old {timed(old_prompt, [0], 5) * 1000:.2f}ms, "
+          f"new {timed(new_prompt, [0], 5) * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
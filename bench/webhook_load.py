@@ -0,0 +1,127 @@
+"""Sustained update rate of sharded modes
+
+Fake Telegram posts updates to webhook server from several connections
+(or serves them to dispatcher.py by getUpdates with --mode polling), bot
+replies go to the same fake. Reports how fast updates are accepted and
+answered, and checks that replies of every chat come in order.
+
+Run: python bench/webhook_load.py --workers 4 --threads 8 --chats 200 --messages 5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import http.client
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import FakeTelegram, FakeOpenAI, FakeServer, use_fakes, percentile
+
+
+def post_updates(port, path, updates, acks):
+    """Post updates over one keep-alive connection, record (status, seconds) of every post"""
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    for update in updates:
+        body = json.dumps(update)
+        started = time.perf_counter()
+        connection.request("POST", path, body, {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        response.read()
+        acks.append((response.status, time.perf_counter() - started))
+    connection.close()
+
+
+def main():
+    """Post updates of all chats at once and wait for all replies"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mode", choices=["webhook", "polling"], default="webhook")
+    parser.add_argument("--workers", type=int, default=4, help="worker processes (shards)")
+    parser.add_argument("--threads", type=int, default=8, help="threads per worker process")
+    parser.add_argument("--connections", type=int, default=8, help="parallel connections posting updates")
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=5, help="messages per chat")
+    parser.add_argument("--openai-latency", type=float, default=0.05)
+    parser.add_argument("--openai-jitter", type=float, default=0.02)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    telegram = FakeTelegram()
+    openai_fake = FakeOpenAI(latency=args.openai_latency, jitter=args.openai_jitter)
+    base_url = FakeServer(telegram, openai_fake).start()
+    use_fakes(base_url, tempfile.mkdtemp(prefix="bench-"))
+    os.environ["POLL_TIMEOUT"] = "1"
+    import webhook
+    import dispatcher
+    from workers import WorkerPool
+
+    print(f"starting {args.workers} workers...")
+    pool = WorkerPool(args.workers, args.threads)
+    pool.start()
+    if args.mode == "webhook":
+        server = webhook.create_server(pool, host="127.0.0.1", port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        threading.Thread(target=dispatcher.poll, args=(pool,), daemon=True).start()
+
+    # Messages of a chat are posted by one connection, in order
+    batches = [[] for _ in range(args.connections)]
+    pushed = {}
+    for number in range(args.messages):
+        for chat in range(args.chats):
+            update = telegram.make_update(1000 + chat, f"Question {number} from chat {chat}")
+            batches[chat % args.connections].append(update)
+    acks = []
+    started = time.perf_counter()
+    for batch in batches:
+        for update in batch:
+            pushed[update["message"]["message_id"]] = started
+    if args.mode == "webhook":
+        posters = [threading.Thread(target=post_updates, args=(server.server_port, webhook.WEBHOOK_PATH, batch, acks))
+                   for batch in batches]
+        for poster in posters:
+            poster.start()
+        for poster in posters:
+            poster.join()
+    else:
+        # getUpdates returns updates by id, like Telegram does
+        for update in sorted((update for batch in batches for update in batch), key=lambda update: update["update_id"]):
+            telegram.loop.call_soon_threadsafe(telegram.add_update, update)
+    accepted = time.perf_counter() - started
+
+    replies = {}
+    deadline = time.perf_counter() + args.timeout
+    while len(replies) < len(pushed) and time.perf_counter() < deadline:
+        for sent in list(telegram.sent):
+            if sent["reply_to"] in pushed and sent["reply_to"] not in replies:
+                replies[sent["reply_to"]] = sent
+        time.sleep(0.05)
+    elapsed = max(sent["time"] for sent in replies.values()) - started if replies else 0.0
+
+    # Question ids grow with message number, so replies of a chat must reply to growing ids
+    out_of_order = 0
+    by_chat = {}
+    for sent in sorted(replies.values(), key=lambda sent: sent["time"]):
+        by_chat.setdefault(sent["chat_id"], []).append(sent["reply_to"])
+    for reply_to in by_chat.values():
+        out_of_order += sum(1 for previous, current in zip(reply_to, reply_to[1:]) if current < previous)
+
+    statuses = {}
+    for status, _ in acks:
+        statuses[status] = statuses.get(status, 0) + 1
+    ack_times = [seconds for _, seconds in acks]
+    print(f"mode={args.mode} workers={args.workers}x{args.threads} chats={args.chats} updates={len(pushed)} "
+          f"openai_latency={args.openai_latency}s")
+    if acks:
+        print(f"accepted: {len(acks)} in {accepted:.2f}s ({len(acks) / accepted:.0f} updates/s) statuses={statuses}")
+        print(f"ack latency p50={percentile(ack_times, 50) * 1000:.2f}ms p99={percentile(ack_times, 99) * 1000:.2f}ms")
+    if elapsed:
+        print(f"answered: {len(replies)}/{len(pushed)} in {elapsed:.2f}s ({len(replies) / elapsed:.1f} updates/s)")
+    print(f"replies out of order: {out_of_order}")
+    pool.stop(timeout=5)
+    os._exit(0 if len(replies) == len(pushed) and not out_of_order else 1)
+
+
+if __name__ == "__main__":
+    main()
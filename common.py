@@ -0,0 +1,212 @@
+"""Shared bot logic used by both polling (app.py) and async (async_app.py) modes"""
+import time
+import threading
+from contextlib import contextmanager
+from decouple import config
+
+from conv import trans, first_delivery, forget_delivery
+from utils.completion_cache import COMPLETION_CACHE_MAX_TEMPERATURE
+
+# Send placeholder and edit it while completion is generated
+STREAM_RESPONSES = config("STREAM_RESPONSES", default=False, cast=bool)
+# Min seconds between edits of one message and min new characters per edit
+STREAM_EDIT_INTERVAL = config("STREAM_EDIT_INTERVAL", default=1.0, cast=float)
+STREAM_EDIT_MIN_CHARS = config("STREAM_EDIT_MIN_CHARS", default=40, cast=int)
+STREAM_PLACEHOLDER = "..."
+# Telegram limit for message text
+MAX_MESSAGE_LENGTH = 4096
+
+AVAILBLE_SETTINGS = [
+    {
+        "k": "region",
+        "default": "us-en",
+        "description": "Region of DuckDuckGo search engine: wt-wt, us-en, uk-en, ru-ru, etc.",
+    },
+    {
+        "k": "num",
+        "default": "3",
+        "description": "Max results to show from DuckDuckGo search engine",
+        "options": ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10"],
+    },
+    {
+        "k": "time",
+        "default": "all",
+        "description": "Time range of DuckDuckGo search engine: all, d, w, m, y",
+        "options": ["all", "d", "w", "m", "y"],
+    },
+    {
+        "k": "deep",
+        "default": "off",
+        "description": "Answer /s from full text of found pages instead of snippets (slower)",
+        "options": ["off", "on"],
+    },
+    {
+        "k": "summary",
+        "default": "off",
+        "description": "Summarize old messages of long chats instead of forgetting them",
+        "options": ["off", "on"],
+    },
+    {
+        "k": "recall",
+        "default": "off",
+        "description": "Add older messages related to the question to the context of long chats",
+        "options": ["off", "on"],
+    },
+    {
+        "k": "cache",
+        "default": "off",
+        "description": f"Reuse answers to repeated questions and searches (at temperature up to {COMPLETION_CACHE_MAX_TEMPERATURE})",
+        "options": ["off", "on"],
+    },
+    {
+        "k": "temperature",
+        "default": "0.5",
+        "description": "Temperature of OpenAI GPT-3 chatbot",
+        "options": ["0.1", "0.2", "0.3", "0.4", "0.5", "0.6", "0.7", "0.8", "0.9", "1.0"],
+    }
+]
+
+HELP_MESSAGE = """Hi, I'm a chatbot powered by OpenAI GPT-3.
+Open source code on GitHub: https://github.com/Hormold/py-tg-chat by @define
+Current chat history size: {history_size}. Bot uses ChatGPT API.
+
+Available commands:
+/help - Display this message
+/rollback <num> - Rollback current chat history by <num> messages
+/reset - Remove all current chat history
+/backup [since:YYYY-MM-DD] [until:YYYY-MM-DD] [last:N] [format:gzip|zstd|none] - Download chat history (compressed json file)
+/export all|<chat_id> ... [options of /backup] - Download many chats in one archive (bot admins only, all = chats of this shard in sharded mode)
+/s <query> - Search on DuckDuckGo and compile a one-line response
+/settings key:value - Change chat settings (see /settings) + set temperature
+"""
+
+def get_rollback_count(text):
+    """Get count from command /rollback <num> or fallback to 1"""
+    return int(text.split()[1]) if len(text.split()) > 1 else 1
+
+def settings_text(settings):
+    """Text with all available settings and current values"""
+    text = "Available settings:\n\n"
+    for sett in AVAILBLE_SETTINGS:
+        current_value = settings[sett["k"]]
+        text += f"{sett['k']}: {current_value} ({sett['description']})\n"
+    text+="\n\nSend message in format /settings key:value to change setting. Example: /settings temperature:0.5"
+    return text
+
+def parse_setting(text):
+    """Parse and validate /settings key:value command.
+    Returns (key, value, error), error is None if setting can be saved"""
+    key, value = text.split()[1].split(":")
+    definitions = {sett["k"]: sett for sett in AVAILBLE_SETTINGS}
+    if key not in definitions:
+        return key, value, f"Invalid setting key: {key}"
+    definition = definitions[key]
+    if (value == "default" or len(value) == 0 or value == " " or len(value) > 100):
+        value = definition["default"]
+    if "options" in definition and value not in definition["options"]:
+        return key, value, f"Invalid setting value: {value}, available options: {', '.join(definition['options'])}"
+    if key == "num":
+        value = int(value)
+    if key == "temperature":
+        if(float(value) > 1.0):
+            value = "1.0"
+        if(float(value) < 0.1):
+            value = "0.1"
+    return key, value, None
+
+def get_question(message, bot_name):
+    """Get text of message addressed to bot, None if bot should not answer it"""
+    # Ignore zero length messages or it 1 symbol
+    if message.text is None or len(message.text) < 2:
+        return None
+    is_reply = False
+    if message.reply_to_message is not None:
+        is_reply = message.reply_to_message.from_user.username == bot_name
+    # If message not from private chat, it must start with bot name
+    if message.chat.type != "private" and not message.text.startswith(f"@{bot_name}") and not is_reply:
+        return None
+    text = message.text.replace(f"@{bot_name}", "").strip()
+
+    # Allow only latin characters
+    if not text.isascii():
+        text = trans(text)
+        # Non latin characters are very slow to process and badly tokenized
+    return text
+
+class InFlight:
+    """Lets every Telegram message be handled once.
+
+    Message already handled is skipped. Duplicate that comes while the first
+    delivery is still handled (threaded polling) waits for it: when the first
+    one fails, the message is forgotten and the duplicate handles it instead.
+    """
+
+    def __init__(self):
+        self.running = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def once(self, message):
+        """Yields True for first delivery of message, False for a duplicate.
+        Exception in the block forgets the message, so its redelivery is handled"""
+        key = (message.chat.id, message.message_id)
+        while True:
+            with self.lock:
+                done = self.running.get(key)
+                if done is None:
+                    done = self.running[key] = threading.Event()
+                    break
+            done.wait()
+        first = False
+        try:
+            # Seen id is stored outside the lock, deliveries of other messages do not wait for it
+            first = first_delivery(message.chat.id, message.message_id)
+            yield first
+        except BaseException:
+            if first:
+                forget_delivery(message.chat.id, message.message_id)
+            raise
+        finally:
+            with self.lock:
+                del self.running[key]
+            done.set()
+
+class StreamBuffer:
+    """Collects streamed completion and decides when the placeholder should be edited.
+    First visible text is shown right away, after that edits are coalesced
+    by time and size so Telegram edit limits are not hit"""
+
+    def __init__(self, interval=STREAM_EDIT_INTERVAL, min_chars=STREAM_EDIT_MIN_CHARS):
+        self.interval = interval
+        self.min_chars = min_chars
+        self.text = ""
+        self.shown = STREAM_PLACEHOLDER
+        self.last_edit = 0.0
+
+    def add(self, delta):
+        """Add text piece, returns True if message should be edited now"""
+        self.text += delta
+        if not self.text.strip():
+            return False
+        if self.last_edit == 0.0:
+            # First visible text is what users wait for
+            return True
+        if len(self.text) - len(self.shown) < self.min_chars:
+            return False
+        return time.monotonic() - self.last_edit >= self.interval
+
+    def preview(self, hotfix):
+        """Text to show now, None if nothing changed since last edit"""
+        text = hotfix(self.text)[:MAX_MESSAGE_LENGTH]
+        if not text.strip() or text == self.shown:
+            return None
+        return text
+
+    def mark_shown(self, text):
+        """Remember text that is currently displayed"""
+        self.shown = text
+        self.last_edit = time.monotonic()
+
+    def mark_failed(self):
+        """Edit failed, wait for next interval before trying again"""
+        self.last_edit = time.monotonic()
@@ -1,36 +1,177 @@
 """Conversation history module"""
 import os
 import json
-from transliterate import translit
-import tiktoken
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from decouple import config
+import recall
+from storage import create_storage
+from utils import metrics
+from utils.cache import LRUCache
+from utils.log import get_logger
+from utils.models import ENGINE, OPENAI_ANSWER_TOKENS, get_model
+from utils.translit import to_latin
 
+log = get_logger("conv")
 ENABLE_TRANSLIT = config("ENABLE_TRANSLIT", default=False, cast=bool)
 if ENABLE_TRANSLIT:
-    print("[CONFIG] Transliteration is enabled (cyr -> latin)")
-logDir = os.path.join(os.getcwd(), "logs")
-conversation_history = {}
-ENGINE = config("OPENAI_ENGINE", default="gpt-3.5-turbo")
-ENCODER = tiktoken.encoding_for_model(ENGINE)
-MODEL_MAX = 4096
+    log.info("Transliteration is enabled (cyr -> latin)")
+# Sharded modes point every worker to directory of its shard
+logDir = config("LOG_DIR", default=os.path.join(os.getcwd(), "logs"))
+# Chats kept in memory, least recently used are evicted and loaded back on demand
+MAX_CHATS_IN_MEMORY = config("MAX_CHATS_IN_MEMORY", default=1000, cast=int)
+MAX_HISTORY_BYTES = config("MAX_HISTORY_BYTES", default=256 * 1024 * 1024, cast=int)
+MODEL = get_model(ENGINE)
+# Chats with summary setting on: when history after the summary grows over
+# SUMMARY_TRIGGER_TOKENS, all but newest SUMMARY_KEEP_TOKENS are folded into it
+SUMMARY_TRIGGER_TOKENS = config("SUMMARY_TRIGGER_TOKENS", default=2000, cast=int)
+SUMMARY_KEEP_TOKENS = config("SUMMARY_KEEP_TOKENS", default=800, cast=int)
+SUMMARY_WORKERS = config("SUMMARY_WORKERS", default=2, cast=int)
+# Newest entries checked for a message saved twice (retried or double delivered update)
+DEDUP_WINDOW = config("DEDUP_WINDOW", default=16, cast=int)
+# Ids of handled messages kept per chat, a message delivered again is not handled twice
+SEEN_IDS = config("SEEN_IDS", default=256, cast=int)
+RECALL_HEADER = "Earlier messages of this chat related to the question:\n"
+# Opened by get_storage(), importing conv does not lock the storage directory
+STORAGE = None
+storage_lock = threading.Lock()
+
+def get_storage():
+    """Storage of chats, created and locked on first use. Entry points open it on start,
+    so a second bot on the same directory fails right away"""
+    global STORAGE
+    if STORAGE is None:
+        with storage_lock:
+            if STORAGE is None:
+                STORAGE = create_storage(logDir)
+    return STORAGE
+
+def count_tokens(text):
+    """Count tokens in text"""
+    return MODEL.count(text)
+
+def make_entry(role, content, message_id=None):
+    """Build history entry with cached token count, unix time it was added and Telegram message id"""
+    entry = {"role": role, "content": content, "tokens": count_tokens(content), "date": int(time.time())}
+    if message_id is not None:
+        entry["message_id"] = message_id
+    return entry
+
+def is_duplicate(history, entry):
+    """Entry repeats one of DEDUP_WINDOW newest entries: same Telegram message with the same text.
+    Equal text of different messages (two users saying thanks) is not a duplicate"""
+    message_id = entry.get('message_id')
+    if message_id is None:
+        return False
+    for saved in history[-DEDUP_WINDOW:]:
+        if saved.get('message_id') == message_id and saved['content'] == entry['content']:
+            return True
+    return False
+
+def entry_tokens(entry):
+    """Get token count of history entry content, count and cache it if missing"""
+    return MODEL.content_tokens(entry)
 
 def calc_array_tokens(messages):
     """Calculate tokens for array of messages"""
     tokens = 0
     for message in messages:
-        tokens += len(ENCODER.encode(message['content']))
+        tokens += entry_tokens(message)
     return tokens
 
-def strip_to_max(messages):
-    """Strip messages array to max tokens, if needed"""
-    tokens = calc_array_tokens(messages)
-    print(f"Tokens: {tokens} (max: {MODEL_MAX})")
-    if tokens > MODEL_MAX:
-        # Remove second message, but stay first one!
-        messages.pop(1)
-        return strip_to_max(messages)
-    else:
-        return messages
+def fit_history(history, budget):
+    """Newest history messages that fit into budget tokens, newest first.
+    Returns (messages, index of the oldest of them, tokens left)"""
+    window = []
+    start = len(history)
+    # Walk from the newest message back and keep as many as fit
+    while start > 0:
+        entry = history[start - 1]
+        if entry['role'] != 'system':
+            tokens = MODEL.message_total(entry)
+            if tokens > budget:
+                break
+            budget -= tokens
+            window.append(entry)
+        start -= 1
+    return window, start, budget
+
+def strip_to_max(system, history, summary=None, recall_older=None):
+    """Build messages array from system prompt, summary and newest history messages that fit into
+    model context next to the answer. System messages stored in history are skipped.
+    recall_older(start, budget) returns system message with messages older than history[start]
+    related to the question, in at most budget tokens, or None"""
+    limit = MODEL.context - OPENAI_ANSWER_TOKENS
+    # Chat format tokens are counted too, request built from window always fits
+    budget = limit - MODEL.reply_tokens - MODEL.message_total(system)
+    if summary is not None:
+        budget -= MODEL.message_total(summary)
+    window, start, left = fit_history(history, budget)
+    recalled = None
+    if recall_older is not None and start > 0 and budget > recall.RECALL_TOKENS:
+        # Some messages do not fit, part of the context goes to the relevant ones of them
+        window, start, left = fit_history(history, budget - recall.RECALL_TOKENS)
+        recalled = recall_older(start, left + recall.RECALL_TOKENS)
+        if recalled is not None:
+            window.append(recalled)
+            left -= MODEL.message_total(recalled)
+        else:
+            window, start, left = fit_history(history, budget)
+    if summary is not None:
+        window.append(summary)
+    window.append(system)
+    window.reverse()
+    log.debug("Tokens: %s (max: %s)", limit - left, limit)
+    return window
+
+def recount_tokens(chat):
+    """Recalculate running token total of chat history"""
+    chat['tokens'] = calc_array_tokens(chat['history'])
+    return chat['tokens']
+
+def chat_size(chat):
+    """Approximate memory used by chat state, from running token total"""
+    return chat.get('tokens', 0) * 4 + len(chat['history']) * 200 + len(chat['members']) * 300
+
+def evict_chat(str_id, chat):
+    """Chat pushed out of memory: every change is already stored, just flush it"""
+    get_storage().close(str_id)
+    log.debug("Evicted chat %s from memory", str_id)
+
+def get_chat(str_id):
+    """Get chat state from memory, load it from storage if it is not there"""
+    chat = conversation_history.get(str_id)
+    if chat is None:
+        chat = get_storage().load(str_id)
+        if chat is not None:
+            recount_tokens(chat)
+            conversation_history[str_id] = chat
+    return chat
+
+def read_chat(str_id):
+    """Get chat state from memory or storage without keeping it in memory, for exports of many chats"""
+    chat = conversation_history.get(str_id)
+    if chat is None:
+        chat = get_storage().load(str_id)
+    return chat
+
+def chat_ids():
+    """Ids of all chats in storage"""
+    return get_storage().chat_ids()
+
+def cache_stats():
+    """Hit, miss and eviction counters of chat state cache"""
+    return conversation_history.stats()
+
+conversation_history = LRUCache(
+    max_items=MAX_CHATS_IN_MEMORY,
+    max_bytes=MAX_HISTORY_BYTES,
+    sizeof=chat_size,
+    on_evict=evict_chat,
+)
+# Rendered system prompt per chat with version it was built for
+prompt_cache = LRUCache(max_items=MAX_CHATS_IN_MEMORY)
 
 def user_to_str(user, with_id=True):
     """Convert user object to string"""
@@ -47,160 +188,310 @@ def user_to_str(user, with_id=True):
 def trans(text):
     """Translate text to english"""
     if ENABLE_TRANSLIT:
-        return translit(text, 'ru', reversed=True)
+        return to_latin(text)
     else:
         return text
 
+def make_member(user, chat_type):
+    """Member record of Telegram user. Its line of system prompt is rendered once, here"""
+    member = {
+        "id": user.id,
+        "first_name": trans(user.first_name if user.first_name is not None else ""),
+        "last_name": trans(user.last_name if user.last_name is not None else ""),
+        "username": user.username,
+    }
+    member["rendered"] = user_to_str(member, chat_type != "private")
+    return member
+
+def rendered_member(member, with_id):
+    """Line of system prompt about member"""
+    if 'rendered' not in member:
+        # Member saved before lines were rendered on add
+        member['rendered'] = user_to_str(member, with_id)
+    return member['rendered']
+
 def get_full_data(chat_id):
     """Get full conversation history"""
-    str_id = str(chat_id)
-    if str_id not in conversation_history:
+    chat = get_chat(str(chat_id))
+    if chat is None:
         return {}
-    data = json.dumps(conversation_history[str_id], indent=4, ensure_ascii=False)
+    data = json.dumps(chat, indent=4, ensure_ascii=False)
     return data
 
 def get_file_path(chat_id):
-    """Get file path for chat history"""
-    return os.path.join(logDir, f"new_{str(chat_id)}.json")
+    """Get file path for chat history snapshot"""
+    return get_storage().get_file_path(chat_id)
 
-def get(chat_id):
-    """Get conversation history for Prompt"""
-    str_id = str(chat_id)
-    if str_id not in conversation_history:
-        return []
+def prompt_version(chat):
+    """Everything system prompt depends on. Members are only added, so count is enough"""
+    return (chat['title'], chat['type'], len(chat['members']))
+
+def get_system_prompt(str_id, chat):
+    """System prompt entry of chat, rebuilt only when members or title change"""
+    version = prompt_version(chat)
+    cached = prompt_cache.get(str_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
     # Generate prompt from history. Using title, type and member list
-    prompt = f'You are ChatGPT bot, helping user inside Telegram chat. Do not send reply with you name in beginning. Not send me: "ChatGPT bot: ". Current chat title: "{conversation_history[str_id]["title"]}"\n'
+    prompt = f'You are ChatGPT bot, helping user inside Telegram chat. Do not send reply with you name in beginning. Not send me: "ChatGPT bot: ". Current chat title: "{chat["title"]}"\n'
 
-    if conversation_history[str_id]['type'] == "private":
-        member_obj = conversation_history[str_id]['members']
+    if chat['type'] == "private":
+        member_obj = chat['members']
         # Get first member
         member = member_obj[list(member_obj.keys())[0]]
-        member = user_to_str(member, False)
+        member = rendered_member(member, False)
         prompt += f'Your companion in chat is {member}\n'
     else:
-        members_count = len(conversation_history[str_id]["members"])
+        members_count = len(chat["members"])
         prompt += f'You are in group chat with {members_count} members.\n'
-        known_members = []
-        for member_id in conversation_history[str_id]["members"]:
-            member = conversation_history[str_id]["members"][member_id]
-            known_members.append(user_to_str(member, True))
+        known_members = [rendered_member(member, True) for member in chat["members"].values()]
         prompt += f'Known members of chat: {", ".join(known_members)}\n'
 
-    real_history = conversation_history[str_id]['history']
-    # Add prompt to beginning of history
-    # Remove messages where role is system
-    real_history = [x for x in real_history if x['role'] != 'system']
-    # Limit to LAST 25 messages
-    real_history = [{"role": "system", "content": prompt}] + real_history
-    real_history = strip_to_max(real_history)
-    return real_history
+    system = make_entry("system", prompt)
+    prompt_cache[str_id] = (version, system)
+    return system
+
+def get(chat_id):
+    """Get conversation history for Prompt"""
+    str_id = str(chat_id)
+    chat = get_chat(str_id)
+    if chat is None:
+        return []
+    system = get_system_prompt(str_id, chat)
+    history = chat['history']
+    summary = chat.get('summary')
+    summary_entry = None
+    covered = 0
+    if summary is not None and summary_enabled(chat):
+        summary_entry = {"role": "system", "content": summary_message(summary['content']), "tokens": summary['tokens']}
+        covered = summary['covered']
+        history = history[covered:]
+    recall_older = None
+    if recall_enabled(chat):
+        # Summarized messages can be recalled too, positions are in the whole history
+        recall_older = lambda start, budget: recall_message(str_id, chat, covered + start, budget)
+    return strip_to_max(system, history, summary_entry, recall_older)
+
+def recall_enabled(chat):
+    """Recall setting of chat, off by default like in AVAILBLE_SETTINGS"""
+    return chat.get('settings', {}).get('recall') == 'on'
+
+def recall_message(str_id, chat, end, budget):
+    """System message with messages before history[end] that match the question best,
+    in chronological order and at most budget tokens. None if nothing matches"""
+    history = chat['history']
+    question = next((entry for entry in reversed(history) if entry['role'] == 'user'), None)
+    if question is None:
+        return None
+    with metrics.stage("recall"):
+        found = recall.search(str_id, get_storage().get_index_path(str_id), history, question['content'], end)
+    chosen = []
+    used = MODEL.message_overhead({"role": "system"}) + count_tokens(RECALL_HEADER)
+    # Best matches first, every line costs its content and a few tokens of role and separator
+    for position in found:
+        tokens = entry_tokens(history[position]) + 3
+        if used + tokens <= budget:
+            chosen.append(position)
+            used += tokens
+    while chosen:
+        lines = [f"{history[position]['role']}: {history[position]['content']}" for position in sorted(chosen)]
+        content = RECALL_HEADER + "\n".join(lines)
+        entry = {"role": "system", "content": content, "tokens": count_tokens(content)}
+        if MODEL.message_total(entry) <= budget:
+            return entry
+        chosen.pop()
+    return None
+
+def history_len(chat_id):
+    """Number of messages in chat history, without building prompt"""
+    chat = get_chat(str(chat_id))
+    if chat is None:
+        return 0
+    return len(chat['history'])
+
+def last_message(chat_id):
+    """Last message of chat history, None if history is empty"""
+    chat = get_chat(str(chat_id))
+    if chat is None or len(chat['history']) == 0:
+        return None
+    return chat['history'][-1]
 
 def load(chat_id):
     """Load conversation history from file"""
     str_id = str(chat_id)
-    path = get_file_path(str_id)
-    if not os.path.exists(path):
-        return print (f"[ERROR] Conversation history for chat {str_id} not found in {path}")
-    with open(path, "r", encoding="utf-8") as content:
-        conversation_history[str_id] = json.load(content)
-        print(f"[CONV] Loaded conversation history for chat {str_id}")
+    if str_id in conversation_history:
+        return # Already in memory
+    if get_chat(str_id) is None:
+        log.error("Conversation history for chat %s not found in %s", str_id, get_file_path(str_id))
+        return
+    log.debug("Loaded conversation history for chat %s", str_id)
 
 def init(chat_id, title, chat_type, from_user):
     """Initialize conversation history"""
     str_id = str(chat_id)
-    if str_id in conversation_history:
-        return # Already initialized
     if title is None:
         title = 'Private chat'
+    chat = get_chat(str_id)
+    if chat is not None:
+        # Already initialized, only follow title changes
+        if chat.get('source_title') != title:
+            chat['source_title'] = title
+            chat['title'] = trans(title)
+            commit(str_id, chat, {"op": "title", "title": chat['title'], "source_title": title})
+        return
 
-    conversation_history[str_id] = {
+    chat = {
         "id": str_id,
         "title": trans(title),
+        "source_title": title,
         "history": [],
         "members": {},
         "type": chat_type,
-        "settings": {}
+        "settings": {},
+        "tokens": 0
     }
 
-    conversation_history[str_id]['members'][str(from_user.id)] = {
-        "id": from_user.id,
-        "first_name": trans(from_user.first_name if from_user.first_name is not None else ""),
-        "last_name": trans(from_user.last_name if from_user.last_name is not None else ""),
-        "username": from_user.username,
-    }
+    chat['members'][str(from_user.id)] = make_member(from_user, chat_type)
+    conversation_history[str_id] = chat
     # Save conversation history to file after init
-    save(str_id)
+    snapshot(str_id, chat)
 
 def save(chat_id):
-    """Save conversation history to file"""
+    """Save full conversation history snapshot"""
     str_id = str(chat_id)
-    if str_id not in conversation_history:
+    chat = get_chat(str_id)
+    if chat is None:
         return
-    path = get_file_path(str_id)
-    with open(path, "w", encoding="utf-8") as content:
-        # Remove duplicates from history where content is the same
-        conversation_history[str_id]['history'] = [i for n, i in enumerate(conversation_history[str_id]['history']) if i not in conversation_history[str_id]['history'][n + 1:]]
-        json.dump(conversation_history[str_id], content, indent=4, ensure_ascii=False)
-        print(f"[CONV] Saved conversation history for chat {str_id}")
+    snapshot(str_id, chat)
+
+def snapshot(str_id, chat):
+    """Write full chat state to storage"""
+    get_storage().save(str_id, chat)
+    log.debug("Saved conversation history for chat %s", str_id)
+
+def commit(str_id, chat, record):
+    """Persist single change of chat: journal record or full snapshot"""
+    if get_storage().append_only:
+        get_storage().append(str_id, record, chat)
+    else:
+        snapshot(str_id, chat)
+    conversation_history.resize(str_id)
 
 
-def save_question(chat_id, text, author):
-    """Append question to history"""
+seen_lock = threading.Lock()
+
+def first_delivery(chat_id, message_id):
+    """Record message as handled. False if it already was: Telegram delivered the update again"""
+    str_id = str(chat_id)
+    chat = get_chat(str_id)
+    if chat is None:
+        return True
+    with seen_lock:
+        seen = chat.setdefault('seen', [])
+        if message_id in seen:
+            return False
+        seen.append(message_id)
+        del seen[:-SEEN_IDS]
+    # Snapshot storage saves ids with the next change of history, journal has a cheap record for it
+    if get_storage().append_only:
+        commit(str_id, chat, {"op": "seen", "id": message_id})
+    return True
+
+def forget_delivery(chat_id, message_id):
+    """Undo first_delivery of message that failed, so the update delivered again is handled.
+    Its question is withdrawn too if nothing was added after it, otherwise redelivery finds it saved"""
     str_id = str(chat_id)
-    if str_id not in conversation_history:
-        print(f"[ERROR] chat {str_id} is not initialized")
+    chat = get_chat(str_id)
+    if chat is None:
         return
+    with seen_lock:
+        seen = chat.get('seen', [])
+        if message_id not in seen:
+            return
+        seen.remove(message_id)
+    if chat['history'] and chat['history'][-1].get('message_id') == message_id:
+        rollback(chat_id, 1)
+    commit(str_id, chat, {"op": "unseen", "id": message_id})
+
+def save_question(chat_id, text, author, message_id=None):
+    """Append question to history. Returns False if it was not saved: chat is unknown
+    or message with this id and text is already there"""
+    str_id = str(chat_id)
+    chat = get_chat(str_id)
+    if chat is None:
+        log.error("Chat %s is not initialized", str_id)
+        return False
 
     # If member is not in members list, add him
-    if not str(author.id) in conversation_history[str_id]['members']:
-        print(f"[MEMBERS] Adding new member {author.id} to chat {str_id}")
-        conversation_history[str_id]['members'][str(author.id)] = {
-            "id": author.id,
-            "first_name": trans(author.first_name if author.first_name is not None else ""),
-            "last_name": trans(author.last_name if author.last_name is not None else ""),
-            "username": author.username,
-        }
+    if not str(author.id) in chat['members']:
+        log.debug("Adding new member %s to chat %s", author.id, str_id)
+        member = make_member(author, chat['type'])
+        chat['members'][str(author.id)] = member
+        if get_storage().append_only:
+            commit(str_id, chat, {"op": "member", "member": member})
 
-    if conversation_history[str_id]['type'] == 'private':
-        conversation_history[str_id]['history'].append({"role": 'user', "content": text})
+    if chat['type'] == 'private':
+        entry = make_entry('user', text, message_id)
     else:
-        conversation_history[str_id]['history'].append({"role": 'user', "content": f'#{author.id}: {text}'});
-    save(str_id)
+        entry = make_entry('user', f'#{author.id}: {text}', message_id)
+    if is_duplicate(chat['history'], entry):
+        log.debug("Message %s is already in history of chat %s", message_id, str_id)
+        return False
+    chat['history'].append(entry)
+    chat['tokens'] += entry['tokens']
+    commit(str_id, chat, {"op": "append", "entry": entry})
+    recall.add(str_id, chat['history'])
+    return True
 
 def save_response(chat_id, text):
     """Append response to history"""
     str_id = str(chat_id)
-    if str_id not in conversation_history:
-        print(f"[ERROR] chat {str_id} is not initialized")
+    chat = get_chat(str_id)
+    if chat is None:
+        log.error("Chat %s is not initialized", str_id)
         return
-    conversation_history[str_id]['history'].append({"role": 'assistant', "content": text})
-    save(str_id)
+    entry = make_entry('assistant', text)
+    chat['history'].append(entry)
+    chat['tokens'] += entry['tokens']
+    commit(str_id, chat, {"op": "append", "entry": entry})
+    recall.add(str_id, chat['history'])
+    if summary_enabled(chat):
+        summarize_later(str_id, chat)
 
 def reset(chat_id):
     """Reset history"""
     str_id = str(chat_id)
-    if str_id not in conversation_history:
+    chat = get_chat(str_id)
+    if chat is None:
         return
-    conversation_history[str_id]['history'] = []
-    save(str_id)
+    chat['history'] = []
+    chat['tokens'] = 0
+    chat.pop('summary', None)
+    commit(str_id, chat, {"op": "reset"})
+    recall.remove(str_id, get_storage().get_index_path(str_id))
 
 def rollback(chat_id, count):
     """Rollback history"""
     str_id = str(chat_id)
-    if str_id not in conversation_history:
+    chat = get_chat(str_id)
+    if chat is None:
         return
-    conversation_history[str_id]['history'] = conversation_history[str_id]['history'][:-count]
-    save(str_id)
+    chat['history'] = chat['history'][:-count]
+    recount_tokens(chat)
+    drop_stale_summary(chat)
+    commit(str_id, chat, {"op": "rollback", "count": count})
+    recall.truncate(str_id, get_storage().get_index_path(str_id), chat['history'])
 
-def save_chat_settings(chat_id, key, value): 
+def save_chat_settings(chat_id, key, value):
     """Save chat settings"""
     str_id = str(chat_id)
-    if str_id not in conversation_history:
+    chat = get_chat(str_id)
+    if chat is None:
         return
-    if not 'settings' in conversation_history[str_id]:
-        conversation_history[str_id]['settings'] = {}
-    conversation_history[str_id]['settings'][key] = value
-    save(str_id)
+    if not 'settings' in chat:
+        chat['settings'] = {}
+    chat['settings'][key] = value
+    commit(str_id, chat, {"op": "settings", "key": key, "value": value})
 
 def get_all_chat_settings(chat_id, default_settings):
     """Get all chat settings"""
@@ -208,10 +499,96 @@ def get_all_chat_settings(chat_id, default_settings):
     # convert default_settings [{"k": "...", "default": "123"}] to {key: default_value}
     default_settings = {item['k']: item['default'] for item in default_settings}
 
-    if str_id not in conversation_history:
+    chat = get_chat(str_id)
+    if chat is None:
         return default_settings
-    if not 'settings' in conversation_history[str_id]:
+    if not 'settings' in chat:
         return default_settings
-    mixed_settings = {**default_settings, **conversation_history[str_id]['settings']}
+    mixed_settings = {**default_settings, **chat['settings']}
     return mixed_settings
 
+
+# Summarization runs off the handler thread. summarizer(previous_summary, entries)
+# returns new summary text, it is set by the bot (see set_summarizer) or a stub in tests
+summarizer = None
+summary_executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="summary")
+summarizing = set()
+summarizing_lock = threading.Lock()
+
+def set_summarizer(function):
+    """Set function that condenses messages into summary"""
+    global summarizer
+    summarizer = function
+
+def summary_enabled(chat):
+    """Summary setting of chat, off by default like in AVAILBLE_SETTINGS"""
+    return chat.get('settings', {}).get('summary') == 'on'
+
+def summary_message(content):
+    """Text of system message that carries summary"""
+    return f"Summary of the earlier conversation: {content}"
+
+def drop_stale_summary(chat):
+    """Forget summary if messages it covers were rolled back"""
+    summary = chat.get('summary')
+    if summary is not None and summary['covered'] > len(chat['history']):
+        del chat['summary']
+
+def unsummarized_tokens(chat):
+    """Tokens of history after the summary"""
+    summary = chat.get('summary')
+    return chat['tokens'] - (summary['covered_tokens'] if summary else 0)
+
+def summarize_later(str_id, chat):
+    """Queue summarization of chat if history after summary is too long"""
+    if summarizer is None or unsummarized_tokens(chat) <= SUMMARY_TRIGGER_TOKENS:
+        return
+    with summarizing_lock:
+        if str_id in summarizing:
+            return
+        summarizing.add(str_id)
+    summary_executor.submit(summarize, str_id, chat)
+
+def summary_cut(history, start):
+    """Index where newest SUMMARY_KEEP_TOKENS of history begin, messages before it get summarized"""
+    kept = 0
+    cut = len(history)
+    while cut > start and kept + entry_tokens(history[cut - 1]) <= SUMMARY_KEEP_TOKENS:
+        cut -= 1
+        kept += history[cut]['tokens']
+    return cut
+
+def summarize(str_id, chat):
+    """Fold oldest messages of chat into its summary"""
+    try:
+        history = chat['history']
+        previous = chat.get('summary')
+        start = previous['covered'] if previous else 0
+        cut = summary_cut(history, start)
+        if cut <= start:
+            return
+        entries = history[start:cut]
+        with metrics.stage("summarize"):
+            content = summarizer(previous['content'] if previous else None, entries)
+        summary = {
+            "content": content,
+            "tokens": count_tokens(summary_message(content)),
+            "covered": cut,
+            "covered_tokens": (previous['covered_tokens'] if previous else 0) + calc_array_tokens(entries),
+        }
+        # Storage lock keeps snapshot writes from seeing chat half updated
+        with get_storage().lock:
+            if conversation_history.get(str_id) is not chat or chat['history'] is not history or chat.get('summary') is not previous:
+                # Chat was evicted, reset or rolled back meanwhile, summary would not match it
+                metrics.SUMMARIES.inc(status="stale")
+                return
+            chat['summary'] = summary
+            commit(str_id, chat, {"op": "summary", "summary": summary})
+        metrics.SUMMARIES.inc(status="ok")
+        log.debug("Summarized %s messages of chat %s into %s tokens", cut - start, str_id, summary['tokens'])
+    except Exception as ex:
+        metrics.SUMMARIES.inc(status="error")
+        log.exception("Summarization of chat %s failed > %s", str_id, ex)
+    finally:
+        with summarizing_lock:
+            summarizing.discard(str_id)
@@ -0,0 +1,68 @@
+"""Sharded polling mode: one process long-polls Telegram and routes updates to shard processes
+
+Run: python dispatcher.py
+Move chat files for another number of shards without starting the bot: python dispatcher.py --rebalance N
+"""
+import time
+import argparse
+from decouple import config
+from telebot import apihelper
+
+from storage import lock_directory, rebalance_shards
+from workers import WorkerPool, SHARDS, LOG_DIR
+from utils import metrics
+from utils.log import get_logger
+
+BOT_TOKEN = config("BOT_TOKEN")
+# Bot API server, for local Bot API server or tests
+TELEGRAM_API_URL = config("TELEGRAM_API_URL", default="")
+# Seconds Telegram holds getUpdates open
+POLL_TIMEOUT = config("POLL_TIMEOUT", default=20, cast=int)
+
+log = get_logger("bot")
+
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+
+
+def poll(pool):
+    """Long-poll updates and hand them to shards, waits while a shard is behind"""
+    offset = None
+    while True:
+        try:
+            updates = apihelper.get_updates(BOT_TOKEN, offset=offset, timeout=POLL_TIMEOUT + 5,
+                                            long_polling_timeout=POLL_TIMEOUT)
+        except Exception as err:
+            log.error("getUpdates failed: %s", err)
+            time.sleep(1)
+            continue
+        for update in updates:
+            while not pool.submit(update):
+                log.warning("Shard queue is full, waiting")
+            offset = update["update_id"] + 1
+
+
+def main():
+    """Rebalance chats, start shards and poll until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rebalance", type=int, metavar="N", help="only move chat files for N shards and exit")
+    args = parser.parse_args()
+    if args.rebalance:
+        with lock_directory(LOG_DIR):
+            rebalance_shards(LOG_DIR, args.rebalance)
+        return
+
+    pool = WorkerPool()
+    pool.start()
+    metrics.start_server()
+    log.info("Polling updates for %s shards x %s threads", SHARDS, pool.threads)
+    try:
+        poll(pool)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Chat history exports: /backup of current chat and /export of many chats for bot admins
+
+History is written entry by entry into a compressed temp file, so neither JSON
+text nor compressed archive of a big chat is built in memory. Exports are built
+in a small thread pool, handlers only schedule them.
+"""
+import os
+import copy
+import gzip
+import json
+import tarfile
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from decouple import config, Csv
+
+import conv
+from storage import SHARDS_DIR
+from utils.log import get_logger
+
+try:
+    import zstandard
+except ImportError:
+    # Optional, exports are gzip or plain json without it
+    zstandard = None
+
+# Compression used when /backup has no format option: gzip, zstd or none
+EXPORT_FORMAT = config("EXPORT_FORMAT", default="gzip")
+# Exports built at the same time
+EXPORT_WORKERS = config("EXPORT_WORKERS", default=2, cast=int)
+# Telegram user ids allowed to /export any chat, comma separated
+ADMIN_IDS = config("ADMIN_IDS", default="", cast=Csv(int))
+EXTENSIONS = {"gzip": ".json.gz", "zstd": ".json.zst", "none": ".json"}
+DAY = 24 * 60 * 60
+
+log = get_logger("export")
+executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+
+
+class ExportError(Exception):
+    """Export can not be made, message is shown to user"""
+
+
+def parse_date(value):
+    """Unix time of YYYY-MM-DD in UTC"""
+    try:
+        return int(datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
+    except ValueError:
+        raise ExportError(f"Invalid date: {value}, use YYYY-MM-DD") from None
+
+
+def parse_options(text):
+    """Parse key:value options of /backup and /export command.
+    Returns (options, words), words are arguments without colon"""
+    options = {"format": EXPORT_FORMAT, "since": None, "until": None, "last": None}
+    words = []
+    for argument in text.split()[1:]:
+        if ":" not in argument:
+            words.append(argument)
+            continue
+        key, value = argument.split(":", 1)
+        if key == "format":
+            if value not in EXTENSIONS:
+                raise ExportError(f"Invalid format: {value}, available formats: {', '.join(EXTENSIONS)}")
+        elif key == "since":
+            value = parse_date(value)
+        elif key == "until":
+            # Whole day is included
+            value = parse_date(value) + DAY
+        elif key == "last":
+            if not value.isdigit() or int(value) == 0:
+                raise ExportError(f"Invalid number of messages: {value}")
+            value = int(value)
+        else:
+            raise ExportError(f"Unknown option: {key}, available options: format, since, until, last")
+        options[key] = value
+    if options["format"] == "zstd" and zstandard is None:
+        raise ExportError("zstd is not available, use format:gzip")
+    return options, words
+
+
+def filter_history(history, since=None, until=None, last=None):
+    """Entries added in [since, until) and then last N of them. Entries saved without date count as oldest"""
+    entries = history
+    if since is not None or until is not None:
+        entries = [entry for entry in history
+                   if (since is None or entry.get('date', 0) >= since) and (until is None or entry.get('date', 0) < until)]
+    if last is not None:
+        entries = entries[-last:]
+    return entries
+
+
+@contextmanager
+def compressed(path, compression):
+    """Binary stream writing compressed data to path"""
+    with open(path, "wb") as raw:
+        if compression == "gzip":
+            with gzip.GzipFile(fileobj=raw, mode="wb") as stream:
+                yield stream
+        elif compression == "zstd":
+            with zstandard.ZstdCompressor().stream_writer(raw, closefd=False) as stream:
+                yield stream
+        else:
+            yield raw
+
+
+def copy_chat(chat, options):
+    """Chat fields and filtered history copied under storage lock, handlers keep changing the chat meanwhile"""
+    with conv.get_storage().lock:
+        head = {key: copy.deepcopy(value) for key, value in list(chat.items()) if key not in ('history', 'seen')}
+        entries = copy.deepcopy(filter_history(list(chat['history']), options["since"], options["until"], options["last"]))
+    return head, entries
+
+
+def write_chat(stream, head, entries):
+    """Write chat fields and history as one JSON object, history entry by entry"""
+    encoded = json.dumps(head, ensure_ascii=False)
+    stream.write(encoded[:-1].encode("utf-8"))
+    stream.write(b', "history": [' if head else b'"history": [')
+    for number, entry in enumerate(entries):
+        if number:
+            stream.write(b", ")
+        stream.write(json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+    stream.write(b"]}")
+
+
+def export_chat(chat_id, options):
+    """Write filtered history of chat into temp file. Returns (path, file name for user)"""
+    str_id = str(chat_id)
+    chat = conv.read_chat(str_id)
+    if chat is None:
+        raise ExportError(f"Chat {str_id} has no history")
+    head, entries = copy_chat(chat, options)
+    name = f"chat_{str_id}{EXTENSIONS[options['format']]}"
+    descriptor, path = tempfile.mkstemp(prefix="export_", suffix=EXTENSIONS[options["format"]])
+    os.close(descriptor)
+    try:
+        with compressed(path, options["format"]) as stream:
+            write_chat(stream, head, entries)
+    except BaseException:
+        os.remove(path)
+        raise
+    log.info("Exported %s messages of chat %s, %s bytes", len(entries), str_id, os.path.getsize(path))
+    return path, name
+
+
+def bundle_ids(words):
+    """Chat ids of /export arguments: "all" or list of ids"""
+    if words == ["all"]:
+        return conv.chat_ids()
+    if not words or not all(word.lstrip("-").isdigit() for word in words):
+        raise ExportError("Usage: /export all|<chat_id> [<chat_id> ...] [since:YYYY-MM-DD] [until:YYYY-MM-DD] [last:N] [format:gzip|zstd|none]")
+    return words
+
+
+def sharded():
+    """True in shard worker: storage holds only chats of this shard"""
+    return os.path.basename(os.path.dirname(os.path.abspath(conv.logDir))) == SHARDS_DIR
+
+
+def bundle_caption(words):
+    """Caption of /export archive, "all" of a shard worker is not every chat of the bot"""
+    if words == ["all"] and sharded():
+        return "Chat history export (only chats of this shard)"
+    return "Chat history export"
+
+
+def export_bundle(chat_ids, options):
+    """Write chats into one tar archive of per-chat exports. Returns (path, file name for user)"""
+    descriptor, path = tempfile.mkstemp(prefix="export_", suffix=".tar")
+    os.close(descriptor)
+    exported = 0
+    try:
+        with tarfile.open(path, "w") as archive:
+            for chat_id in chat_ids:
+                try:
+                    member, name = export_chat(chat_id, options)
+                except ExportError as err:
+                    log.warning("Skipped chat in bundle: %s", err)
+                    continue
+                try:
+                    archive.add(member, arcname=name)
+                finally:
+                    os.remove(member)
+                exported += 1
+    except BaseException:
+        os.remove(path)
+        raise
+    if exported == 0:
+        os.remove(path)
+        raise ExportError("No chats to export")
+    return path, f"chats_{exported}.tar"
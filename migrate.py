@@ -0,0 +1,58 @@
+"""Migrations for stored conversation history files
+
+Run: python migrate.py
+"""
+import os
+import glob
+import json
+
+import conv
+from storage import SHARDS_DIR, lock_directory
+
+def chat_dirs(log_dir):
+    """log_dir and directories of its shards, sharded deployments keep chats in logs/shards/<index>/"""
+    dirs = [log_dir]
+    shards_path = os.path.join(log_dir, SHARDS_DIR)
+    if os.path.isdir(shards_path):
+        dirs += [os.path.join(shards_path, name) for name in sorted(os.listdir(shards_path))]
+    return dirs
+
+def backfill_token_counts(log_dir=conv.logDir):
+    """Add cached token count to every history entry and running total to every chat"""
+    migrated = 0
+    conv.get_storage()
+    dirs = chat_dirs(log_dir)
+    # conv storage holds lock of its own directory. Others are locked here, so a running
+    # shard process fails this migration instead of writing the same chat at the same time
+    locked = [directory for directory in dirs if os.path.abspath(directory) != os.path.abspath(conv.logDir)]
+    locks = []
+    try:
+        for directory in locked:
+            locks.append(lock_directory(directory))
+        for directory in dirs:
+            for path in sorted(glob.glob(os.path.join(directory, "new_*.json"))):
+                with open(path, "r", encoding="utf-8") as content:
+                    chat = json.load(content)
+                history = chat.get('history', [])
+                if 'tokens' in chat and all('tokens' in entry for entry in history):
+                    continue
+                chat['tokens'] = conv.calc_array_tokens(history)
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as content:
+                    json.dump(chat, content, indent=4, ensure_ascii=False)
+                os.replace(tmp_path, path)
+                migrated += 1
+                print(f"[MIGRATE] Backfilled token counts for {path} ({chat['tokens']} tokens)")
+    finally:
+        for lock in locks:
+            lock.close()
+    return migrated
+
+MIGRATIONS = [
+    backfill_token_counts,
+]
+
+if __name__ == "__main__":
+    for migration in MIGRATIONS:
+        count = migration()
+        print(f"[MIGRATE] {migration.__name__}: {count} file(s) updated")
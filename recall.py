@@ -0,0 +1,351 @@
+"""Lexical recall of older chat messages
+
+Chats with recall setting on keep an inverted index of their history: word ->
+positions of messages with it and how many times it is there. When prompt is
+built, messages that no longer fit into the context are ranked with BM25
+against the question and the best of them are sent in one system message.
+
+Index lives in recall_<chat_id>.idx next to chat history: delta encoded arrays
+compressed with zlib. It is loaded on first use, messages saved after it was
+written are indexed from history then, and it is rewritten in background
+every RECALL_FLUSH_EVERY new messages and when it leaves memory. History is the
+source of truth: file keeps number of indexed messages and checksum of the last
+one, an index that does not match history is rebuilt. Rollback truncates the
+index file too, messages saved after it could repeat the checksum.
+"""
+import os
+import re
+import sys
+import math
+import zlib
+import heapq
+import struct
+import operator
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from decouple import config
+
+from utils import metrics
+from utils.cache import LRUCache
+from utils.log import get_logger
+
+# Older messages added to prompt: best N of them that fit into RECALL_TOKENS
+RECALL_TOP_K = config("RECALL_TOP_K", default=5, cast=int)
+RECALL_TOKENS = config("RECALL_TOKENS", default=400, cast=int)
+# Memory of loaded indexes, least recently used are written to disk and dropped
+RECALL_INDEX_BYTES = config("RECALL_INDEX_BYTES", default=64 * 1024 * 1024, cast=int)
+# New messages indexed before index file is rewritten, big indexes wait for a tenth of their size
+RECALL_FLUSH_EVERY = config("RECALL_FLUSH_EVERY", default=200, cast=int)
+# Newest messages scored per query word, keeps lookups fast in huge chats
+RECALL_CANDIDATES = config("RECALL_CANDIDATES", default=128, cast=int)
+# Rarest words of question used for lookup
+QUERY_WORDS = 8
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Arrays are stored in machine byte order, file of other order is rebuilt
+MAGIC = b"RIX2" if sys.byteorder == "little" else b"RIXC"
+HEADER = struct.Struct("<IIIIIII")
+WORD = re.compile(r"\w+")
+# Author prefix of group messages, "#123: "
+AUTHOR = re.compile(r"^#-?\d+: ")
+STOP_WORDS = frozenset("""a an and are as at be but by can do does for from had has have he her his how i if in
+into is it its me my no not of on or our she so than that the their them then there they this to was we were
+what when which who will with would you your""".split())
+
+log = get_logger("recall")
+
+
+def words(text):
+    """Lowercase words of message used for search, without stop words and author prefix"""
+    return [word for word in WORD.findall(AUTHOR.sub("", text, count=1).lower())
+            if len(word) > 1 and word not in STOP_WORDS]
+
+
+def fingerprint(entry):
+    """Checksum of history entry, tells if index still matches history"""
+    return zlib.crc32(entry['content'].encode("utf-8"))
+
+
+class HistoryIndex:
+    """Inverted index of chat history, documents are positions of messages in history"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Write is queued, index is dropped after reset of history
+        self.saving = False
+        self.removed = False
+        self.clear()
+
+    def clear(self):
+        """Forget all messages"""
+        # word -> (positions of messages, occurrences in them), positions are ascending
+        self.postings = {}
+        self.lengths = array('I')
+        self.total = 0
+        self.entries = 0
+        self.last = 0
+        self.unsaved = 0
+
+    @property
+    def docs(self):
+        """Number of indexed messages"""
+        return len(self.lengths)
+
+    def size(self):
+        """Approximate memory used by index"""
+        return self.entries * 6 + len(self.postings) * 150 + self.docs * 4
+
+    def add(self, entry):
+        """Index next message of history. System messages are kept as empty documents"""
+        position = self.docs
+        counts = Counter(words(entry['content'])) if entry['role'] != 'system' else {}
+        for word, count in counts.items():
+            posting = self.postings.get(word)
+            if posting is None:
+                posting = self.postings[word] = (array('I'), array('H'))
+            posting[0].append(position)
+            posting[1].append(min(count, 0xFFFF))
+        length = sum(counts.values())
+        self.entries += len(counts)
+        self.lengths.append(length)
+        self.total += length
+        self.last = fingerprint(entry)
+        self.unsaved += 1
+
+    def truncate(self, count, history):
+        """Forget messages from position `count` on, after rollback"""
+        for word in list(self.postings):
+            positions, counts = self.postings[word]
+            cut = bisect_left(positions, count)
+            if cut == 0:
+                del self.postings[word]
+            elif cut < len(positions):
+                del positions[cut:]
+                del counts[cut:]
+        del self.lengths[count:]
+        self.total = sum(self.lengths)
+        self.entries = sum(len(positions) for positions, _ in self.postings.values())
+        self.last = fingerprint(history[count - 1]) if count else 0
+        self.unsaved += 1
+
+    def matches(self, history):
+        """Index covers a prefix of history: its messages are there and the last one is the same"""
+        if self.docs > len(history):
+            return False
+        return self.docs == 0 or fingerprint(history[self.docs - 1]) == self.last
+
+    def catch_up(self, history):
+        """Index messages saved after the index. Returns False if index does not match history"""
+        if not self.matches(history):
+            return False
+        for entry in history[self.docs:]:
+            self.add(entry)
+        return True
+
+    def search(self, query, end, count):
+        """Positions of up to `count` messages before `end` that match query best, best first"""
+        if end <= 0 or self.docs == 0:
+            return []
+        average = self.total / self.docs or 1.0
+        lengths = self.lengths
+        found = []
+        for word in set(words(query)):
+            posting = self.postings.get(word)
+            if posting is not None:
+                stop = bisect_left(posting[0], end)
+                if stop:
+                    found.append((stop, posting))
+        # Rarest words weigh most, common ones barely change the ranking
+        found.sort(key=operator.itemgetter(0))
+        scores = {}
+        for stop, (positions, counts) in found[:QUERY_WORDS]:
+            weight = math.log(1 + (end - stop + 0.5) / (stop + 0.5)) * (K1 + 1)
+            # Word in more than RECALL_CANDIDATES messages scores its newest ones only
+            for number in range(max(0, stop - RECALL_CANDIDATES), stop):
+                position = positions[number]
+                tf = counts[number]
+                scores[position] = scores.get(position, 0.0) + weight * tf / (
+                    tf + K1 * (1 - B + B * lengths[position] / average))
+        return heapq.nlargest(count, scores, key=scores.get)
+
+    def encode(self):
+        """Compact binary form of index"""
+        words_list = list(self.postings)
+        sizes = array('I', (len(self.postings[word][0]) for word in words_list))
+        deltas = array('I')
+        counts = array('H')
+        for word in words_list:
+            positions, occurrences = self.postings[word]
+            deltas.append(positions[0])
+            deltas.extend(map(operator.sub, positions[1:], positions[:-1]))
+            counts.extend(occurrences)
+        names = "\n".join(words_list).encode("utf-8")
+        sections = [names, self.lengths.tobytes(), sizes.tobytes(), deltas.tobytes(), counts.tobytes()]
+        header = HEADER.pack(self.last, self.docs, *(len(section) for section in sections))
+        # Fastest level: file is a third of history text already, rewrite time matters more
+        return MAGIC + zlib.compress(header + b"".join(sections), 1)
+
+    @classmethod
+    def decode(cls, path, data):
+        """Index from encode() output. Raises ValueError if data is damaged"""
+        if not data.startswith(MAGIC):
+            raise ValueError("not a recall index")
+        try:
+            raw = zlib.decompress(data[len(MAGIC):])
+            last, docs, *lengths = HEADER.unpack_from(raw)
+        except (zlib.error, struct.error) as err:
+            raise ValueError(str(err)) from None
+        sections = []
+        offset = HEADER.size
+        for length in lengths:
+            sections.append(raw[offset:offset + length])
+            offset += length
+        index = cls(path)
+        words_list = sections[0].decode("utf-8").split("\n") if sections[0] else []
+        index.lengths.frombytes(sections[1])
+        if index.docs != docs:
+            raise ValueError(f"recall index has {index.docs} messages, header says {docs}")
+        sizes = array('I', sections[2])
+        deltas = array('I', sections[3])
+        counts = array('H', sections[4])
+        if len(sizes) != len(words_list) or sum(sizes) != len(deltas) or len(deltas) != len(counts):
+            raise ValueError("recall index sections do not match")
+        start = 0
+        for word, size in zip(words_list, sizes):
+            stop = start + size
+            index.postings[word] = (array('I', accumulate(deltas[start:stop])), counts[start:stop])
+            start = stop
+        index.total = sum(index.lengths)
+        index.entries = len(deltas)
+        index.last = last
+        index.unsaved = 0
+        return index
+
+    def save(self):
+        """Write index to its file, replaced atomically"""
+        data = self.encode()
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as index_file:
+            index_file.write(data)
+        os.replace(temp_path, self.path)
+        self.unsaved = 0
+        metrics.count(metrics.STORAGE_BYTES, len(data), "storage_bytes", kind="recall")
+
+
+def read_index(path):
+    """Index from file, None if it is missing or damaged"""
+    try:
+        with open(path, "rb") as index_file:
+            return HistoryIndex.decode(path, index_file.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as err:
+        log.warning("Recall index %s is damaged, rebuilding it: %s", path, err)
+        return None
+
+
+def write(str_id, index):
+    """Save index, caller holds its lock"""
+    try:
+        index.save()
+    except OSError as err:
+        # Not lost, messages are indexed from history on next load
+        log.warning("Failed to write recall index of chat %s: %s", str_id, err)
+
+
+def flush(str_id, index):
+    """Write index with unsaved messages, in background or when index leaves memory"""
+    with index.lock:
+        index.saving = False
+        if index.unsaved and not index.removed:
+            write(str_id, index)
+
+
+def save_later(str_id, index):
+    """Queue write of index if enough messages were added since the last one, caller holds its lock"""
+    # Every write costs the whole index, so big indexes are written less often
+    if index.saving or index.unsaved < max(RECALL_FLUSH_EVERY, index.docs // 10):
+        return
+    index.saving = True
+    writer.submit(flush, str_id, index)
+
+
+indexes = LRUCache(max_bytes=RECALL_INDEX_BYTES, sizeof=HistoryIndex.size, on_evict=flush)
+load_lock = threading.Lock()
+writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recall")
+
+
+def get_index(str_id, path, history):
+    """Index of chat covering whole history, loaded or built on first use"""
+    index = indexes.get(str_id)
+    if index is None:
+        with load_lock:
+            index = indexes.get(str_id)
+            if index is None:
+                index = read_index(path) or HistoryIndex(path)
+                indexes[str_id] = index
+    with index.lock:
+        if not index.catch_up(history):
+            log.info("Recall index of chat %s does not match history, rebuilding", str_id)
+            index.clear()
+            index.catch_up(history)
+        save_later(str_id, index)
+    indexes.resize(str_id)
+    return index
+
+
+def search(str_id, path, history, query, end, count=RECALL_TOP_K):
+    """Positions of up to `count` messages before `end` that match query best, best first"""
+    index = get_index(str_id, path, history)
+    with index.lock:
+        return index.search(query, end, count)
+
+
+def add(str_id, history):
+    """Index newest message of history if index of chat is loaded, otherwise it is indexed on load"""
+    index = indexes.get(str_id)
+    if index is None:
+        return
+    with index.lock:
+        if index.docs != len(history) - 1:
+            # Missed a change, catch up on next search
+            return
+        index.add(history[-1])
+        save_later(str_id, index)
+    indexes.resize(str_id)
+
+
+def truncate(str_id, path, history):
+    """History was rolled back to `history`, drop removed messages from index"""
+    index = indexes.get(str_id)
+    if index is None:
+        # Index file is fixed right away: messages saved later could take the
+        # places of removed ones and match checksum of the last indexed one
+        with load_lock:
+            index = indexes.get(str_id) or read_index(path)
+            if index is None:
+                return
+            indexes[str_id] = index
+    with index.lock:
+        if index.docs > len(history):
+            index.truncate(len(history), history)
+            write(str_id, index)
+    indexes.resize(str_id)
+
+
+def remove(str_id, path):
+    """Forget index of chat, history was reset"""
+    index = indexes.pop(str_id)
+    if index is not None:
+        with index.lock:
+            index.removed = True
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,304 @@
+"""Outbound Telegram messages: rate limits, long texts and retries
+
+Bot API allows about 30 messages per second in total, one per second in a chat
+and 20 per minute in a group. Every send waits for a token of its chat and then
+of the whole bot, so bursts are queued instead of failing with 429. A 429 that
+comes anyway holds back the chat for retry_after seconds and the send is made
+again, like sends that failed to connect or got a 5xx.
+
+Texts over one message are split at paragraph, line or word boundaries, a code
+block that is cut is closed and opened again. Markdown Telegram can not parse
+is sent as plain text. Chat action repeated while the previous one is still
+shown, or while sends of the chat are queued, is skipped.
+"""
+import re
+import time
+import random
+import asyncio
+import requests
+from decouple import config
+from telebot import apihelper
+
+from common import MAX_MESSAGE_LENGTH
+from utils import metrics
+from utils.cache import LRUCache
+from utils.log import get_logger
+from utils.ratelimit import TokenBucket
+
+# Messages per minute: whole bot, one private chat, one group. 0 disables the limit
+TELEGRAM_SENDS_PER_MINUTE = config("TELEGRAM_SENDS_PER_MINUTE", default=1800, cast=int)
+TELEGRAM_CHAT_SENDS_PER_MINUTE = config("TELEGRAM_CHAT_SENDS_PER_MINUTE", default=60, cast=int)
+TELEGRAM_GROUP_SENDS_PER_MINUTE = config("TELEGRAM_GROUP_SENDS_PER_MINUTE", default=20, cast=int)
+TELEGRAM_MAX_RETRIES = config("TELEGRAM_MAX_RETRIES", default=5, cast=int)
+TELEGRAM_BACKOFF_BASE = config("TELEGRAM_BACKOFF_BASE", default=0.5, cast=float)
+TELEGRAM_BACKOFF_MAX = config("TELEGRAM_BACKOFF_MAX", default=10.0, cast=float)
+# Longest retry_after that is waited out, send fails on a longer flood wait
+TELEGRAM_MAX_RETRY_AFTER = config("TELEGRAM_MAX_RETRY_AFTER", default=60, cast=int)
+# Messages a chat can get at once before the per minute rate applies
+CHAT_BURST = 3
+# Seconds Telegram shows chat action, or until the next message of the bot
+CHAT_ACTION_SECONDS = 5
+FENCE = "```"
+# Language of code block that is opened again, longer info strings are not kept
+FENCE_LANGUAGE = re.compile(r"```([\w+#.-]{1,32})(?:\s|$)")
+
+log = get_logger("sender")
+
+
+def split_point(text, limit):
+    """Index to cut text at: last paragraph, line, sentence or word break before limit"""
+    for separator in ("\n\n", "\n", ". ", " "):
+        cut = text.rfind(separator, 0, limit)
+        # Cut too close to the start makes many tiny messages, try finer separator
+        if cut >= limit // 2:
+            return cut + len(separator)
+    return limit
+
+
+def open_fence(fence, part):
+    """Code block still open after part: backticks with its language to open it again, or None"""
+    for line in part.split("\n"):
+        if line.count(FENCE) % 2:
+            language = FENCE_LANGUAGE.match(line.strip())
+            fence = None if fence else (language.group(0).rstrip() if language else FENCE)
+    return fence
+
+
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    """Parts of text, each fits into one message"""
+    parts = []
+    fence = None
+    while text:
+        prefix = fence + "\n" if fence else ""
+        if len(prefix) > limit // 4:
+            # Language is dropped rather than leave little room for the text
+            prefix = FENCE + "\n"
+        if len(prefix) + len(text) <= limit:
+            parts.append(prefix + text)
+            break
+        # Room for the fence that closes code block cut in two
+        cut = split_point(text, max(1, limit - len(prefix) - len(FENCE) - 1))
+        chunk, text = text[:cut].rstrip("\n"), text[cut:]
+        fence = open_fence(fence, chunk)
+        parts.append(prefix + chunk + ("\n" + FENCE if fence else ""))
+    return parts
+
+
+def is_parse_error(error):
+    """Telegram could not parse Markdown of message"""
+    return getattr(error, "error_code", None) == 400 and "can't parse entities" in error.description
+
+
+def is_not_modified(error):
+    """Edit did not change message, it already shows the text"""
+    return getattr(error, "error_code", None) == 400 and "message is not modified" in error.description
+
+
+class BaseSender:
+    """Rate limits and retry policy shared by sync and async senders"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.bucket = TokenBucket(TELEGRAM_SENDS_PER_MINUTE, max(1, TELEGRAM_SENDS_PER_MINUTE // 60))
+        self.chat_buckets = LRUCache(max_items=10000)
+        self.actions = LRUCache(max_items=10000)
+
+    def chat_bucket(self, chat_id):
+        """Token bucket of chat, groups have negative ids and lower limit"""
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            per_minute = TELEGRAM_GROUP_SENDS_PER_MINUTE if int(chat_id) < 0 else TELEGRAM_CHAT_SENDS_PER_MINUTE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(per_minute, min(CHAT_BURST, per_minute))
+        return bucket
+
+    def action_due(self, chat_id, action):
+        """Action should be sent: it is not shown already and nothing waits to be sent to chat"""
+        now = time.monotonic()
+        last = self.actions.get(chat_id)
+        if last is not None and last[0] == action and now - last[1] < CHAT_ACTION_SECONDS:
+            return False
+        if self.chat_bucket(chat_id).available() < 1:
+            return False
+        self.actions[chat_id] = (action, now)
+        return True
+
+    def sent(self, chat_id, method, waited):
+        """Account successful call, message of the bot ends chat action"""
+        metrics.TELEGRAM_REQUESTS.inc(method=method, status="ok")
+        metrics.SEND_WAIT_SECONDS.observe(waited)
+        self.actions.pop(chat_id)
+
+    def retry_delay(self, chat_id, method, error, attempt):
+        """Seconds to wait before calling again after error, None if it must be raised"""
+        code = getattr(error, "error_code", None)
+        metrics.TELEGRAM_REQUESTS.inc(method=method, status=code or "error")
+        if attempt >= TELEGRAM_MAX_RETRIES:
+            return None
+        if code == 429:
+            retry_after = error.result_json.get("parameters", {}).get("retry_after", 1)
+            if retry_after > TELEGRAM_MAX_RETRY_AFTER:
+                return None
+            # Other sends to the chat wait in its bucket too
+            self.chat_bucket(chat_id).pause(retry_after)
+            wait = 0.0
+        elif (code is not None and code >= 500) or self.is_connection_error(error):
+            wait = random.uniform(0, min(TELEGRAM_BACKOFF_MAX, TELEGRAM_BACKOFF_BASE * 2 ** attempt))
+        else:
+            return None
+        log.warning("%s in chat %s failed: %s, retry %s/%s", method, chat_id, error, attempt + 1, TELEGRAM_MAX_RETRIES)
+        return wait
+
+    def is_connection_error(self, error):
+        """Request did not reach Telegram, sending again can not duplicate message"""
+        return isinstance(error, requests.ConnectionError)
+
+
+class Sender(BaseSender):
+    """Sends of TeleBot through rate limits and retries, callers wait for their turn"""
+
+    def call(self, chat_id, function, *args, **kwargs):
+        """Call Bot API method for chat when limits allow, retrying flood waits and temporary failures"""
+        method = function.__name__
+        attempt = 0
+        waited = 0.0
+        while True:
+            waited += self.chat_bucket(chat_id).acquire()
+            waited += self.bucket.acquire()
+            try:
+                result = function(*args, **kwargs)
+            except (apihelper.ApiTelegramException, requests.ConnectionError) as error:
+                wait = self.retry_delay(chat_id, method, error, attempt)
+                if wait is None:
+                    raise
+                attempt += 1
+                time.sleep(wait)
+                continue
+            self.sent(chat_id, method, waited)
+            return result
+
+    def send(self, chat_id, text, parse_mode=None, reply_to=None):
+        """Send text in as many messages as needed, the first one replies to reply_to. Returns the last one"""
+        sent = None
+        for part in split_message(text):
+            if reply_to is not None and sent is None:
+                function, args = self.bot.reply_to, (reply_to, part)
+            else:
+                function, args = self.bot.send_message, (chat_id, part)
+            try:
+                sent = self.call(chat_id, function, *args, parse_mode=parse_mode)
+            except apihelper.ApiTelegramException as error:
+                if parse_mode is None or not is_parse_error(error):
+                    raise
+                log.warning("Markdown error: %s", error)
+                sent = self.call(chat_id, function, *args)
+        return sent
+
+    def reply(self, message, text, parse_mode=None):
+        """Reply to message, long text continues in next messages"""
+        return self.send(message.chat.id, text, parse_mode, reply_to=message)
+
+    def edit(self, text, chat_id, message_id, final=True):
+        """Replace text of message. Intermediate edit is skipped when chat has no free token
+        or fails, returns False then"""
+        if not final and self.chat_bucket(chat_id).available() < 1:
+            return False
+        try:
+            self.call(chat_id, self.bot.edit_message_text, text, chat_id, message_id)
+        except apihelper.ApiTelegramException as error:
+            if is_not_modified(error):
+                return True
+            if final:
+                raise
+            log.warning("Stream edit failed > %s", error)
+            return False
+        return True
+
+    def action(self, chat_id, action="typing"):
+        """Show chat action unless it is redundant. Failure is only logged"""
+        if not self.action_due(chat_id, action):
+            return
+        try:
+            self.bot.send_chat_action(chat_id, action)
+        except (apihelper.ApiException, requests.RequestException) as error:
+            log.debug("Chat action in %s failed: %s", chat_id, error)
+
+
+class AsyncSender(BaseSender):
+    """Sends of AsyncTeleBot through rate limits and retries, callers wait for their turn"""
+
+    def is_connection_error(self, error):
+        """Request did not reach Telegram, sending again can not duplicate message"""
+        # aiohttp is imported by async mode only, sync bot starts without it
+        import aiohttp
+        from telebot import asyncio_helper
+        return isinstance(error, asyncio_helper.RequestTimeout) and isinstance(error.__cause__, aiohttp.ClientConnectorError)
+
+    async def call(self, chat_id, function, *args, **kwargs):
+        """Call Bot API method for chat when limits allow, retrying flood waits and temporary failures"""
+        from telebot import asyncio_helper
+        method = function.__name__
+        attempt = 0
+        waited = 0.0
+        while True:
+            waited += await self.chat_bucket(chat_id).aacquire()
+            waited += await self.bucket.aacquire()
+            try:
+                result = await function(*args, **kwargs)
+            except (asyncio_helper.ApiTelegramException, asyncio_helper.RequestTimeout) as error:
+                wait = self.retry_delay(chat_id, method, error, attempt)
+                if wait is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(wait)
+                continue
+            self.sent(chat_id, method, waited)
+            return result
+
+    async def send(self, chat_id, text, parse_mode=None, reply_to=None):
+        """Send text in as many messages as needed, the first one replies to reply_to. Returns the last one"""
+        from telebot import asyncio_helper
+        sent = None
+        for part in split_message(text):
+            if reply_to is not None and sent is None:
+                function, args = self.bot.reply_to, (reply_to, part)
+            else:
+                function, args = self.bot.send_message, (chat_id, part)
+            try:
+                sent = await self.call(chat_id, function, *args, parse_mode=parse_mode)
+            except asyncio_helper.ApiTelegramException as error:
+                if parse_mode is None or not is_parse_error(error):
+                    raise
+                log.warning("Markdown error: %s", error)
+                sent = await self.call(chat_id, function, *args)
+        return sent
+
+    async def reply(self, message, text, parse_mode=None):
+        """Reply to message, long text continues in next messages"""
+        return await self.send(message.chat.id, text, parse_mode, reply_to=message)
+
+    async def edit(self, text, chat_id, message_id, final=True):
+        """Replace text of message. Intermediate edit is skipped when chat has no free token
+        or fails, returns False then"""
+        from telebot import asyncio_helper
+        if not final and self.chat_bucket(chat_id).available() < 1:
+            return False
+        try:
+            await self.call(chat_id, self.bot.edit_message_text, text, chat_id, message_id)
+        except asyncio_helper.ApiTelegramException as error:
+            if is_not_modified(error):
+                return True
+            if final:
+                raise
+            log.warning("Stream edit failed > %s", error)
+            return False
+        return True
+
+    async def action(self, chat_id, action="typing"):
+        """Show chat action unless it is redundant. Failure is only logged"""
+        from telebot import asyncio_helper
+        if not self.action_due(chat_id, action):
+            return
+        try:
+            await self.bot.send_chat_action(chat_id, action)
+        except (asyncio_helper.ApiException, asyncio_helper.RequestTimeout) as error:
+            log.debug("Chat action in %s failed: %s", chat_id, error)
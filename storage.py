@@ -0,0 +1,345 @@
+"""Storage backends for conversation history
+
+json    - full snapshot of chat in logs/new_<chat_id>.json, rewritten on every change
+journal - snapshot plus append-only logs/new_<chat_id>.jsonl journal of changes,
+          compacted back into the snapshot every JOURNAL_COMPACT_EVERY records
+
+Storage directory is locked by the process using it. With several shards every
+shard owns logs/shards/<index>/, chats are assigned to shards by hash of chat id.
+"""
+import os
+import re
+import json
+import time
+import zlib
+import atexit
+import threading
+from decouple import config
+
+from utils import metrics
+from utils.log import get_logger
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on Windows, directories are not locked there
+    fcntl = None
+
+STORAGE_BACKEND = config("STORAGE_BACKEND", default="json")
+# Records in journal before it is folded into snapshot
+JOURNAL_COMPACT_EVERY = config("JOURNAL_COMPACT_EVERY", default=500, cast=int)
+# Journal is written to OS on every record, fsync is batched by count or time
+JOURNAL_FSYNC_EVERY = config("JOURNAL_FSYNC_EVERY", default=50, cast=int)
+JOURNAL_FSYNC_INTERVAL = config("JOURNAL_FSYNC_INTERVAL", default=1.0, cast=float)
+SHARDS_DIR = "shards"
+LAYOUT_FILE = "layout.json"
+# Snapshot and journal of chat
+CHAT_FILE = re.compile(r"^new_(-?\d+)\.jsonl?$")
+# Every file of chat, moved together between shards
+SHARD_FILE = re.compile(r"^(?:new|recall)_(-?\d+)\.(?:jsonl?|idx)$")
+
+log = get_logger("storage")
+
+
+def atomic_write_json(path, data):
+    """Write json to temp file and move it over target, so readers never see partial file.
+    Returns number of bytes written"""
+    tmp_path = f"{path}.tmp"
+    encoded = json.dumps(data, indent=4, ensure_ascii=False).encode("utf-8")
+    with open(tmp_path, "wb") as content:
+        content.write(encoded)
+        content.flush()
+        os.fsync(content.fileno())
+    os.replace(tmp_path, path)
+    return len(encoded)
+
+
+def lock_directory(log_dir):
+    """Take exclusive lock of storage directory, held while returned file is open"""
+    os.makedirs(log_dir, exist_ok=True)
+    lock_file = open(os.path.join(log_dir, ".lock"), "w", encoding="utf-8")
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise RuntimeError(f"{log_dir} is used by another bot process") from None
+    return lock_file
+
+
+def shard_of(chat_id, count):
+    """Shard owning chat: crc32 of chat id split into `count` equal ranges"""
+    return (zlib.crc32(str(chat_id).encode()) * count) >> 32
+
+
+def shard_dir(log_dir, index, count):
+    """Storage directory of shard, single shard uses log_dir itself"""
+    if count == 1:
+        return log_dir
+    return os.path.join(log_dir, SHARDS_DIR, str(index))
+
+
+def read_layout(log_dir):
+    """Number of shards chat files are laid out for"""
+    path = os.path.join(log_dir, LAYOUT_FILE)
+    if not os.path.exists(path):
+        return 1
+    with open(path, "r", encoding="utf-8") as content:
+        return json.load(content)["shards"]
+
+
+def rebalance_shards(log_dir, count):
+    """Move chat files into directories of shards that own them for `count` shards.
+    Caller must hold lock of log_dir, shard directories are locked here, so no
+    shard process can be running. Returns number of moved files"""
+    shards_path = os.path.join(log_dir, SHARDS_DIR)
+    sources = [log_dir]
+    if os.path.isdir(shards_path):
+        sources += [os.path.join(shards_path, name) for name in sorted(os.listdir(shards_path))]
+    locks = [lock_directory(source) for source in sources[1:]]
+    moved = 0
+    try:
+        # Every file is checked, so a rebalance interrupted half way is finished by the next one
+        for source in sources:
+            for name in os.listdir(source):
+                match = SHARD_FILE.match(name)
+                if match is None:
+                    continue
+                target = shard_dir(log_dir, shard_of(match.group(1), count), count)
+                if os.path.abspath(source) == os.path.abspath(target):
+                    continue
+                os.makedirs(target, exist_ok=True)
+                os.replace(os.path.join(source, name), os.path.join(target, name))
+                moved += 1
+        if moved or read_layout(log_dir) != count:
+            atomic_write_json(os.path.join(log_dir, LAYOUT_FILE), {"shards": count})
+            log.info("Rebalanced chats to %s shard(s), moved %s file(s)", count, moved)
+    finally:
+        for lock in locks:
+            lock.close()
+    return moved
+
+
+def apply_record(chat, record):
+    """Apply journal record to chat state"""
+    operation = record['op']
+    if operation == 'append':
+        chat['history'].append(record['entry'])
+    elif operation == 'member':
+        chat['members'][str(record['member']['id'])] = record['member']
+    elif operation == 'settings':
+        chat.setdefault('settings', {})[record['key']] = record['value']
+    elif operation == 'title':
+        chat['title'] = record['title']
+        chat['source_title'] = record['source_title']
+    elif operation == 'seen':
+        chat.setdefault('seen', []).append(record['id'])
+    elif operation == 'unseen':
+        if record['id'] in chat.get('seen', []):
+            chat['seen'].remove(record['id'])
+    elif operation == 'summary':
+        chat['summary'] = record['summary']
+    elif operation == 'reset':
+        chat['history'] = []
+        chat.pop('summary', None)
+    elif operation == 'rollback':
+        chat['history'] = chat['history'][:-record['count']]
+        if 'summary' in chat and chat['summary']['covered'] > len(chat['history']):
+            del chat['summary']
+    else:
+        log.warning("Unknown journal record %s, skipped", operation)
+
+
+class JsonStorage:
+    """Full snapshot per chat"""
+    append_only = False
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.lock = threading.RLock()
+        # Two processes writing the same chat files would lose history
+        self.dir_lock = lock_directory(log_dir)
+
+    def get_file_path(self, chat_id):
+        """Get snapshot path for chat"""
+        return os.path.join(self.log_dir, f"new_{str(chat_id)}.json")
+
+    def get_index_path(self, chat_id):
+        """Get path of recall index of chat, see recall.py"""
+        return os.path.join(self.log_dir, f"recall_{str(chat_id)}.idx")
+
+    def load(self, chat_id):
+        """Load chat from snapshot, None if chat is unknown"""
+        path = self.get_file_path(chat_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as content:
+            return json.load(content)
+
+    def chat_ids(self):
+        """Ids of chats that have files in storage directory"""
+        ids = set()
+        for name in os.listdir(self.log_dir):
+            match = CHAT_FILE.match(name)
+            if match:
+                ids.add(match.group(1))
+        return sorted(ids)
+
+    def save(self, chat_id, chat):
+        """Write full snapshot of chat"""
+        with self.lock:
+            written = atomic_write_json(self.get_file_path(chat_id), chat)
+        metrics.count(metrics.STORAGE_BYTES, written, "storage_bytes", kind="snapshot")
+
+    def append(self, chat_id, record, chat):
+        """Persist single change. Without journal it is a full snapshot"""
+        self.save(chat_id, chat)
+
+    def flush(self):
+        """Make sure everything written reached the disk"""
+
+    def close(self, chat_id):
+        """Release resources held for chat"""
+
+
+class JournalStorage(JsonStorage):
+    """Snapshot plus append-only journal per chat.
+
+    Every record carries increasing `seq`, snapshot stores `seq` of last folded record.
+    Compaction writes snapshot first and truncates journal after, so a crash in
+    between only leaves records that are skipped on replay.
+    """
+    append_only = True
+
+    def __init__(self, log_dir):
+        super().__init__(log_dir)
+        self.files = {}
+        self.seq = {}
+        self.pending = {}
+        self.unsynced = set()
+        self.unsynced_count = 0
+        self.last_sync = time.monotonic()
+        atexit.register(self.flush)
+
+    def get_journal_path(self, chat_id):
+        """Get journal path for chat"""
+        return os.path.join(self.log_dir, f"new_{str(chat_id)}.jsonl")
+
+    def load(self, chat_id):
+        """Load snapshot and replay journal on top of it"""
+        str_id = str(chat_id)
+        with self.lock:
+            chat = super().load(str_id)
+            seq = chat.get('seq', 0) if chat is not None else 0
+            replayed = 0
+            path = self.get_journal_path(str_id)
+            if os.path.exists(path):
+                with open(path, "rb") as journal:
+                    good_offset = 0
+                    for line in journal:
+                        try:
+                            record = json.loads(line.decode("utf-8"))
+                        except ValueError:
+                            # Torn write from a crash, drop it and everything after
+                            log.warning("Truncating damaged journal %s at %s", path, good_offset)
+                            os.truncate(path, good_offset)
+                            break
+                        good_offset += len(line)
+                        if record['seq'] <= seq:
+                            continue
+                        if chat is None:
+                            log.warning("Journal %s has no snapshot, skipped", path)
+                            break
+                        apply_record(chat, record)
+                        seq = record['seq']
+                        replayed += 1
+            self.seq[str_id] = seq
+            self.pending[str_id] = replayed
+            return chat
+
+    def save(self, chat_id, chat):
+        """Write snapshot and start empty journal (compaction)"""
+        str_id = str(chat_id)
+        with self.lock:
+            self.restore_counters(str_id)
+            chat['seq'] = self.seq[str_id]
+            super().save(str_id, chat)
+            self.close_journal(str_id)
+            path = self.get_journal_path(str_id)
+            if os.path.exists(path):
+                os.truncate(path, 0)
+            self.pending[str_id] = 0
+
+    def append(self, chat_id, record, chat):
+        """Append record to journal, compact when journal grows too long"""
+        str_id = str(chat_id)
+        with self.lock:
+            self.restore_counters(str_id)
+            self.seq[str_id] += 1
+            line = json.dumps({"seq": self.seq[str_id], **record}, ensure_ascii=False) + "\n"
+            journal = self.get_journal(str_id)
+            encoded = line.encode("utf-8")
+            journal.write(encoded)
+            journal.flush()
+            metrics.count(metrics.STORAGE_BYTES, len(encoded), "storage_bytes", kind="journal")
+            self.pending[str_id] += 1
+            if self.pending[str_id] >= JOURNAL_COMPACT_EVERY:
+                log.debug("Compacting journal for chat %s", str_id)
+                self.save(str_id, chat)
+                return
+            self.unsynced.add(str_id)
+            self.unsynced_count += 1
+            if self.unsynced_count >= JOURNAL_FSYNC_EVERY or time.monotonic() - self.last_sync >= JOURNAL_FSYNC_INTERVAL:
+                self.flush()
+
+    def restore_counters(self, str_id):
+        """Read seq of chat back from files after close, so numbering goes on
+        after records already written instead of restarting below snapshot seq"""
+        if str_id not in self.seq:
+            self.load(str_id)
+
+    def get_journal(self, str_id):
+        """Get open journal file for chat"""
+        if str_id not in self.files:
+            self.files[str_id] = open(self.get_journal_path(str_id), "ab")
+        return self.files[str_id]
+
+    def flush(self):
+        """fsync all journals written since last sync"""
+        with self.lock:
+            for str_id in self.unsynced:
+                if str_id in self.files:
+                    os.fsync(self.files[str_id].fileno())
+            self.unsynced.clear()
+            self.unsynced_count = 0
+            self.last_sync = time.monotonic()
+
+    def close_journal(self, str_id):
+        """Sync and close journal file of chat"""
+        journal = self.files.pop(str_id, None)
+        if journal is not None:
+            journal.flush()
+            os.fsync(journal.fileno())
+            journal.close()
+        self.unsynced.discard(str_id)
+
+    def close(self, chat_id):
+        """Close journal and forget counters, they are restored from files on next use"""
+        str_id = str(chat_id)
+        with self.lock:
+            self.close_journal(str_id)
+            self.seq.pop(str_id, None)
+            self.pending.pop(str_id, None)
+
+
+BACKENDS = {
+    "json": JsonStorage,
+    "journal": JournalStorage,
+}
+
+def create_storage(log_dir, backend=STORAGE_BACKEND):
+    """Create storage backend by name"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown storage backend {backend}, available: {', '.join(BACKENDS)}")
+    log.info("Using %s storage in %s", backend, log_dir)
+    return BACKENDS[backend](log_dir)
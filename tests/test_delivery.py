@@ -0,0 +1,119 @@
+"""Telegram messages are handled once: duplicates wait for the first delivery, failed ones are forgotten"""
+import threading
+from types import SimpleNamespace
+import pytest
+
+import conv
+from common import InFlight
+from storage import create_storage
+from utils.cache import LRUCache
+from utils.models import ModelProfile
+
+CHAT_ID = 42
+AUTHOR = SimpleNamespace(id=1, first_name="Ann", last_name=None, username="ann")
+
+
+def new_cache():
+    """Empty chat state cache like conv creates"""
+    return LRUCache(max_items=10, sizeof=conv.chat_size, on_evict=conv.evict_chat)
+
+
+def message(message_id):
+    """Telegram message of the test chat"""
+    return SimpleNamespace(chat=SimpleNamespace(id=CHAT_ID), message_id=message_id)
+
+
+@pytest.fixture(params=["json", "journal"])
+def chat(request, tmp_path, monkeypatch):
+    """Initialized private chat in storage of tmp_path"""
+    backend = create_storage(str(tmp_path), request.param)
+    monkeypatch.setattr(conv, "STORAGE", backend)
+    monkeypatch.setattr(conv, "conversation_history", new_cache())
+    monkeypatch.setattr(ModelProfile, "count", lambda self, text: len(text.split()))
+    conv.init(CHAT_ID, None, "private", AUTHOR)
+    yield
+    conv.STORAGE.flush()
+    conv.STORAGE.dir_lock.close()
+
+
+def restart(monkeypatch):
+    """Chat of a restarted bot, loaded back from files"""
+    old = conv.STORAGE
+    old.flush()
+    for str_id in list(getattr(old, "files", {})):
+        old.close(str_id)
+    old.dir_lock.close()
+    monkeypatch.setattr(conv, "STORAGE", create_storage(old.log_dir, "journal" if old.append_only else "json"))
+    monkeypatch.setattr(conv, "conversation_history", new_cache())
+    return conv.get_chat(str(CHAT_ID))
+
+
+def test_failed_message_is_handled_again(chat, monkeypatch):
+    assert conv.first_delivery(CHAT_ID, 7)
+    conv.save_question(CHAT_ID, "question", AUTHOR, 7)
+    conv.forget_delivery(CHAT_ID, 7)
+    loaded = restart(monkeypatch)
+    # Unanswered question is withdrawn with the seen id
+    assert loaded["history"] == []
+    assert conv.first_delivery(CHAT_ID, 7)
+    assert conv.save_question(CHAT_ID, "question", AUTHOR, 7)
+
+
+def test_answered_message_is_not_withdrawn(chat):
+    assert conv.first_delivery(CHAT_ID, 7)
+    conv.save_question(CHAT_ID, "question", AUTHOR, 7)
+    conv.save_response(CHAT_ID, "answer")
+    conv.forget_delivery(CHAT_ID, 7)
+    assert len(conv.get_chat(str(CHAT_ID))["history"]) == 2
+
+
+def test_handled_message_is_skipped(chat, monkeypatch):
+    inflight = InFlight()
+    with inflight.once(message(7)) as first:
+        assert first
+        # Snapshot storage keeps seen ids with the next change of the chat
+        conv.save_question(CHAT_ID, "question", AUTHOR, 7)
+    restart(monkeypatch)
+    with inflight.once(message(7)) as first:
+        assert not first
+
+
+def test_exception_forgets_message(chat):
+    inflight = InFlight()
+    with pytest.raises(RuntimeError):
+        with inflight.once(message(7)) as first:
+            assert first
+            raise RuntimeError("Telegram is down")
+    with inflight.once(message(7)) as first:
+        assert first
+
+
+def test_duplicate_waits_for_first_delivery(chat):
+    inflight = InFlight()
+    started, release = threading.Event(), threading.Event()
+    results = []
+
+    def handle(fail):
+        try:
+            with inflight.once(message(7)) as first:
+                results.append(first)
+                started.set()
+                release.wait(5)
+                if fail:
+                    raise RuntimeError("OpenAI is down")
+        except RuntimeError:
+            pass
+
+    first = threading.Thread(target=handle, args=(True,))
+    first.start()
+    started.wait(5)
+    duplicate = threading.Thread(target=handle, args=(False,))
+    duplicate.start()
+    duplicate.join(0.2)
+    # Duplicate is not dropped while the first one runs
+    assert duplicate.is_alive() and results == [True]
+    release.set()
+    first.join(5)
+    duplicate.join(5)
+    # First delivery failed, so the duplicate handles the message
+    assert results == [True, True]
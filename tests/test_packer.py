@@ -0,0 +1,46 @@
+"""Cutting text to token limit at sentence boundary"""
+import pytest
+
+from utils import packer
+
+
+class ByteEncoder:
+    """Worst case of byte-level BPE: every UTF-8 byte is a token"""
+
+    def encode(self, text):
+        return list(text.encode("utf-8"))
+
+    def decode(self, tokens):
+        return bytes(tokens).decode("utf-8", errors="ignore")
+
+
+class ByteModel:
+    encoder = ByteEncoder()
+
+    def count(self, text):
+        return len(self.encoder.encode(text))
+
+
+@pytest.fixture(autouse=True)
+def byte_tokens(monkeypatch):
+    monkeypatch.setattr(packer, "get_model", lambda model: ByteModel())
+
+
+@pytest.mark.parametrize("text", ["Привет. Как дела?", "你好。 世界很大。", "🙂🙂. 🙃🙃🙃!"])
+def test_non_latin_text_fits_limit(text):
+    # Fewer characters than the limit, more tokens than it
+    limit = len(text) + 2
+    assert len(ByteEncoder().encode(text)) > limit
+    truncated = packer.truncate_sentences(text, limit)
+    assert truncated
+    assert len(ByteEncoder().encode(truncated)) <= limit
+    assert text.startswith(truncated)
+
+
+def test_short_text_is_kept():
+    assert packer.truncate_sentences("Привет.", 20) == "Привет."
+
+
+def test_first_sentence_too_long_is_cut_by_tokens():
+    truncated = packer.truncate_sentences("Очень длинное предложение без точки", 10)
+    assert truncated == "Очень"
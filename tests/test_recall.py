@@ -0,0 +1,95 @@
+"""Recall index: BM25 ranking, index file round trip and rebuild when history changed under it"""
+import zlib
+import pytest
+
+import recall
+from recall import HistoryIndex, read_index
+from utils.cache import LRUCache
+
+CHAT_ID = "42"
+
+
+def entry(text, role="user"):
+    """History entry with text"""
+    return {"role": role, "content": text}
+
+
+def build(history, path="unused.idx"):
+    """Index of whole history"""
+    index = HistoryIndex(path)
+    index.catch_up(history)
+    return index
+
+
+@pytest.fixture
+def loaded(monkeypatch):
+    """No indexes in memory, so every test reads its own file"""
+    indexes = LRUCache(max_bytes=recall.RECALL_INDEX_BYTES, sizeof=HistoryIndex.size, on_evict=recall.flush)
+    monkeypatch.setattr(recall, "indexes", indexes)
+    return indexes
+
+
+def test_rare_and_repeated_words_rank_first():
+    history = [
+        entry("weather is nice today"),
+        entry("my cat likes the weather"),
+        entry("cat food cat toys cat tree"),
+        entry("system prompt mentions cat", role="system"),
+        entry("#7: dog walks in the weather"),
+    ]
+    index = build(history)
+    # Three cats in a short message beat one, system message is not a match
+    assert index.search("cat", len(history), 5) == [2, 1]
+    # "dog" is rarer than "weather", author prefix is not a word
+    assert index.search("dog weather", len(history), 2)[0] == 4
+    assert index.search("#7", len(history), 5) == []
+    # Only messages before `end`
+    assert index.search("cat", 2, 5) == [1]
+
+
+def test_index_file_round_trip(tmp_path):
+    history = [entry(f"message number {number} about topic{number % 3}") for number in range(50)]
+    index = build(history, str(tmp_path / "recall_42.idx"))
+    index.save()
+    copy = read_index(index.path)
+    assert copy.docs == 50 and copy.last == index.last and copy.unsaved == 0
+    assert copy.search("topic1", 50, 10) == index.search("topic1", 50, 10)
+    assert copy.matches(history)
+
+
+def test_damaged_file_is_rebuilt(tmp_path):
+    path = tmp_path / "recall_42.idx"
+    path.write_bytes(recall.MAGIC + b"garbage")
+    assert read_index(str(path)) is None
+
+
+def test_file_with_wrong_message_count_is_rebuilt(tmp_path):
+    path = tmp_path / "recall_42.idx"
+    index = build([entry("alpha"), entry("beta")])
+    raw = zlib.decompress(index.encode()[len(recall.MAGIC):])
+    last, docs, *lengths = recall.HEADER.unpack_from(raw)
+    header = recall.HEADER.pack(last, docs + 1, *lengths)
+    path.write_bytes(recall.MAGIC + zlib.compress(header + raw[recall.HEADER.size:]))
+    assert read_index(str(path)) is None
+
+
+def test_rollback_then_new_messages(tmp_path, loaded):
+    path = str(tmp_path / "recall_42.idx")
+    history = [entry("alpha"), entry("beta"), entry("ok")]
+    assert recall.search(CHAT_ID, path, history, "beta", 3) == [1]
+    recall.flush(CHAT_ID, loaded.pop(CHAT_ID))
+    # Rolled back while index is not in memory, then a new message repeats the last text
+    history = history[:1]
+    recall.truncate(CHAT_ID, path, history)
+    history += [entry("gamma"), entry("ok")]
+    loaded.pop(CHAT_ID)
+    assert recall.search(CHAT_ID, path, history, "beta", 3) == []
+    assert recall.search(CHAT_ID, path, history, "gamma", 3) == [1]
+
+
+def test_index_longer_than_history_is_rebuilt(tmp_path, loaded):
+    path = str(tmp_path / "recall_42.idx")
+    build([entry("alpha"), entry("beta"), entry("gamma")], path).save()
+    history = [entry("alpha"), entry("delta")]
+    assert recall.search(CHAT_ID, path, history, "delta", 2) == [1]
+    assert recall.search(CHAT_ID, path, history, "gamma", 2) == []
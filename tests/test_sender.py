@@ -0,0 +1,68 @@
+"""Splitting of long replies into Telegram messages"""
+import random
+import pytest
+
+from common import MAX_MESSAGE_LENGTH
+from sender import FENCE, split_message
+
+
+def code_is_closed(part):
+    """Every code block opened in part is closed in it"""
+    return part.count(FENCE) % 2 == 0
+
+
+def test_short_text_is_one_part():
+    assert split_message("hello") == ["hello"]
+    assert split_message("") == []
+
+
+def test_plain_text_is_cut_at_paragraphs():
+    paragraph = ("word " * 150).strip()
+    parts = split_message("\n\n".join([paragraph] * 20), limit=1000)
+    # Newlines at the cut are dropped, every paragraph is a message
+    assert parts == [paragraph] * 20
+
+
+def test_exact_limit():
+    assert split_message("x" * MAX_MESSAGE_LENGTH) == ["x" * MAX_MESSAGE_LENGTH]
+    parts = split_message("x" * (MAX_MESSAGE_LENGTH + 1))
+    # Text without breaks is cut where a closing fence would still fit
+    assert [len(part) for part in parts] == [MAX_MESSAGE_LENGTH - len(FENCE) - 1, len(FENCE) + 2]
+
+
+def test_code_block_is_closed_and_opened_again():
+    code = "\n".join(f"print({number})" for number in range(600))
+    text = f"Here is the code:\n```python\n{code}\n```\nDone."
+    parts = split_message(text)
+    assert len(parts) > 1
+    assert all(len(part) <= MAX_MESSAGE_LENGTH for part in parts)
+    assert all(code_is_closed(part) for part in parts)
+    assert all(part.startswith("```python\n") for part in parts[1:])
+    assert parts[-1].endswith("```\nDone.")
+
+
+@pytest.mark.parametrize("text", [
+    FENCE + "y" * 5000 + FENCE,
+    FENCE + "y" * 5000 + "\ncode\n" + FENCE,
+    FENCE + "python " + "title " * 2000 + "\ncode\n" + FENCE,
+], ids=["one line", "code after", "language and title"])
+def test_long_fence_line_is_not_repeated(text):
+    parts = split_message(text)
+    assert len(parts) == len(text) // MAX_MESSAGE_LENGTH + 1
+    assert all(len(part) <= MAX_MESSAGE_LENGTH for part in parts)
+    # Only backticks and a short language open the block again
+    assert parts[1].split("\n", 1)[0] in (FENCE, FENCE + "python")
+
+
+def test_small_limit_still_moves_forward():
+    parts = split_message(FENCE + "javascript\n" + "x" * 100 + "\n" + FENCE, limit=24)
+    assert "".join(part.replace(FENCE, "").replace("javascript", "").replace("\n", "") for part in parts) == "x" * 100
+
+
+def test_no_part_over_limit():
+    generator = random.Random(1)
+    pieces = ["word", "\n", "\n\n", "```", "```python\n", ". ", "x" * 300, " "]
+    for _ in range(50):
+        text = "".join(generator.choice(pieces) for _ in range(generator.randint(100, 3000)))
+        parts = split_message(text)
+        assert all(len(part) <= MAX_MESSAGE_LENGTH for part in parts)
@@ -0,0 +1,69 @@
+"""Pages a chat asks for are fetched only from public hosts"""
+import socket
+import pytest
+
+from utils import serp
+
+
+def resolve_to(address):
+    """getaddrinfo replacement resolving every host to address"""
+    def getaddrinfo(host, port, *args, **kwargs):
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, port))]
+    return getaddrinfo
+
+
+class FakeResponse:
+    def __init__(self, location=None):
+        self.is_redirect = location is not None
+        self.headers = {"Location": location} if location else {}
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1/",
+    "http://localhost:8080/admin",
+    "http://169.254.169.254/latest/meta-data/",
+    "http://10.0.0.5/",
+    "http://[::1]/",
+    "http://[::ffff:192.168.1.1]/",
+    "file:///etc/passwd",
+    "ftp://example.com/",
+])
+def test_local_and_odd_urls_are_refused(url):
+    with pytest.raises(serp.UnsafeURL):
+        serp.check_url(url)
+
+
+def test_public_host_on_custom_port_is_refused(monkeypatch):
+    monkeypatch.setattr(socket, "getaddrinfo", resolve_to("93.184.216.34"))
+    serp.check_url("https://example.com/page")
+    with pytest.raises(serp.UnsafeURL):
+        serp.check_url("https://example.com:8443/page")
+
+
+def test_host_resolving_to_private_address_is_refused(monkeypatch):
+    monkeypatch.setattr(socket, "getaddrinfo", resolve_to("192.168.0.10"))
+    with pytest.raises(serp.UnsafeURL):
+        serp.check_url("http://intranet.example.com/")
+
+
+def test_redirect_to_local_address_is_not_followed(monkeypatch):
+    monkeypatch.setattr(socket, "getaddrinfo", resolve_to("93.184.216.34"))
+    requested = []
+
+    def get(url, **kwargs):
+        requested.append(url)
+        return FakeResponse(location="http://127.0.0.1:2375/containers/json")
+    monkeypatch.setattr(serp.session, "get", get)
+    with pytest.raises(serp.UnsafeURL):
+        serp.get_page("https://example.com/", {})
+    assert requested == ["https://example.com/"]
+
+
+def test_redirects_are_limited(monkeypatch):
+    monkeypatch.setattr(socket, "getaddrinfo", resolve_to("93.184.216.34"))
+    monkeypatch.setattr(serp.session, "get", lambda url, **kwargs: FakeResponse(location="/again"))
+    with pytest.raises(serp.requests.TooManyRedirects):
+        serp.get_page("https://example.com/", {})
@@ -0,0 +1,133 @@
+"""Crash safety of journal storage: replay over snapshot, torn records, compaction"""
+import os
+import json
+import pytest
+
+import storage
+from storage import JournalStorage
+
+CHAT_ID = "42"
+
+
+def make_chat():
+    """Empty chat state like conv.init creates"""
+    return {"id": CHAT_ID, "title": "Test", "history": [], "type": "private", "members": {}, "tokens": 0}
+
+
+def add(backend, chat, text):
+    """Append message the way conv does: change state, then journal it"""
+    entry = {"role": "user", "content": text}
+    chat["history"].append(entry)
+    backend.append(CHAT_ID, {"op": "append", "entry": entry}, chat)
+
+
+def reopen(backend):
+    """Storage of the same directory after restart"""
+    backend.flush()
+    for journal in list(backend.files.values()):
+        journal.close()
+    backend.dir_lock.close()
+    return JournalStorage(backend.log_dir)
+
+
+def contents(chat):
+    """Texts of chat history"""
+    return [entry["content"] for entry in chat["history"]]
+
+
+@pytest.fixture
+def backend(tmp_path):
+    """Journal storage in empty directory"""
+    journal_storage = JournalStorage(str(tmp_path))
+    yield journal_storage
+    journal_storage.dir_lock.close()
+
+
+def test_journal_is_replayed_over_snapshot(backend):
+    chat = make_chat()
+    backend.save(CHAT_ID, chat)
+    for text in ("one", "two", "three"):
+        add(backend, chat, text)
+    backend.append(CHAT_ID, {"op": "settings", "key": "temperature", "value": "0.2"}, chat)
+    backend.append(CHAT_ID, {"op": "rollback", "count": 1}, chat)
+
+    loaded = reopen(backend).load(CHAT_ID)
+    assert contents(loaded) == ["one", "two"]
+    assert loaded["settings"] == {"temperature": "0.2"}
+
+
+def test_torn_last_record_is_dropped(backend):
+    chat = make_chat()
+    backend.save(CHAT_ID, chat)
+    add(backend, chat, "one")
+    add(backend, chat, "two")
+    # Crash in the middle of writing the third record
+    with open(backend.get_journal_path(CHAT_ID), "ab") as journal:
+        journal.write(b'{"seq": 3, "op": "append", "entry": {"role": "user", "con')
+
+    restarted = reopen(backend)
+    loaded = restarted.load(CHAT_ID)
+    assert contents(loaded) == ["one", "two"]
+    # Damaged tail is cut off, records written after restart are readable
+    add(restarted, loaded, "three")
+    assert contents(reopen(restarted).load(CHAT_ID)) == ["one", "two", "three"]
+
+
+def test_records_folded_into_snapshot_are_skipped(backend):
+    chat = make_chat()
+    backend.save(CHAT_ID, chat)
+    add(backend, chat, "one")
+    add(backend, chat, "two")
+    path = backend.get_journal_path(CHAT_ID)
+    with open(path, "rb") as journal:
+        records = journal.read()
+    # Crash after compaction wrote snapshot, before it truncated journal
+    backend.save(CHAT_ID, chat)
+    with open(path, "wb") as journal:
+        journal.write(records)
+
+    loaded = reopen(backend).load(CHAT_ID)
+    assert loaded["seq"] == 2
+    assert contents(loaded) == ["one", "two"]
+
+
+def test_compaction_keeps_state(backend, monkeypatch):
+    monkeypatch.setattr(storage, "JOURNAL_COMPACT_EVERY", 3)
+    chat = make_chat()
+    backend.save(CHAT_ID, chat)
+    for number in range(7):
+        add(backend, chat, f"message {number}")
+
+    with open(backend.get_journal_path(CHAT_ID), "r", encoding="utf-8") as journal:
+        records = [json.loads(line) for line in journal]
+    assert [record["seq"] for record in records] == [7]
+    with open(backend.get_file_path(CHAT_ID), "r", encoding="utf-8") as snapshot:
+        assert json.load(snapshot)["seq"] == 6
+
+    loaded = reopen(backend).load(CHAT_ID)
+    assert contents(loaded) == contents(chat)
+
+
+def test_journal_without_snapshot_is_ignored(backend):
+    with open(backend.get_journal_path(CHAT_ID), "w", encoding="utf-8") as journal:
+        journal.write(json.dumps({"seq": 1, "op": "reset"}) + "\n")
+    assert backend.load(CHAT_ID) is None
+    assert os.path.exists(backend.get_journal_path(CHAT_ID))
+
+
+def test_append_after_close_continues_seq(backend):
+    chat = make_chat()
+    backend.save(CHAT_ID, chat)
+    add(backend, chat, "one")
+    add(backend, chat, "two")
+    # Chat evicted from memory while its state is still used
+    backend.close(CHAT_ID)
+    add(backend, chat, "three")
+    backend.close(CHAT_ID)
+    backend.save(CHAT_ID, chat)
+    add(backend, chat, "four")
+
+    with open(backend.get_file_path(CHAT_ID), "r", encoding="utf-8") as snapshot:
+        assert json.load(snapshot)["seq"] == 3
+    loaded = reopen(backend).load(CHAT_ID)
+    assert contents(loaded) == ["one", "two", "three", "four"]
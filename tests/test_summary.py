@@ -0,0 +1,133 @@
+"""Summary of long chats with a stub model: trigger, nesting, stale results, rollback and reset"""
+from types import SimpleNamespace
+import pytest
+
+import conv
+from storage import create_storage
+from utils.cache import LRUCache
+from utils.models import ModelProfile
+
+CHAT_ID = 42
+AUTHOR = SimpleNamespace(id=1, first_name="Ann", last_name=None, username="ann")
+
+
+class InlineExecutor:
+    """Runs summarization in the calling thread, so tests see its result right away"""
+
+    def submit(self, function, *args):
+        function(*args)
+
+
+class StubSummarizer:
+    """Summary names the messages it covers and nests the previous one"""
+
+    def __init__(self):
+        self.calls = []
+        self.during_call = None
+
+    def __call__(self, previous, entries):
+        self.calls.append((previous, [entry["content"] for entry in entries]))
+        if self.during_call is not None:
+            self.during_call()
+        return f"[{previous}] + {len(entries)} messages"
+
+
+def new_cache():
+    """Empty chat state cache like conv creates"""
+    return LRUCache(max_items=10, sizeof=conv.chat_size, on_evict=conv.evict_chat)
+
+
+@pytest.fixture(params=["json", "journal"])
+def summarizer(request, tmp_path, monkeypatch):
+    """Chat storage in tmp_path, one token per word and small summary limits"""
+    backend = create_storage(str(tmp_path), request.param)
+    monkeypatch.setattr(conv, "STORAGE", backend)
+    monkeypatch.setattr(conv, "conversation_history", new_cache())
+    monkeypatch.setattr(conv, "summary_executor", InlineExecutor())
+    monkeypatch.setattr(ModelProfile, "count", lambda self, text: len(text.split()))
+    monkeypatch.setattr(conv, "SUMMARY_TRIGGER_TOKENS", 20)
+    monkeypatch.setattr(conv, "SUMMARY_KEEP_TOKENS", 8)
+    stub = StubSummarizer()
+    monkeypatch.setattr(conv, "summarizer", stub)
+    conv.init(CHAT_ID, None, "private", AUTHOR)
+    conv.save_chat_settings(CHAT_ID, "summary", "on")
+    yield stub
+    conv.STORAGE.flush()
+    conv.STORAGE.dir_lock.close()
+
+
+def talk(turns, start=0):
+    """Question and answer of four words each per turn"""
+    for number in range(start, start + turns):
+        conv.save_question(CHAT_ID, f"question {number} four words", AUTHOR, number)
+        conv.save_response(CHAT_ID, f"answer {number} four words")
+
+
+def restart(monkeypatch):
+    """Storage and cache of a restarted bot, chat is loaded back from files"""
+    old = conv.STORAGE
+    old.flush()
+    for str_id in list(getattr(old, "files", {})):
+        old.close(str_id)
+    old.dir_lock.close()
+    monkeypatch.setattr(conv, "STORAGE", create_storage(old.log_dir, "journal" if old.append_only else "json"))
+    monkeypatch.setattr(conv, "conversation_history", new_cache())
+    return conv.get_chat(str(CHAT_ID))
+
+
+def test_summary_starts_over_trigger_and_nests(summarizer, monkeypatch):
+    talk(2)
+    # 16 tokens, under the trigger
+    assert summarizer.calls == []
+    talk(1, start=2)
+    chat = conv.get_chat(str(CHAT_ID))
+    # Newest 8 tokens (one turn) are kept out of the summary
+    assert summarizer.calls == [(None, [entry["content"] for entry in chat["history"][:4]])]
+    assert chat["summary"]["covered"] == 4
+    assert chat["summary"]["covered_tokens"] == 16
+
+    talk(3, start=3)
+    previous, entries = summarizer.calls[-1]
+    assert previous == "[None] + 4 messages"
+    assert entries[0] == "question 2 four words"
+    assert chat["summary"]["content"].startswith("[[None] + 4 messages]")
+
+    loaded = restart(monkeypatch)
+    assert loaded["summary"] == chat["summary"]
+
+
+def test_result_for_changed_history_is_dropped(summarizer):
+    talk(2)
+    # Rollback lands while the model is summarizing
+    summarizer.during_call = lambda: conv.rollback(CHAT_ID, 2)
+    talk(1, start=2)
+    assert len(summarizer.calls) == 1
+    chat = conv.get_chat(str(CHAT_ID))
+    assert "summary" not in chat
+    assert len(chat["history"]) == 4
+
+
+def test_result_after_reset_is_dropped(summarizer):
+    talk(2)
+    summarizer.during_call = lambda: conv.reset(CHAT_ID)
+    talk(1, start=2)
+    chat = conv.get_chat(str(CHAT_ID))
+    assert "summary" not in chat
+    assert chat["history"] == []
+
+
+def test_rollback_past_summary_and_reset_clear_it(summarizer, monkeypatch):
+    talk(3)
+    chat = conv.get_chat(str(CHAT_ID))
+    assert chat["summary"]["covered"] == 4
+    # Messages after the summary can go, it still matches history
+    conv.rollback(CHAT_ID, 2)
+    assert "summary" in chat
+    conv.rollback(CHAT_ID, 1)
+    assert "summary" not in chat
+    assert "summary" not in restart(monkeypatch)
+
+    talk(3, start=3)
+    assert "summary" in conv.get_chat(str(CHAT_ID))
+    conv.reset(CHAT_ID)
+    assert "summary" not in restart(monkeypatch)
@@ -0,0 +1,170 @@
+"""In-memory caches"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from utils.log import get_logger
+
+log = get_logger("cache")
+
+
+class LRUCache:
+    """Dict-like LRU cache bounded by number of items and/or approximate size in bytes.
+
+    `sizeof(value)` estimates size of value, `on_evict(key, value)` is called for
+    every item pushed out by the limits. Most recently added item is never evicted.
+    With `ttl` (seconds) items older than that are treated as missing and dropped
+    without calling `on_evict`.
+    """
+
+    def __init__(self, max_items=None, max_bytes=None, sizeof=None, on_evict=None, ttl=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.on_evict = on_evict
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.sizes = {}
+        self.expires = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self.lock = threading.RLock()
+
+    def get(self, key, default=None):
+        """Get value and mark it as recently used"""
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return default
+            if self.is_expired(key):
+                self.expired += 1
+                self.misses += 1
+                self.pop(key)
+                return default
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value, expires=None):
+        """Add or replace value, evict least recently used items over the limits.
+
+        `expires` is unix time when value goes stale, by default now + ttl.
+        """
+        evicted = []
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            self.update_size(key)
+            if expires is None and self.ttl is not None:
+                expires = time.time() + self.ttl
+            if expires is not None:
+                self.expires[key] = expires
+            else:
+                self.expires.pop(key, None)
+            while len(self.items) > 1 and self.over_limit():
+                old_key, old_value = self.items.popitem(last=False)
+                self.size -= self.sizes.pop(old_key)
+                self.expires.pop(old_key, None)
+                self.evictions += 1
+                evicted.append((old_key, old_value))
+        # Callbacks may do IO, keep them out of the lock
+        if self.on_evict is not None:
+            for old_key, old_value in evicted:
+                self.on_evict(old_key, old_value)
+
+    def resize(self, key):
+        """Recalculate size of value changed in place"""
+        with self.lock:
+            if key in self.items:
+                self.put(key, self.items[key], self.expires.get(key))
+
+    def pop(self, key, default=None):
+        """Remove value without calling on_evict"""
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.size -= self.sizes.pop(key)
+            self.expires.pop(key, None)
+            return self.items.pop(key)
+
+    def is_expired(self, key):
+        """Check if value outlived its ttl"""
+        expires = self.expires.get(key)
+        return expires is not None and expires <= time.time()
+
+    def update_size(self, key):
+        """Store size of value"""
+        size = self.sizeof(self.items[key])
+        self.size += size - self.sizes.get(key, 0)
+        self.sizes[key] = size
+
+    def over_limit(self):
+        """Check if cache is over item count or size limit"""
+        if self.max_items is not None and len(self.items) > self.max_items:
+            return True
+        return self.max_bytes is not None and self.size > self.max_bytes
+
+    def stats(self):
+        """Hit, miss and eviction counters with current usage"""
+        with self.lock:
+            return {
+                "items": len(self.items),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expired": self.expired,
+            }
+
+    def dump(self, path):
+        """Write live items to json file, oldest first so load keeps LRU order"""
+        with self.lock:
+            data = [[key, value, self.expires.get(key)]
+                    for key, value in self.items.items() if not self.is_expired(key)]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as content:
+            json.dump(data, content, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """Read items written by dump, skipping expired ones. Returns number of loaded items"""
+        if not os.path.exists(path):
+            return 0
+        try:
+            with open(path, "r", encoding="utf-8") as content:
+                data = json.load(content)
+        except ValueError:
+            log.warning("Damaged cache file %s, ignored", path)
+            return 0
+        loaded = 0
+        for key, value, expires in data:
+            if expires is not None and expires <= time.time():
+                continue
+            # json has no tuples, keys come back as lists
+            self.put(tuple(key) if isinstance(key, list) else key, value, expires)
+            loaded += 1
+        return loaded
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        if self.pop(key, self) is self:
+            raise KeyError(key)
+
+    def __len__(self):
+        return len(self.items)
@@ -0,0 +1,128 @@
+"""Cache of OpenAI answers to repeated prompts
+
+Key is a hash of the whole request (model, temperature, messages or prompt),
+so any change of history, search results or settings is a miss. Memory tier is
+bounded by COMPLETION_CACHE_BYTES, disk tier in COMPLETION_CACHE_DIR survives
+restarts and is shared by shard processes. Chats opt in with the cache setting.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from decouple import config
+
+from utils import metrics
+from utils.cache import LRUCache
+from utils.log import get_logger
+
+# Seconds an answer is reused, 0 disables the cache
+COMPLETION_CACHE_TTL = config("COMPLETION_CACHE_TTL", default=86400, cast=int)
+COMPLETION_CACHE_BYTES = config("COMPLETION_CACHE_BYTES", default=16 * 1024 * 1024, cast=int)
+# Directory of disk tier, empty keeps answers in memory only
+COMPLETION_CACHE_DIR = config("COMPLETION_CACHE_DIR", default="")
+# Answers at higher temperature are meant to vary and are never reused
+COMPLETION_CACHE_MAX_TEMPERATURE = config("COMPLETION_CACHE_MAX_TEMPERATURE", default=0.5, cast=float)
+
+log = get_logger("completion_cache")
+memory = LRUCache(max_bytes=COMPLETION_CACHE_BYTES, ttl=COMPLETION_CACHE_TTL,
+                  sizeof=lambda text: len(text.encode("utf-8")) + 200)
+
+
+def request_key(params):
+    """Cache key of API request params, None if answer to them must not be reused"""
+    if COMPLETION_CACHE_TTL <= 0 or float(params["temperature"]) > COMPLETION_CACHE_MAX_TEMPERATURE:
+        return None
+    encoded = json.dumps(params, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def disk_path(key):
+    """File of answer in disk tier"""
+    return os.path.join(COMPLETION_CACHE_DIR, key[:2], key + ".json")
+
+
+def read_disk(key):
+    """(answer, expires) from disk tier, None if it is missing or stale"""
+    path = disk_path(key)
+    try:
+        with open(path, "r", encoding="utf-8") as cached:
+            record = json.load(cached)
+    except (OSError, ValueError):
+        return None
+    if record["expires"] <= time.time():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    return record["text"], record["expires"]
+
+
+def write_disk(key, text, expires):
+    """Store answer in disk tier, replaced atomically so readers never see half a file"""
+    path = disk_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as cached:
+        json.dump({"text": text, "expires": expires}, cached, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def get(key):
+    """Cached answer, None on miss"""
+    text = memory.get(key)
+    if text is not None:
+        metrics.count(metrics.COMPLETION_CACHE, 1, "completion_cache_hits", result="hit", tier="memory")
+        return text
+    if COMPLETION_CACHE_DIR:
+        record = read_disk(key)
+        if record is not None:
+            text, expires = record
+            memory.put(key, text, expires)
+            metrics.count(metrics.COMPLETION_CACHE, 1, "completion_cache_hits", result="hit", tier="disk")
+            return text
+    metrics.COMPLETION_CACHE.inc(result="miss")
+    return None
+
+
+def put(key, text):
+    """Store answer in both tiers"""
+    expires = time.time() + COMPLETION_CACHE_TTL
+    memory.put(key, text, expires)
+    if COMPLETION_CACHE_DIR:
+        try:
+            write_disk(key, text, expires)
+        except OSError as err:
+            log.warning("Failed to store answer on disk: %s", err)
+
+
+def prune_disk():
+    """Remove stale answers from disk tier"""
+    removed = 0
+    now = time.time()
+    for root, _, names in os.walk(COMPLETION_CACHE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                if name.endswith(".tmp"):
+                    # Left by a crash in the middle of write
+                    stale = os.path.getmtime(path) < now - 60
+                else:
+                    with open(path, "r", encoding="utf-8") as cached:
+                        stale = json.load(cached)["expires"] <= now
+            except (OSError, ValueError, KeyError):
+                continue
+            if stale:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    # Other shard process got it first
+                    pass
+    log.info("Removed %s stale cached answers", removed)
+
+
+if COMPLETION_CACHE_DIR and os.path.isdir(COMPLETION_CACHE_DIR):
+    # In background, startup does not wait for a walk over the whole directory
+    threading.Thread(target=prune_disk, name="completion-cache-prune", daemon=True).start()
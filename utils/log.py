@@ -0,0 +1,15 @@
+"""Leveled logging shared by all modules"""
+import logging
+from decouple import config
+
+# DEBUG also logs every message, answer and history save
+LOG_LEVEL = config("LOG_LEVEL", default="INFO")
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+
+def get_logger(name):
+    """Logger for module, configures logging on first use"""
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(level=LOG_LEVEL.upper(), format=LOG_FORMAT)
+    return logging.getLogger(name)
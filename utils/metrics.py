@@ -0,0 +1,229 @@
+"""Counters, latency histograms and per-request traces
+
+Metrics are served in Prometheus text format on METRICS_PORT, every finished
+request can also be appended to TRACE_LOG as one json line with its stage timings.
+"""
+import json
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from decouple import config
+
+from utils.log import get_logger
+
+# Port of /metrics endpoint, 0 disables it
+METRICS_PORT = config("METRICS_PORT", default=0, cast=int)
+# File to append per-request traces to, empty disables them
+TRACE_LOG = config("TRACE_LOG", default="")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+log = get_logger("metrics")
+REGISTRY = []
+
+
+def format_labels(labels, extra=()):
+    """Prometheus label set, labels are (name, value) pairs"""
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+    kind = "counter"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        """Add amount to series with labels"""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def lines(self):
+        """Sample lines in text format"""
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{format_labels(key)} {value}" for key, value in values]
+
+
+class Histogram(Counter):
+    """Distribution of observed values in fixed buckets"""
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        """Add value to series with labels"""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                # Counts per bucket (last one is +Inf), sum, count
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def lines(self):
+        """Cumulative bucket, sum and count lines in text format"""
+        with self.lock:
+            values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items()]
+        lines = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+
+def render():
+    """All metrics in Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.lines())
+    return "\n".join(lines) + "\n"
+
+
+UPDATES = Counter("bot_updates_total", "Updates handled, by handler")
+UPDATE_LAG = Histogram("bot_update_lag_seconds", "Time from message date to start of handling")
+REQUEST_SECONDS = Histogram("bot_request_seconds", "Time to handle update, by handler and status")
+STAGE_SECONDS = Histogram("bot_stage_seconds", "Time spent in stage of reply pipeline")
+OPENAI_REQUESTS = Counter("openai_requests_total", "OpenAI API responses, by status")
+OPENAI_RETRIES = Counter("openai_retries_total", "Retried OpenAI API requests, by reason")
+OPENAI_TOKENS = Counter("openai_tokens_total", "Tokens sent to and received from OpenAI, by direction")
+STORAGE_BYTES = Counter("storage_bytes_written_total", "Bytes written to chat storage, by kind")
+COMPLETION_CACHE = Counter("completion_cache_requests_total", "Completion cache lookups, by result and tier")
+SUMMARIES = Counter("conv_summaries_total", "Background summarizations of chat history, by status")
+TELEGRAM_REQUESTS = Counter("telegram_requests_total", "Bot API calls made by sender, by method and status")
+SEND_WAIT_SECONDS = Histogram("telegram_send_wait_seconds", "Time sends waited for Telegram rate limits")
+DISPATCHED = Counter("dispatcher_updates_total", "Updates passed to shard workers, by status")
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """Stage timings and counters of one handled update"""
+
+    def __init__(self, handler, chat_id):
+        self.handler = handler
+        self.chat_id = chat_id
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counts = {}
+
+    def to_dict(self, status, duration):
+        """Trace log record"""
+        return {
+            "time": time.time(),
+            "handler": self.handler,
+            "chat_id": self.chat_id,
+            "status": status,
+            "seconds": round(duration, 6),
+            "stages": {name: round(seconds, 6) for name, seconds in self.stages.items()},
+            **self.counts,
+        }
+
+
+trace_lock = threading.Lock()
+
+
+def write_trace(record):
+    """Append trace record to TRACE_LOG"""
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with trace_lock:
+        with open(TRACE_LOG, "a", encoding="utf-8") as trace_log:
+            trace_log.write(line)
+
+
+@contextmanager
+def request(handler, message):
+    """Measure handling of Telegram message, stages inside are added to its trace"""
+    UPDATES.inc(handler=handler)
+    if getattr(message, "date", None):
+        UPDATE_LAG.observe(max(time.time() - message.date, 0.0))
+    trace = Trace(handler, message.chat.id)
+    token = current_trace.set(trace)
+    status = "ok"
+    try:
+        yield trace
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        current_trace.reset(token)
+        duration = time.perf_counter() - trace.started
+        REQUEST_SECONDS.observe(duration, handler=handler, status=status)
+        if TRACE_LOG:
+            write_trace(trace.to_dict(status, duration))
+
+
+@contextmanager
+def stage(name):
+    """Measure stage of reply pipeline"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.stages[name] = trace.stages.get(name, 0.0) + elapsed
+
+
+def count(counter, amount, trace_key=None, **labels):
+    """Increase counter and the same value in current trace under trace_key"""
+    counter.inc(amount, **labels)
+    trace = current_trace.get()
+    if trace is not None and trace_key is not None:
+        trace.counts[trace_key] = trace.counts.get(trace_key, 0) + amount
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """GET /metrics"""
+
+    def do_GET(self):
+        """Serve metrics in text format"""
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Scrapes are not worth logging"""
+
+
+def start_server(port=METRICS_PORT):
+    """Serve /metrics in background thread, does nothing if port is 0"""
+    if not port:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info("Serving metrics on :%s/metrics", port)
+    return server
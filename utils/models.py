@@ -0,0 +1,108 @@
+"""Context windows and token counting of OpenAI models
+
+Chat request costs more than its text: every message is wrapped into a few
+format tokens and the answer is primed with a few more. Profiles keep these
+numbers next to context window and encoding, encoders are loaded on first use
+and shared by the whole process.
+"""
+from functools import lru_cache
+from decouple import config
+
+from utils.log import get_logger
+
+# Model of chat replies and of /s completions
+ENGINE = config("OPENAI_ENGINE", default="gpt-3.5-turbo")
+COMPLETION_MODEL = config("OPENAI_COMPLETION_ENGINE", default="text-davinci-003")
+# Context window of OPENAI_ENGINE if it is not in MODELS or differs from it, 0 = from MODELS
+OPENAI_CONTEXT_SIZE = config("OPENAI_CONTEXT_SIZE", default=0, cast=int)
+# Tokens of context kept for chat answer, history fills the rest
+OPENAI_ANSWER_TOKENS = config("OPENAI_ANSWER_TOKENS", default=500, cast=int)
+
+log = get_logger("models")
+
+
+class ModelProfile:
+    """Context window, encoding and chat format overhead of model"""
+
+    def __init__(self, name, context, encoding, message_tokens=0, name_tokens=0, reply_tokens=0):
+        self.name = name
+        self.context = context
+        self.encoding = encoding
+        # Chat format: tokens around every message, extra for "name" field, answer priming
+        self.message_tokens = message_tokens
+        self.name_tokens = name_tokens
+        self.reply_tokens = reply_tokens
+        self.role_tokens = {}
+
+    @property
+    def encoder(self):
+        """Tokenizer of model"""
+        return get_encoding(self.encoding)
+
+    def count(self, text: str) -> int:
+        """Number of tokens in text"""
+        return len(self.encoder.encode(text))
+
+    def content_tokens(self, message: dict) -> int:
+        """Tokens of message content, cached in message["tokens"]"""
+        if "tokens" not in message:
+            message["tokens"] = self.count(message["content"])
+        return message["tokens"]
+
+    def message_overhead(self, message: dict) -> int:
+        """Format tokens chat message takes besides its content"""
+        role = message["role"]
+        if role not in self.role_tokens:
+            self.role_tokens[role] = self.count(role)
+        tokens = self.message_tokens + self.role_tokens[role]
+        if message.get("name"):
+            tokens += self.name_tokens + self.count(message["name"])
+        return tokens
+
+    def message_total(self, message: dict) -> int:
+        """Tokens chat message takes in request"""
+        return self.message_overhead(message) + self.content_tokens(message)
+
+    def chat_tokens(self, messages: list) -> int:
+        """Prompt tokens of chat request, as OpenAI counts them"""
+        return sum(self.message_total(message) for message in messages) + self.reply_tokens
+
+
+MODELS = {profile.name: profile for profile in [
+    ModelProfile("gpt-3.5-turbo", 4096, "cl100k_base", message_tokens=3, name_tokens=1, reply_tokens=3),
+    ModelProfile("gpt-3.5-turbo-0301", 4096, "cl100k_base", message_tokens=4, name_tokens=-1, reply_tokens=3),
+    ModelProfile("gpt-3.5-turbo-16k", 16384, "cl100k_base", message_tokens=3, name_tokens=1, reply_tokens=3),
+    ModelProfile("gpt-4", 8192, "cl100k_base", message_tokens=3, name_tokens=1, reply_tokens=3),
+    ModelProfile("gpt-4-32k", 32768, "cl100k_base", message_tokens=3, name_tokens=1, reply_tokens=3),
+    ModelProfile("gpt-4-1106-preview", 128000, "cl100k_base", message_tokens=3, name_tokens=1, reply_tokens=3),
+    ModelProfile("gpt-4-turbo", 128000, "cl100k_base", message_tokens=3, name_tokens=1, reply_tokens=3),
+    ModelProfile("text-davinci-003", 4097, "p50k_base"),
+    ModelProfile("text-davinci-002", 4097, "p50k_base"),
+]}
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str):
+    """Tokenizer by encoding name, loaded once"""
+    # tiktoken is slow to import and nothing is counted before the first message
+    import tiktoken
+    return tiktoken.get_encoding(name)
+
+
+@lru_cache(maxsize=None)
+def get_model(name: str = ENGINE) -> ModelProfile:
+    """Profile of model. Dated versions (gpt-4-0613) use profile of longest known prefix"""
+    profile = MODELS.get(name)
+    if profile is None:
+        prefixes = [known for known in MODELS if name.startswith(known)]
+        if prefixes:
+            known = MODELS[max(prefixes, key=len)]
+            profile = ModelProfile(name, known.context, known.encoding, known.message_tokens,
+                                   known.name_tokens, known.reply_tokens)
+        else:
+            log.warning("Unknown model %s, counting tokens like gpt-3.5-turbo", name)
+            profile = ModelProfile(name, 4096, "cl100k_base", message_tokens=3, name_tokens=1, reply_tokens=3)
+    if name == ENGINE and OPENAI_CONTEXT_SIZE:
+        profile = ModelProfile(name, OPENAI_CONTEXT_SIZE, profile.encoding, profile.message_tokens,
+                               profile.name_tokens, profile.reply_tokens)
+    return profile
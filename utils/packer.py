@@ -0,0 +1,67 @@
+"""Fitting prompt parts into context window of completion model"""
+import re
+from functools import lru_cache
+
+from utils.models import COMPLETION_MODEL, get_model
+
+# Sentence ends with punctuation followed by whitespace, or with blank line
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n\s*\n")
+
+
+def count_tokens(text: str, model: str = COMPLETION_MODEL) -> int:
+    """Number of tokens in text for model"""
+    return get_model(model).count(text)
+
+
+@lru_cache(maxsize=256)
+def template_tokens(text: str, model: str = COMPLETION_MODEL) -> int:
+    """count_tokens for fixed template text that is encoded over and over"""
+    return count_tokens(text, model)
+
+
+def truncate_sentences(text: str, limit: int, model: str = COMPLETION_MODEL) -> str:
+    """Longest prefix of whole sentences within `limit` tokens.
+    Falls back to cutting tokens when even the first sentence does not fit"""
+    # Token is never shorter than one byte of UTF-8 (one Cyrillic letter or emoji can
+    # be several tokens), short texts need no encoding
+    if len(text.encode("utf-8")) <= limit:
+        return text
+    encoder = get_model(model).encoder
+    # Tokens are rarely longer than a few characters, do not encode whole page to learn it is too long
+    if len(text) <= limit * 10 and len(encoder.encode(text)) <= limit:
+        return text
+    end = 0
+    used = 0
+    for match in SENTENCE_END.finditer(text):
+        tokens = len(encoder.encode(text[end:match.end()]))
+        if used + tokens > limit:
+            break
+        used += tokens
+        end = match.end()
+    if end == 0:
+        return encoder.decode(encoder.encode(text[:limit * 10])[:limit])
+    return text[:end].rstrip()
+
+
+def pack(items: list, budget: int, render, model: str = COMPLETION_MODEL, item_limit: int = None) -> list:
+    """Fill `budget` tokens with items in rank order.
+
+    `render(item, body)` gives text of item with its body, body of item is
+    item["body"]. Body that does not fit (or is over `item_limit`) is cut at
+    sentence boundary, items after the budget ran out are dropped.
+    Returns items with possibly shortened bodies.
+    """
+    packed = []
+    for item in items:
+        overhead = count_tokens(render(item, ""), model)
+        room = budget - overhead
+        if item_limit is not None:
+            room = min(room, item_limit)
+        if room <= 0:
+            break
+        body = truncate_sentences(item["body"], room, model)
+        if not body.strip() and item["body"].strip():
+            break
+        budget -= overhead + count_tokens(body, model)
+        packed.append({**item, "body": body})
+    return packed
@@ -0,0 +1,67 @@
+"""Client-side rate limiting"""
+import time
+import asyncio
+import threading
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `per_minute` tokens per minute.
+
+    Callers reserve tokens up front and wait until the bucket pays off the debt,
+    so a request bigger than the whole bucket still goes through, just later.
+    `per_minute` of 0 or less disables the limit.
+    """
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """Add tokens earned since last update, caller holds the lock"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount=1):
+        """Take tokens, returns seconds to wait before they are really available"""
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def available(self):
+        """Tokens that can be taken right now, negative while earlier callers wait"""
+        if self.rate <= 0:
+            return float("inf")
+        with self.lock:
+            self.refill()
+            return self.tokens
+
+    def pause(self, seconds):
+        """Give out no tokens for `seconds`, when server asked to retry later"""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def acquire(self, amount=1):
+        """Block until tokens are available"""
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, amount=1):
+        """Wait without blocking event loop until tokens are available"""
+        wait = self.reserve(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
@@ -1,9 +1,72 @@
-"""Search engine results page (SERP) utilities"""
+"""Search engine results page (SERP) utilities
+
+readability (lxml) and duckduckgo_search are imported on first /s, bot starts without them.
+"""
+import os
 import re
+import time
+import atexit
+import socket
+import ipaddress
 import datetime
+from urllib.parse import urljoin, urlsplit
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 import requests
-from readability import Document
-from duckduckgo_search import ddg
+from requests.adapters import HTTPAdapter
+from decouple import config
+from utils.cache import LRUCache
+from utils.log import get_logger
+from utils.models import COMPLETION_MODEL, get_model
+from utils.packer import count_tokens, template_tokens, pack
+
+# Search results per (query, region, time, num)
+SERP_CACHE_TTL = config("SERP_CACHE_TTL", default=900, cast=int)
+SERP_CACHE_SIZE = config("SERP_CACHE_SIZE", default=1000, cast=int)
+# Extracted pages are served without network for PAGE_CACHE_TTL seconds,
+# then revalidated with conditional GET until PAGE_CACHE_KEEP runs out
+PAGE_CACHE_TTL = config("PAGE_CACHE_TTL", default=3600, cast=int)
+PAGE_CACHE_KEEP = config("PAGE_CACHE_KEEP", default=86400, cast=int)
+PAGE_CACHE_BYTES = config("PAGE_CACHE_BYTES", default=32 * 1024 * 1024, cast=int)
+# Directory to keep both caches between restarts, empty disables persistence
+SERP_CACHE_DIR = config("SERP_CACHE_DIR", default="")
+# Page fetching: parallel downloads, seconds to connect / between reads,
+# seconds for one page and for all pages of deep search, max bytes read per page
+SERP_FETCH_WORKERS = config("SERP_FETCH_WORKERS", default=10, cast=int)
+SERP_CONNECT_TIMEOUT = config("SERP_CONNECT_TIMEOUT", default=3, cast=float)
+SERP_READ_TIMEOUT = config("SERP_READ_TIMEOUT", default=5, cast=float)
+SERP_PAGE_TIMEOUT = config("SERP_PAGE_TIMEOUT", default=8, cast=float)
+SERP_DEEP_TIMEOUT = config("SERP_DEEP_TIMEOUT", default=10, cast=float)
+SERP_MAX_PAGE_BYTES = config("SERP_MAX_PAGE_BYTES", default=2 * 1024 * 1024, cast=int)
+# Redirects followed for one page, every hop is checked like the first URL
+SERP_MAX_REDIRECTS = config("SERP_MAX_REDIRECTS", default=5, cast=int)
+# Pages are fetched only from public addresses on default ports, so a chat can't
+# make the bot request localhost or internal services. True is for local tests
+SERP_ALLOW_LOCAL = config("SERP_ALLOW_LOCAL", default=False, cast=bool)
+# Processes for readability extraction, 0 extracts in fetching thread
+SERP_EXTRACT_WORKERS = config("SERP_EXTRACT_WORKERS", default=2, cast=int)
+# Tokens of context window left for the answer, results fill the rest
+SERP_ANSWER_TOKENS = config("SERP_ANSWER_TOKENS", default=1000, cast=int)
+# Max tokens of one result, so a long page does not push out the others
+SERP_RESULT_TOKENS = config("SERP_RESULT_TOKENS", default=1000, cast=int)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+log = get_logger("serp")
+
+
+class UnsafeURL(requests.exceptions.InvalidURL):
+    """URL of page the bot must not fetch"""
+
+SERP_PROMPT = '''Web search results:
+
+{web_results}
+Current date: {current_date}
+
+Instructions: Using the provided web search results, write a comprehensive reply to the given query. Make sure to cite results using [number](URL) notation after the reference. If the provided search results refer to multiple subjects with the same name, write separate answers for each subject.
+Query: {query}'''
 
 DEFAULT_SETTINGS = {
     "num_results": 3,
@@ -11,27 +74,68 @@ DEFAULT_SETTINGS = {
     "region": "us",
 }
 
-def format_web_results(results: list) -> str:
-    """Formats web results"""
-    counter = 1
-    return "\n".join([f"[{counter}] \"{result['body']}\"\nURL: {result['href']}\n\n" for result in results])
+search_cache = LRUCache(max_items=SERP_CACHE_SIZE, ttl=SERP_CACHE_TTL)
+page_cache = LRUCache(max_bytes=PAGE_CACHE_BYTES, ttl=PAGE_CACHE_KEEP,
+                      sizeof=lambda page: len(page["title"]) + len(page["body"]) + 200)
 
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=SERP_FETCH_WORKERS, pool_maxsize=SERP_FETCH_WORKERS))
+session.mount("https://", HTTPAdapter(pool_connections=SERP_FETCH_WORKERS, pool_maxsize=SERP_FETCH_WORKERS))
+fetch_executor = ThreadPoolExecutor(max_workers=SERP_FETCH_WORKERS, thread_name_prefix="serp-fetch")
+extract_executor = None
+extract_lock = threading.Lock()
 
-def get_serp(query: str, num_results: int, time_period: str, region: str) -> list:
-    """Returns a list of search results"""
 
-    serp_prompt = '''Web search results:
+def cache_paths():
+    """Files used to persist search and page caches"""
+    return os.path.join(SERP_CACHE_DIR, "serp_cache.json"), os.path.join(SERP_CACHE_DIR, "page_cache.json")
 
-{web_results}
-Current date: {current_date}
 
-Instructions: Using the provided web search results, write a comprehensive reply to the given query. Make sure to cite results using [number](URL) notation after the reference. If the provided search results refer to multiple subjects with the same name, write separate answers for each subject.
-Query: {query}'''
+def save_caches():
+    """Write both caches to SERP_CACHE_DIR"""
+    search_path, page_path = cache_paths()
+    search_cache.dump(search_path)
+    page_cache.dump(page_path)
+
+
+if SERP_CACHE_DIR:
+    os.makedirs(SERP_CACHE_DIR, exist_ok=True)
+    search_path, page_path = cache_paths()
+    log.info("Loaded %s search results and %s pages from cache", search_cache.load(search_path), page_cache.load(page_path))
+    atexit.register(save_caches)
 
+
+def format_web_result(counter: int, result: dict) -> str:
+    """Formats one web result"""
+    return f"[{counter}] \"{result['body']}\"\nURL: {result['href']}\n\n"
+
+
+def format_web_results(results: list) -> str:
+    """Formats web results"""
+    return "\n".join([format_web_result(counter, result) for counter, result in enumerate(results, 1)])
+
+
+def pack_results(results: list, query: str, current_date: str) -> list:
+    """Keep as many results by rank as fit into the prompt next to SERP_ANSWER_TOKENS of answer"""
+    budget = (get_model(COMPLETION_MODEL).context - SERP_ANSWER_TOKENS
+              - template_tokens(SERP_PROMPT.format(web_results="", current_date="", query=""))
+              - count_tokens(query) - count_tokens(current_date))
+    # Results are counted one by one, leave a token per result for joining them
+    budget -= len(results)
+    # Counter is rendered with two digits to be on the safe side, single page may take everything
+    return pack(results, budget, lambda result, body: format_web_result(10, {**result, "body": body}),
+                item_limit=SERP_RESULT_TOKENS if len(results) > 1 else None)
+
+
+def get_serp(query: str, num_results: int, time_period: str, region: str, deep: bool = False) -> list:
+    """Returns a list of search results, with `deep` snippets are replaced by text of the pages"""
     web_results = api_search(query, num_results, time_period, region)
+    if deep and not re.search(r"page:(\S+)", query):
+        web_results = deep_search(web_results)
     current_date = datetime.datetime.now().strftime("%Y-%m-%d")
+    web_results = pack_results(web_results, query, current_date)
 
-    final = serp_prompt.format(
+    final = SERP_PROMPT.format(
         web_results=format_web_results(web_results),
         current_date=current_date,
         query=query
@@ -52,14 +156,11 @@ def api_search(query: str, num_results: int, time_period: str, region: str) -> l
     query_url = None
 
     if page_operator_matches:
-	    # Not tested
-        return;
         query_url = page_operator_matches.group(1)
         # Check is it is a valid URL
         if not re.match(r"^https?://", query_url):
             query_url = "http://" + query_url
 
-        
     if query_url:
         result = page_to_text(query_url)
         return [{
@@ -68,25 +169,164 @@ def api_search(query: str, num_results: int, time_period: str, region: str) -> l
             "href": query_url,
         }]
     else:
+        key = (query, region, time_period, num_results)
+        output = search_cache.get(key)
+        if output is not None:
+            return output
         output = []
         if time_period == "all":
             time_period = None
+        from duckduckgo_search import ddg
         results = ddg(query, region, safesearch='Off', time=time_period, max_results=num_results)
-        print(results)
-        for result in results:
+        log.debug("Search results: %s", results)
+        for result in results or []:
             output.append({
                 "title": result["title"],
                 "body": result["body"],
                 "href": result["href"],
             })
+        search_cache.put(key, output)
         return output
 
-def page_to_text(url):
-    """Converts a webpage to text"""
-    response = requests.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=10)
-    document = Document(response.text)
-    # return title and summary
+def deep_search(results: list) -> list:
+    """Fetch pages of all results at once, snippet is kept for pages not ready by SERP_DEEP_TIMEOUT"""
+    deadline = time.monotonic() + SERP_DEEP_TIMEOUT
+    futures = [fetch_executor.submit(page_to_text, result["href"], deadline) for result in results]
+    wait(futures, timeout=SERP_DEEP_TIMEOUT)
+    output = []
+    for result, future in zip(results, futures):
+        if not future.done():
+            future.cancel()
+            log.info("Page %s not ready in time, using snippet", result['href'])
+        elif future.exception() is not None:
+            log.info("Failed to fetch %s: %s", result['href'], future.exception())
+        elif future.result()["body"].strip():
+            result = {**result, "body": future.result()["body"]}
+        output.append(result)
+    return output
+
+def extract_page(html: str) -> dict:
+    """Title and main text of html page"""
+    from readability import Document
+    document = Document(html)
     return {
         "title": normalize_text(document.title()),
-        "body": normalize_text(document.summary())
-    }
\ No newline at end of file
+        "body": normalize_text(document.summary()),
+    }
+
+def get_extract_executor():
+    """Process pool for extraction, created on first use.
+    Workers are spawned: a forked child of the bot could inherit locks held by its other threads"""
+    global extract_executor
+    with extract_lock:
+        if extract_executor is None:
+            extract_executor = ProcessPoolExecutor(max_workers=SERP_EXTRACT_WORKERS,
+                                                   mp_context=multiprocessing.get_context("spawn"))
+        return extract_executor
+
+def drop_extract_executor(executor):
+    """Forget broken pool, so the next extraction starts a new one"""
+    global extract_executor
+    with extract_lock:
+        if extract_executor is executor:
+            extract_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def extract(html: str, deadline: float) -> dict:
+    """Run extraction in process pool, so parsing does not hold GIL of the bot"""
+    if SERP_EXTRACT_WORKERS <= 0:
+        return extract_page(html)
+    executor = get_extract_executor()
+    try:
+        return executor.submit(extract_page, html).result(timeout=max(deadline - time.monotonic(), 0.1))
+    except BrokenProcessPool:
+        log.warning("Extraction process died, pool is started again")
+        drop_extract_executor(executor)
+        return extract_page(html)
+
+def check_url(url: str):
+    """Raise UnsafeURL unless url is http(s) on default port of host with only global addresses"""
+    parts = urlsplit(url)
+    if parts.scheme not in DEFAULT_PORTS or not parts.hostname:
+        raise UnsafeURL(f"Only http and https pages can be read: {url}")
+    if SERP_ALLOW_LOCAL:
+        return
+    try:
+        port = parts.port
+    except ValueError:
+        port = -1
+    if port not in (None, DEFAULT_PORTS[parts.scheme]):
+        raise UnsafeURL(f"Pages are read from default ports only: {url}")
+    try:
+        addresses = socket.getaddrinfo(parts.hostname, DEFAULT_PORTS[parts.scheme], type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError) as err:
+        raise UnsafeURL(f"Can't resolve {parts.hostname}: {err}") from None
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        if not address.is_global:
+            raise UnsafeURL(f"{parts.hostname} is not a public address")
+
+def get_page(url: str, headers: dict):
+    """GET with redirects followed by hand, every hop is checked before it is requested"""
+    for _ in range(SERP_MAX_REDIRECTS + 1):
+        check_url(url)
+        response = session.get(url, headers=headers, stream=True, allow_redirects=False,
+                               timeout=(SERP_CONNECT_TIMEOUT, SERP_READ_TIMEOUT))
+        if not response.is_redirect:
+            return response
+        response.close()
+        url = urljoin(url, response.headers["Location"])
+    raise requests.TooManyRedirects(f"More than {SERP_MAX_REDIRECTS} redirects")
+
+def fetch_html(url: str, headers: dict, deadline: float):
+    """GET page reading at most SERP_MAX_PAGE_BYTES until deadline, returns (response, html)"""
+    with get_page(url, headers) as response:
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= SERP_MAX_PAGE_BYTES:
+                log.info("Page %s is larger than %s bytes, truncated", url, SERP_MAX_PAGE_BYTES)
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Page {url} was not downloaded in time")
+        html = b"".join(chunks)[:SERP_MAX_PAGE_BYTES].decode(response.encoding or "utf-8", errors="replace")
+    return response, html
+
+def page_to_text(url, deadline=None):
+    """Converts a webpage to text, cached page is revalidated with ETag/Last-Modified"""
+    page_deadline = time.monotonic() + SERP_PAGE_TIMEOUT
+    deadline = page_deadline if deadline is None else min(deadline, page_deadline)
+    cached = page_cache.get(url)
+    if cached is not None and time.time() - cached["checked"] < PAGE_CACHE_TTL:
+        return cached
+
+    headers = {"User-Agent": "Mozilla/5.0"}
+    if cached is not None:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+    try:
+        response, html = fetch_html(url, headers, deadline)
+    except (requests.RequestException, TimeoutError):
+        if cached is None:
+            raise
+        log.info("Failed to revalidate %s, using cached page", url)
+        return cached
+
+    if cached is not None and response.status_code == 304:
+        page = {**cached, "checked": time.time()}
+    else:
+        page = {
+            **extract(html, deadline),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "checked": time.time(),
+        }
+    if response.ok:
+        page_cache.put(url, page)
+    return page
\ No newline at end of file
@@ -0,0 +1,64 @@
+"""Cyrillic to latin transliteration of names, titles and questions
+
+Gives the same result as transliterate.translit(text, 'ru', reversed=True),
+but every rule of the ru language pack maps a single character, so the whole
+pack folds into one str.translate table. The table is built on first use from
+the pack data, transliterate is not imported while transliteration is off.
+Short strings (names, titles) are memoized.
+"""
+from functools import lru_cache
+from decouple import config
+
+# Transliterated names and titles remembered
+TRANSLIT_CACHE_SIZE = config("TRANSLIT_CACHE_SIZE", default=4096, cast=int)
+# Longer texts are questions, they rarely repeat
+MEMO_MAX_LENGTH = 64
+
+
+@lru_cache(maxsize=None)
+def language_pack():
+    """transliterate ru language pack, for texts the table can't handle"""
+    from transliterate.contrib.languages.ru.translit_language_pack import RussianLanguagePack
+    return RussianLanguagePack()
+
+
+@lru_cache(maxsize=None)
+def table():
+    """str.translate table doing what reversed translit of ru pack does, None if pack
+    has rules over several characters"""
+    pack = language_pack()
+    sources = set(pack.reversed_translation_table)
+    if pack.reversed_specific_mapping:
+        sources.update(pack.reversed_specific_translation_table)
+    for rules in (pack.reversed_specific_pre_processor_mapping, pack.reversed_pre_processor_mapping):
+        if rules:
+            if any(len(rule) != 1 for rule in rules):
+                return None
+            sources.update(ord(rule) for rule in rules)
+    # Characters are independent, so every one maps to what pack makes of it alone
+    mapping = {}
+    for code in sources:
+        result = pack.translit(chr(code), reversed=True)
+        if result != chr(code):
+            mapping[code] = result
+    return mapping
+
+
+def to_latin(text):
+    """Transliterate text"""
+    if len(text) <= MEMO_MAX_LENGTH:
+        return memoized(text)
+    return convert(text)
+
+
+def convert(text):
+    """Transliterate text without memo"""
+    if text.isascii():
+        return text
+    mapping = table()
+    if mapping is None:
+        return language_pack().translit(text, reversed=True)
+    return text.translate(mapping)
+
+
+memoized = lru_cache(maxsize=TRANSLIT_CACHE_SIZE)(convert)
@@ -0,0 +1,90 @@
+"""Webhook mode: Telegram posts updates to a local HTTP server, worker processes handle them
+
+Run: python webhook.py (set WEBHOOK_URL to register the webhook with Telegram)
+"""
+import json
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from decouple import config
+from telebot import apihelper
+
+from workers import WorkerPool
+from utils import metrics
+from utils.log import get_logger
+
+BOT_TOKEN = config("BOT_TOKEN")
+# Bot API server, for local Bot API server or tests
+TELEGRAM_API_URL = config("TELEGRAM_API_URL", default="")
+# Address to listen on and path Telegram posts to
+WEBHOOK_HOST = config("WEBHOOK_HOST", default="0.0.0.0")
+WEBHOOK_PORT = config("WEBHOOK_PORT", default=8080, cast=int)
+WEBHOOK_PATH = config("WEBHOOK_PATH", default="/telegram")
+# Public url passed to setWebhook, empty keeps current webhook settings
+WEBHOOK_URL = config("WEBHOOK_URL", default="")
+# Telegram sends it in X-Telegram-Bot-Api-Secret-Token, empty disables the check
+WEBHOOK_SECRET = config("WEBHOOK_SECRET", default="")
+
+log = get_logger("bot")
+
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accept update, queue it and answer right away"""
+    # Keep-alive, Telegram reuses connections to webhook
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        """Telegram update"""
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != WEBHOOK_PATH:
+            return self.answer(404)
+        if WEBHOOK_SECRET and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return self.answer(403)
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return self.answer(400)
+        # Telegram retries update if webhook does not answer 200
+        return self.answer(200 if self.server.pool.submit(update) else 503)
+
+    def answer(self, status):
+        """Send empty response"""
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        """Access log is too noisy for every update"""
+
+
+def create_server(pool, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+    """HTTP server that feeds updates to worker pool"""
+    server = ThreadingHTTPServer((host, port), WebhookHandler)
+    server.daemon_threads = True
+    server.pool = pool
+    return server
+
+
+def main():
+    """Start workers, register webhook and serve until interrupted"""
+    pool = WorkerPool()
+    pool.start()
+    server = create_server(pool)
+    if WEBHOOK_URL:
+        apihelper.set_webhook(BOT_TOKEN, url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+        log.info("Webhook set to %s", WEBHOOK_URL + WEBHOOK_PATH)
+    metrics.start_server()
+    log.info("Listening for updates on %s:%s%s with %s shards x %s threads",
+             WEBHOOK_HOST, server.server_port, WEBHOOK_PATH, len(pool.processes), pool.threads)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.stop()
+
+
+if __name__ == "__main__":
+    main()
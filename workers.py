@@ -0,0 +1,159 @@
+"""Worker processes (shards) that handle Telegram updates received by webhook.py or dispatcher.py
+
+Updates are partitioned by chat id: a chat is always handled by the same thread
+of the same shard, so messages of one chat are processed in order while
+different chats run in parallel. Every shard stores its chats in its own
+locked directory, see storage.shard_dir.
+"""
+import os
+import queue
+import threading
+import multiprocessing
+from collections import OrderedDict
+from decouple import config
+
+from storage import lock_directory, rebalance_shards, shard_of, shard_dir
+from utils import metrics
+from utils.log import get_logger
+
+# Worker processes, threads (ordered partitions) in each and updates queued per process
+SHARDS = config("SHARDS", default=os.cpu_count() or 1, cast=int)
+SHARD_THREADS = config("SHARD_THREADS", default=8, cast=int)
+SHARD_QUEUE_SIZE = config("SHARD_QUEUE_SIZE", default=1000, cast=int)
+# update_ids remembered by the dispatcher, an update Telegram delivers again is dropped
+RECENT_UPDATES = config("RECENT_UPDATES", default=10000, cast=int)
+LOG_DIR = config("LOG_DIR", default=os.path.join(os.getcwd(), "logs"))
+
+log = get_logger("worker")
+
+
+def update_chat_id(update):
+    """Chat id of update, 0 for updates without chat"""
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post",
+                "my_chat_member", "chat_member", "chat_join_request"):
+        if key in update:
+            return update[key]["chat"]["id"]
+    if "callback_query" in update and "message" in update["callback_query"]:
+        return update["callback_query"]["message"]["chat"]["id"]
+    return 0
+
+
+def share_username():
+    """Check bot token once, workers read bot username from BOT_USERNAME instead of calling getMe each"""
+    if os.environ.get("BOT_USERNAME"):
+        return
+    from telebot import apihelper
+    os.environ["BOT_USERNAME"] = apihelper.get_me(config("BOT_TOKEN"))["username"]
+    log.info("Token is ok, bot username: @%s", os.environ["BOT_USERNAME"])
+
+
+def run_lane(bot, lane):
+    """Handle updates of one partition one by one"""
+    from telebot.types import Update
+    while True:
+        update = lane.get()
+        if update is None:
+            return
+        try:
+            bot.process_new_updates([Update.de_json(update)])
+        except Exception as ex:
+            log.exception("Update failed > %s", ex)
+
+
+def run_worker(index, updates, ready, log_dir, threads):
+    """Worker process: load bot and spread own updates over `threads` ordered lanes"""
+    # Bot is imported here, every spawned process creates its own clients, caches
+    # and storage, which locks the shard directory
+    os.environ["LOG_DIR"] = log_dir
+    import app
+    app.get_storage()
+    # Handlers run in our lanes, not in bot's own thread pool that would reorder them
+    app.bot.threaded = False
+    lanes = [queue.Queue() for _ in range(threads)]
+    workers = [threading.Thread(target=run_lane, args=(app.bot, lane), daemon=True) for lane in lanes]
+    for worker in workers:
+        worker.start()
+    if metrics.METRICS_PORT:
+        # Dispatcher serves METRICS_PORT, shards the ports after it
+        metrics.start_server(metrics.METRICS_PORT + 1 + index)
+    log.info("Worker %s ready with %s threads", index, threads)
+    ready.set()
+    while True:
+        update = updates.get()
+        if update is None:
+            break
+        lanes[update_chat_id(update) % threads].put(update)
+    for lane in lanes:
+        lane.put(None)
+    for worker in workers:
+        worker.join()
+
+
+class WorkerPool:
+    """Shard processes with bounded update queues, update goes to shard_of(chat id)"""
+
+    def __init__(self, shards=SHARDS, threads=SHARD_THREADS, queue_size=SHARD_QUEUE_SIZE, log_dir=LOG_DIR):
+        # Spawn, so workers do not inherit sockets and threads of the HTTP server
+        context = multiprocessing.get_context("spawn")
+        self.log_dir = log_dir
+        self.threads = threads
+        self.dir_lock = None
+        self.recent = OrderedDict()
+        self.recent_lock = threading.Lock()
+        self.queues = [context.Queue(queue_size) for _ in range(shards)]
+        self.ready = [context.Event() for _ in range(shards)]
+        self.processes = [
+            context.Process(target=run_worker, name=f"shard-{index}", daemon=True,
+                            args=(index, self.queues[index], self.ready[index], shard_dir(log_dir, index, shards), threads))
+            for index in range(shards)
+        ]
+
+    def start(self, timeout=60):
+        """Move chats to their shards, start workers and wait until all of them loaded the bot"""
+        shards = len(self.processes)
+        self.dir_lock = lock_directory(self.log_dir)
+        rebalance_shards(self.log_dir, shards)
+        if shards == 1:
+            # Single shard works in log_dir itself and takes the lock
+            self.dir_lock.close()
+            self.dir_lock = None
+        # Spawned processes inherit environment as it is now
+        share_username()
+        for process in self.processes:
+            process.start()
+        for index, ready in enumerate(self.ready):
+            if not ready.wait(timeout):
+                raise RuntimeError(f"Worker {index} did not start in {timeout}s")
+
+    def submit(self, update, timeout=1.0):
+        """Queue update for its worker, False if worker is too far behind.
+        Update with update_id seen recently is dropped and counts as queued"""
+        update_id = update["update_id"]
+        with self.recent_lock:
+            if update_id in self.recent:
+                metrics.DISPATCHED.inc(status="duplicate")
+                return True
+            self.recent[update_id] = None
+            while len(self.recent) > RECENT_UPDATES:
+                self.recent.popitem(last=False)
+        partition = shard_of(update_chat_id(update), len(self.queues))
+        try:
+            self.queues[partition].put(update, timeout=timeout)
+        except queue.Full:
+            # Sender retries it, so it is not a duplicate then
+            with self.recent_lock:
+                self.recent.pop(update_id, None)
+            metrics.DISPATCHED.inc(status="full")
+            return False
+        metrics.DISPATCHED.inc(status="queued")
+        return True
+
+    def stop(self, timeout=30):
+        """Let workers finish queued updates and exit"""
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join(timeout)
+        if self.dir_lock is not None:
+            self.dir_lock.close()
+            self.dir_lock = None